@@ -1,10 +1,25 @@
 from datetime import datetime
+from array import array
 import asyncio
+import base64
+import bisect
+import heapq
+import itertools
+import json
+import math
 import os
 import random
-import requests
+import sqlite3
+import sys
+import time
+import zlib
+from collections import Counter, OrderedDict
+from decimal import Decimal
+from typing import NamedTuple
+import aiohttp
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
@@ -23,15 +38,60 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 TMDB_TOKEN = os.getenv("API_TMDB")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Настройки HTTP-клиента TMDB
+TMDB_TIMEOUT = float(os.getenv("TMDB_TIMEOUT", "10"))
+TMDB_MAX_CONNECTIONS = int(os.getenv("TMDB_MAX_CONNECTIONS", "20"))
+TMDB_CONCURRENCY = int(os.getenv("TMDB_CONCURRENCY", "10"))
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", "40"))  # запросов в секунду
+TMDB_RATE_BURST = int(os.getenv("TMDB_RATE_BURST", "20"))
+TMDB_MAX_RETRIES = int(os.getenv("TMDB_MAX_RETRIES", "3"))
+TMDB_RETRY_BASE = float(os.getenv("TMDB_RETRY_BASE", "0.5"))  # секунд, удваивается с каждой попыткой
+
+# Кэш деталей TMDB: размер в памяти, время жизни и (опционально) файл для второго уровня
+TMDB_CACHE_SIZE = int(os.getenv("TMDB_CACHE_SIZE", "5000"))
+TMDB_CACHE_TTL = int(os.getenv("TMDB_CACHE_TTL", str(6 * 60 * 60)))
+TMDB_CACHE_PATH = os.getenv("TMDB_CACHE_PATH")
+TMDB_CACHE_FLUSH_INTERVAL = float(os.getenv("TMDB_CACHE_FLUSH_INTERVAL", "5"))  # секунд, запись на диск пачками
+
+# Пул страниц discover: сколько страниц держать наготове на один набор фильтров,
+# сколько наборов фильтров помнить и как долго верить закэшированному total_pages
+DISCOVER_POOL_PAGES = int(os.getenv("DISCOVER_POOL_PAGES", "3"))
+DISCOVER_POOL_SIGNATURES = int(os.getenv("DISCOVER_POOL_SIGNATURES", "200"))
+DISCOVER_TOTAL_TTL = int(os.getenv("DISCOVER_TOTAL_TTL", str(6 * 60 * 60)))
+
+# Сессии чатов: время жизни с последнего обращения, общий бюджет памяти и период очистки
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(24 * 60 * 60)))
+SESSION_MEMORY_MB = int(os.getenv("SESSION_MEMORY_MB", "64"))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+# Бюджет памяти кэша настроек пользователей (аниме/мультфильмы/просмотренное)
+PREFS_MEMORY_MB = int(os.getenv("PREFS_MEMORY_MB", "8"))
+# Бюджет памяти кэша просмотренного (отсортированные массивы id на пользователя)
+WATCHED_MEMORY_MB = int(os.getenv("WATCHED_MEMORY_MB", "16"))
+# Где хранить состояние чатов: memory (только этот процесс) или postgres (общее для всех процессов)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+
+# Сколько кандидатов можно отклонить (бан, фильтры) при подборе одной карточки
+CANDIDATE_BUDGET = int(os.getenv("CANDIDATE_BUDGET", "40"))
+
+# Как часто сверять счетчики title_stats и friend_signals с исходными таблицами (секунд)
+TITLE_STATS_RECONCILE_INTERVAL = int(os.getenv("TITLE_STATS_RECONCILE_INTERVAL", str(60 * 60)))
+
+# Рекомендации по оценкам пользователей: число соседей на тайтл и период полной пересборки (секунд)
+CF_TOP_K = int(os.getenv("CF_TOP_K", "50"))
+CF_REBUILD_INTERVAL = int(os.getenv("CF_REBUILD_INTERVAL", str(60 * 60)))
+
 
 bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 db: asyncpg.Pool = None
+tmdb_http: aiohttp.ClientSession | None = None
+tmdb_semaphore = asyncio.Semaphore(TMDB_CONCURRENCY)
+# Одинаковые запросы к TMDB, выполняющиеся прямо сейчас: future и общий билет приоритета
+tmdb_inflight: dict[tuple, tuple[asyncio.Future, dict]] = {}
+tmdb_stats = {"requests": 0, "coalesced": 0, "throttled": 0, "retries": 0, "promoted": 0}
 
-# Персистентные структуры в памяти
-user_sessions = {}
-user_filters = {}
+# Персистентные структуры в памяти (user_sessions и user_filters — SessionStore, объявлены в разделе CACHE)
 user_input_waiting = {}
 
 # ЖАНРЫ TMDB
@@ -151,9 +211,230 @@ async def init_db():
                 CONSTRAINT unique_friend_request UNIQUE (from_user_id, to_user_id)
             );
         """)
+        # file_id постеров, уже загруженных в Telegram
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS poster_file_ids (
+                poster_path TEXT NOT NULL,
+                size TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                PRIMARY KEY (poster_path, size)
+            );
+        """)
+        # Индексы под горячие запросы (проверяются командой /explain)
+        await conn.execute("""
+            -- оценки по тайтлу (лайки друзей на карточке, сверка title_stats)
+            CREATE INDEX IF NOT EXISTS idx_ratings_title
+                ON ratings (tmdb_id, type) INCLUDE (liked, disliked, watched);
+            -- просмотренное пользователем (load_watched)
+            CREATE INDEX IF NOT EXISTS idx_ratings_user_watched
+                ON ratings (user_id, type, tmdb_id) WHERE watched = TRUE;
+            -- лайки пользователя, видимые друзьям (пересчет friend_signals)
+            CREATE INDEX IF NOT EXISTS idx_ratings_user_liked
+                ON ratings (user_id, tmdb_id, type) WHERE liked = TRUE AND watched = TRUE AND is_hidden = FALSE;
+            -- коллекция по дате добавления (get_collection, get_collection_count)
+            CREATE INDEX IF NOT EXISTS idx_collection_user_added
+                ON collection (user_id, added_at DESC);
+            -- проверка наличия в коллекции (is_in_user_collection)
+            CREATE INDEX IF NOT EXISTS idx_collection_user_item
+                ON collection (user_id, tmdb_id, type);
+            -- обратная сторона дружбы
+            CREATE INDEX IF NOT EXISTS idx_user_friends_friend
+                ON user_friends (friend_user_id);
+            -- входящие заявки (get_pending_friend_requests)
+            CREATE INDEX IF NOT EXISTS idx_friend_requests_pending
+                ON friend_requests (to_user_id, created_at DESC) WHERE status = 'pending';
+        """)
+        # Счетчики реакций по тайтлу. Триггер обновляет их в той же транзакции,
+        # что и изменение ratings, поэтому карточка читает одну строку
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS title_stats (
+                tmdb_id INT NOT NULL,
+                type TEXT NOT NULL,
+                likes INT NOT NULL DEFAULT 0,
+                dislikes INT NOT NULL DEFAULT 0,
+                watches INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (tmdb_id, type)
+            );
+
+            -- Когда фоновая задача (сверка счетчиков) последний раз выполнялась каким-либо процессом
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                job TEXT PRIMARY KEY,
+                ran_at TIMESTAMP NOT NULL
+            );
+
+            CREATE OR REPLACE FUNCTION title_stats_apply() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    INSERT INTO title_stats AS s (tmdb_id, type, likes, dislikes, watches)
+                    VALUES (OLD.tmdb_id, OLD.type,
+                            -COALESCE(OLD.liked, FALSE)::int,
+                            -COALESCE(OLD.disliked, FALSE)::int,
+                            -COALESCE(OLD.watched, FALSE)::int)
+                    ON CONFLICT (tmdb_id, type) DO UPDATE SET
+                        likes = s.likes + EXCLUDED.likes,
+                        dislikes = s.dislikes + EXCLUDED.dislikes,
+                        watches = s.watches + EXCLUDED.watches;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO title_stats AS s (tmdb_id, type, likes, dislikes, watches)
+                    VALUES (NEW.tmdb_id, NEW.type,
+                            COALESCE(NEW.liked, FALSE)::int,
+                            COALESCE(NEW.disliked, FALSE)::int,
+                            COALESCE(NEW.watched, FALSE)::int)
+                    ON CONFLICT (tmdb_id, type) DO UPDATE SET
+                        likes = s.likes + EXCLUDED.likes,
+                        dislikes = s.dislikes + EXCLUDED.dislikes,
+                        watches = s.watches + EXCLUDED.watches;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_title_stats ON ratings;
+            CREATE TRIGGER trg_title_stats
+                AFTER INSERT OR DELETE OR UPDATE OF tmdb_id, type, liked, disliked, watched ON ratings
+                FOR EACH ROW EXECUTE FUNCTION title_stats_apply();
+        """)
+        # Рекомендации от друзей: для каждого пользователя — тайтлы, которые друзья лайкнули
+        # и посмотрели (не скрыв оценку), с числом и id лайкнувших (имена берутся из users при
+        # чтении). Строка пересчитывается триггерами при изменении оценки друга или списка
+        # друзей и периодически сверяется (reconcile_friend_signals)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS friend_signals (
+                user_id INT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                tmdb_id INT NOT NULL,
+                type TEXT NOT NULL,
+                title TEXT,
+                liker_count INT NOT NULL,
+                liker_ids INT[] NOT NULL,
+                PRIMARY KEY (user_id, tmdb_id, type)
+            );
+            -- Имена лайкнувших раньше хранились в таблице и устаревали при смене username
+            ALTER TABLE friend_signals DROP COLUMN IF EXISTS liker_names;
+            CREATE INDEX IF NOT EXISTS idx_friend_signals_top
+                ON friend_signals (user_id, liker_count DESC);
+
+            CREATE OR REPLACE FUNCTION friend_signals_refresh(p_user INT, p_tmdb INT, p_type TEXT)
+            RETURNS void AS $$
+            DECLARE
+                v_count INT;
+                v_ids INT[];
+                v_title TEXT;
+            BEGIN
+                -- Пользователь удаляется каскадом — пересчитывать для него нечего
+                IF NOT EXISTS (SELECT 1 FROM users WHERE user_id = p_user) THEN
+                    RETURN;
+                END IF;
+                -- Пересчеты одной строки выполняются по очереди: следующий ждет коммита
+                -- предыдущего и видит его оценку (иначе параллельные лайки теряют друг друга)
+                PERFORM pg_advisory_xact_lock(hashtext('friend_signals:' || p_user || ':' || p_tmdb || ':' || p_type));
+                SELECT count(*),
+                       array_agg(r.user_id ORDER BY r.user_id),
+                       max(r.title)
+                  INTO v_count, v_ids, v_title
+                  FROM user_friends uf
+                  JOIN ratings r ON r.user_id = uf.friend_user_id
+                 WHERE uf.user_id = p_user
+                   AND r.tmdb_id = p_tmdb AND r.type = p_type
+                   AND r.liked = TRUE AND r.watched = TRUE AND r.is_hidden = FALSE;
+                IF v_count = 0 THEN
+                    DELETE FROM friend_signals
+                     WHERE user_id = p_user AND tmdb_id = p_tmdb AND type = p_type;
+                ELSE
+                    INSERT INTO friend_signals (user_id, tmdb_id, type, title, liker_count, liker_ids)
+                    VALUES (p_user, p_tmdb, p_type, v_title, v_count, v_ids)
+                    ON CONFLICT (user_id, tmdb_id, type) DO UPDATE SET
+                        title = EXCLUDED.title,
+                        liker_count = EXCLUDED.liker_count,
+                        liker_ids = EXCLUDED.liker_ids;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION friend_signals_on_rating() RETURNS trigger AS $$
+            DECLARE
+                old_signal BOOLEAN := FALSE;
+                new_signal BOOLEAN := FALSE;
+                moved BOOLEAN := FALSE;
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    old_signal := OLD.liked AND OLD.watched AND NOT OLD.is_hidden;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    new_signal := NEW.liked AND NEW.watched AND NOT NEW.is_hidden;
+                END IF;
+                IF TG_OP = 'UPDATE' THEN
+                    moved := (OLD.user_id, OLD.tmdb_id, OLD.type) IS DISTINCT FROM (NEW.user_id, NEW.tmdb_id, NEW.type);
+                END IF;
+                IF COALESCE(old_signal, FALSE) AND (NOT COALESCE(new_signal, FALSE) OR moved) THEN
+                    PERFORM friend_signals_refresh(uf.user_id, OLD.tmdb_id, OLD.type)
+                       FROM user_friends uf WHERE uf.friend_user_id = OLD.user_id;
+                END IF;
+                IF COALESCE(new_signal, FALSE) AND (NOT COALESCE(old_signal, FALSE) OR moved) THEN
+                    PERFORM friend_signals_refresh(uf.user_id, NEW.tmdb_id, NEW.type)
+                       FROM user_friends uf WHERE uf.friend_user_id = NEW.user_id;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE OR REPLACE FUNCTION friend_signals_on_friendship() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM friend_signals_refresh(NEW.user_id, r.tmdb_id, r.type)
+                       FROM ratings r
+                      WHERE r.user_id = NEW.friend_user_id
+                        AND r.liked = TRUE AND r.watched = TRUE AND r.is_hidden = FALSE;
+                ELSE
+                    PERFORM friend_signals_refresh(OLD.user_id, fs.tmdb_id, fs.type)
+                       FROM friend_signals fs
+                      WHERE fs.user_id = OLD.user_id AND OLD.friend_user_id = ANY(fs.liker_ids);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS trg_friend_signals_rating ON ratings;
+            CREATE TRIGGER trg_friend_signals_rating
+                AFTER INSERT OR DELETE OR UPDATE OF user_id, tmdb_id, type, liked, watched, is_hidden ON ratings
+                FOR EACH ROW EXECUTE FUNCTION friend_signals_on_rating();
+
+            DROP TRIGGER IF EXISTS trg_friend_signals_friendship ON user_friends;
+            CREATE TRIGGER trg_friend_signals_friendship
+                AFTER INSERT OR DELETE ON user_friends
+                FOR EACH ROW EXECUTE FUNCTION friend_signals_on_friendship();
+        """)
+    await session_backend.setup()
+    await load_poster_file_ids()
+    # Заполняет счетчики для оценок, сохраненных до появления триггеров (только при первом запуске);
+    # дальше дрейф чинит периодическая сверка
+    await reconcile_title_stats(None)
+    await reconcile_friend_signals(None)
+    await build_cf_model()
+    await start_banned_listener()
 
 
 # -------------------- DB HELPERS --------------------
+# tg_id -> user_id. Связка не меняется, пока пользователь существует;
+# код, удаляющий пользователей, должен вызывать forget_user_id
+user_ids: dict[int, int] = {}
+
+
+async def get_user_id(conn, tg_id: int) -> int | None:
+    """Возвращает user_id по tg_id, обращаясь к БД только при промахе кэша"""
+    user_id = user_ids.get(tg_id)
+    if user_id is None:
+        user_id = await conn.fetchval("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
+        if user_id is not None:
+            user_ids[tg_id] = user_id
+    return user_id
+
+
+def forget_user_id(tg_id: int):
+    """Сбрасывает кэшированный user_id (при удалении пользователя)"""
+    user_ids.pop(tg_id, None)
+
+
 async def get_or_create_user(tg_id: int, username: str | None = None):
     async with db.acquire() as conn:
         user = await conn.fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
@@ -162,37 +443,54 @@ async def get_or_create_user(tg_id: int, username: str | None = None):
                 "INSERT INTO users (tg_id, username) VALUES ($1, $2) RETURNING *",
                 tg_id, username
             )
+        user_ids[tg_id] = user["user_id"]
         return user
 
 
+# Колонка users -> ключ настроек в user_filters
+USER_FILTER_FIELDS = {
+    "disable_anime": "exclude_anime",
+    "disable_cartoons": "exclude_cartoons",
+    "hide_watched": "exclude_watched",
+}
+
+
 async def update_user_filter(tg_id: int, field: str, value: bool):
     async with db.acquire() as conn:
         await conn.execute(f"UPDATE users SET {field}=$1 WHERE tg_id=$2", value, tg_id)
+    # Пишем и в кэш, чтобы следующее чтение не ходило в базу
+    filters = user_filters.get(tg_id)
+    if filters is not None:
+        user_filters[tg_id] = {**filters, USER_FILTER_FIELDS[field]: value}
+    invalidate_card_prefetch(tg_id)
 
 
 async def get_user_filters(tg_id: int):
+    """Настройки пользователя: из кэша user_filters, при промахе — из базы"""
+    filters = user_filters.get(tg_id)
+    if filters is not None:
+        return dict(filters)
     async with db.acquire() as conn:
         row = await conn.fetchrow(
             "SELECT disable_anime, disable_cartoons, hide_watched FROM users WHERE tg_id=$1", tg_id
         )
-        if row:
-            return {
-                "exclude_anime": row["disable_anime"],
-                "exclude_cartoons": row["disable_cartoons"],
-                "exclude_watched": row["hide_watched"]
-            }
-        return {"exclude_anime": False, "exclude_cartoons": False, "exclude_watched": False}
+    if row:
+        filters = {key: row[field] for field, key in USER_FILTER_FIELDS.items()}
+    else:
+        filters = {"exclude_anime": False, "exclude_cartoons": False, "exclude_watched": False}
+    user_filters[tg_id] = filters
+    return dict(filters)
 
 
 async def save_search_filters(tg_id: int, filters: dict):
     """Сохраняет фильтры поиска в базу данных"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return False
 
         # Проверяем, есть ли уже фильтры для пользователя
-        existing = await conn.fetchrow("SELECT * FROM user_filters WHERE user_id=$1", user["user_id"])
+        existing = await conn.fetchrow("SELECT * FROM user_filters WHERE user_id=$1", user_id)
 
         if existing:
             # Обновляем существующие фильтры
@@ -205,13 +503,13 @@ async def save_search_filters(tg_id: int, filters: dict):
                                    updated_at=NOW()
                                WHERE user_id = $5
                                """, filters.get('start_year'), filters.get('end_year'), filters.get('country'),
-                               filters.get('rating'), user["user_id"])
+                               filters.get('rating'), user_id)
         else:
             # Создаем новые фильтры
             await conn.execute("""
                                INSERT INTO user_filters (user_id, start_year, end_year, country_code, min_rating)
                                VALUES ($1, $2, $3, $4, $5)
-                               """, user["user_id"], filters.get('start_year'), filters.get('end_year'),
+                               """, user_id, filters.get('start_year'), filters.get('end_year'),
                                filters.get('country'), filters.get('rating'))
 
         return True
@@ -220,15 +518,15 @@ async def save_search_filters(tg_id: int, filters: dict):
 async def load_search_filters(tg_id: int):
     """Загружает фильтры поиска из базы данных"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return {}
 
         row = await conn.fetchrow("""
                                   SELECT start_year, end_year, country_code, min_rating
                                   FROM user_filters
                                   WHERE user_id = $1
-                                  """, user["user_id"])
+                                  """, user_id)
 
         if row:
             filters = {}
@@ -247,11 +545,11 @@ async def load_search_filters(tg_id: int):
 async def clear_search_filters(tg_id: int):
     """Очищает фильтры поиска пользователя"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return False
 
-        await conn.execute("DELETE FROM user_filters WHERE user_id=$1", user["user_id"])
+        await conn.execute("DELETE FROM user_filters WHERE user_id=$1", user_id)
         return True
 
 async def get_current_filters(chat_id: int):
@@ -268,49 +566,52 @@ async def get_current_filters(chat_id: int):
 
 async def add_to_collection(tg_id: int, tmdb_id: int, type_: str, title: str, year: str, poster_path: str):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return False
         await conn.execute("""
                            INSERT INTO collection (user_id, tmdb_id, type, title, year, poster_path)
                            VALUES ($1, $2, $3, $4, $5, $6)
-                           """, user["user_id"], tmdb_id, type_, title, year, poster_path)
+                           """, user_id, tmdb_id, type_, title, year, poster_path)
         return True
 
 
+SQL_GET_COLLECTION = """
+                     SELECT *
+                     FROM collection
+                     WHERE user_id = $1
+                     ORDER BY added_at DESC
+                         LIMIT $2
+                     OFFSET $3
+                     """
+
+
 async def get_collection(tg_id: int, limit=4, offset=0):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return []
-        rows = await conn.fetch("""
-                                SELECT *
-                                FROM collection
-                                WHERE user_id = $1
-                                ORDER BY added_at DESC
-                                    LIMIT $2
-                                OFFSET $3
-                                """, user["user_id"], limit, offset)
+        rows = await conn.fetch(SQL_GET_COLLECTION, user_id, limit, offset)
         return rows
 
 
 async def get_collection_count(tg_id: int):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return 0
         row = await conn.fetchrow("""
                                   SELECT COUNT(*)
                                   FROM collection
                                   WHERE user_id = $1
-                                  """, user["user_id"])
+                                  """, user_id)
         return row["count"]
 
 
 async def remove_from_collection(tg_id: int, tmdb_id: int, type_: str):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return False
         await conn.execute("""
                            DELETE
@@ -318,17 +619,17 @@ async def remove_from_collection(tg_id: int, tmdb_id: int, type_: str):
                            WHERE user_id = $1
                              AND tmdb_id = $2
                              AND type = $3
-                           """, user["user_id"], tmdb_id, type_)
+                           """, user_id, tmdb_id, type_)
         return True
 
 
 async def add_friend(user_tg_id: int, friend_tg_id: int):
     """Добавляет друга"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", user_tg_id)
-        friend = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", friend_tg_id)
+        user_id = await get_user_id(conn, user_tg_id)
+        friend_user_id = await get_user_id(conn, friend_tg_id)
 
-        if not user or not friend or user["user_id"] == friend["user_id"]:
+        if user_id is None or friend_user_id is None or user_id == friend_user_id:
             return False
 
         # Добавляем взаимную дружбу
@@ -336,7 +637,7 @@ async def add_friend(user_tg_id: int, friend_tg_id: int):
             INSERT INTO user_friends (user_id, friend_user_id)
             VALUES ($1, $2), ($2, $1)
             ON CONFLICT (user_id, friend_user_id) DO NOTHING
-        """, user["user_id"], friend["user_id"])
+        """, user_id, friend_user_id)
 
         return True
 
@@ -344,8 +645,8 @@ async def add_friend(user_tg_id: int, friend_tg_id: int):
 async def get_user_friends(tg_id: int):
     """Получает список друзей пользователя"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return []
 
         rows = await conn.fetch("""
@@ -354,102 +655,148 @@ async def get_user_friends(tg_id: int):
             JOIN users u ON uf.friend_user_id = u.user_id
             WHERE uf.user_id = $1
             ORDER BY uf.created_at DESC
-        """, user["user_id"])
+        """, user_id)
 
         return rows
 
 
+SQL_GET_FRIENDS_LIKES = """
+    SELECT
+        fs.tmdb_id,
+        fs.type,
+        fs.title,
+        fs.liker_count AS friend_likes_count
+    FROM friend_signals fs
+    WHERE fs.user_id = $1
+    AND NOT EXISTS (
+        SELECT 1 FROM ratings r
+        WHERE r.user_id = $1 AND r.tmdb_id = fs.tmdb_id AND r.type = fs.type AND r.watched = TRUE
+    )
+    ORDER BY fs.liker_count DESC
+    LIMIT $2
+"""
+
+SQL_GET_FRIEND_SIGNAL = """
+    SELECT
+        fs.title,
+        fs.liker_count,
+        ARRAY(
+            SELECT u.username FROM users u
+            WHERE u.user_id = ANY(fs.liker_ids) AND u.username <> ''
+            ORDER BY u.user_id
+        ) AS liker_names
+    FROM friend_signals fs
+    WHERE fs.user_id = $1
+    AND fs.tmdb_id = $2
+    AND fs.type = $3
+"""
+
+
+friend_signals_reconcile = {"runs": 0, "repaired": 0}
+
+
+async def reconcile_friend_signals(interval: int | None) -> int | None:
+    """Пересчитывает friend_signals по ratings и user_friends, возвращает число исправленных строк.
+    Заодно заполняет таблицу при первом запуске. None — пересчет не понадобился: см. claim_maintenance"""
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            if not await claim_maintenance(conn, "friend_signals", interval):
+                return None
+            # Блокируем запись в исходные таблицы на время пересчета, иначе триггеры и сверка могут разойтись
+            await conn.execute("LOCK TABLE ratings, user_friends IN SHARE MODE")
+            upserted = await conn.execute("""
+                INSERT INTO friend_signals AS s (user_id, tmdb_id, type, title, liker_count, liker_ids)
+                SELECT uf.user_id, r.tmdb_id, r.type, max(r.title), count(*),
+                       array_agg(r.user_id ORDER BY r.user_id)
+                FROM user_friends uf
+                JOIN ratings r ON r.user_id = uf.friend_user_id
+                WHERE r.liked = TRUE AND r.watched = TRUE AND r.is_hidden = FALSE
+                GROUP BY uf.user_id, r.tmdb_id, r.type
+                ON CONFLICT (user_id, tmdb_id, type) DO UPDATE SET
+                    title = EXCLUDED.title,
+                    liker_count = EXCLUDED.liker_count,
+                    liker_ids = EXCLUDED.liker_ids
+                WHERE (s.liker_count, s.liker_ids) IS DISTINCT FROM (EXCLUDED.liker_count, EXCLUDED.liker_ids)
+            """)
+            deleted = await conn.execute("""
+                DELETE FROM friend_signals s
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM user_friends uf
+                    JOIN ratings r ON r.user_id = uf.friend_user_id
+                    WHERE uf.user_id = s.user_id
+                    AND r.tmdb_id = s.tmdb_id AND r.type = s.type
+                    AND r.liked = TRUE AND r.watched = TRUE AND r.is_hidden = FALSE
+                )
+            """)
+    repaired = int(upserted.split()[-1]) + int(deleted.split()[-1])
+    friend_signals_reconcile["runs"] += 1
+    friend_signals_reconcile["repaired"] += repaired
+    return repaired
+
+
 async def get_friends_likes(tg_id: int, limit: int = 20):
     """Получает лайки друзей для рекомендаций (только не скрытые)"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return []
 
         # Получаем все рекомендации (только не скрытые оценки)
-        rows = await conn.fetch("""
-            SELECT DISTINCT 
-                r.tmdb_id, 
-                r.type, 
-                r.title,
-                COUNT(r.liked) as friend_likes_count,
-                u.tg_id as friend_tg_id,
-                u.username as friend_username
-            FROM user_friends uf
-            JOIN ratings r ON uf.friend_user_id = r.user_id
-            JOIN users u ON r.user_id = u.user_id
-            LEFT JOIN ratings user_ratings ON 
-                user_ratings.user_id = $1 AND 
-                user_ratings.tmdb_id = r.tmdb_id AND 
-                user_ratings.type = r.type
-            WHERE 
-                uf.user_id = $1 AND 
-                r.liked = TRUE AND 
-                r.watched = TRUE AND
-                r.is_hidden = FALSE AND  -- ТОЛЬКО НЕ СКРЫТЫЕ ОЦЕНКИ
-                (user_ratings.watched IS NULL OR user_ratings.watched = FALSE)
-            GROUP BY r.tmdb_id, r.type, r.title, u.tg_id, u.username
-            ORDER BY friend_likes_count DESC
-            LIMIT $2
-        """, user["user_id"], limit)
-
-        # Фильтруем забаненный контент
-        filtered_rows = []
-        for row in rows:
-            if not await is_banned(row['tmdb_id'], row['type']):
-                filtered_rows.append(row)
+        rows = await conn.fetch(SQL_GET_FRIENDS_LIKES, user_id, limit)
+
+    # Фильтруем забаненный контент
+    return await filter_banned(rows, id_key="tmdb_id", type_key="type")
+
 
-        return filtered_rows
+async def get_friend_signal(tg_id: int, tmdb_id: int, type_: str):
+    """Сколько и какие друзья лайкнули тайтл (None — никто)"""
+    async with db.acquire() as conn:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
+            return None
+        return await conn.fetchrow(SQL_GET_FRIEND_SIGNAL, user_id, tmdb_id, type_)
 
 
-async def add_rating(user_id, tmdb_id, type_, liked=None, disliked=None, watched=None, is_hidden=None, title=None):
+async def add_rating(tg_id, tmdb_id, type_, liked=None, disliked=None, watched=None, is_hidden=None, title=None):
+    """Сохраняет оценку одним UPSERT: непереданные (None) поля остаются как есть.
+    Возвращает итоговую строку оценки или None при ошибке"""
     try:
         async with db.acquire() as conn:
-            # Сначала получаем текущие значения
-            current = await conn.fetchrow(
-                "SELECT liked, disliked, watched, is_hidden FROM ratings WHERE user_id = (SELECT user_id FROM users WHERE tg_id = $1) AND tmdb_id = $2 AND type = $3",
-                user_id, tmdb_id, type_
-            )
-
-            # Если запись существует, обновляем только переданные поля
-            if current:
-                # Сохраняем текущие значения для полей, которые не переданы
-                update_liked = liked if liked is not None else current['liked']
-                update_disliked = disliked if disliked is not None else current['disliked']
-                update_watched = watched if watched is not None else current['watched']
-                update_hidden = is_hidden if is_hidden is not None else current['is_hidden']
-
-                await conn.execute(
-                    "UPDATE ratings SET liked = $1, disliked = $2, watched = $3, is_hidden = $4, title = $5 WHERE user_id = (SELECT user_id FROM users WHERE tg_id = $6) AND tmdb_id = $7 AND type = $8",
-                    update_liked, update_disliked, update_watched, update_hidden, title, user_id, tmdb_id, type_
-                )
-            else:
-                # Создаем новую запись
-                await conn.execute(
-                    "INSERT INTO ratings (user_id, tmdb_id, type, liked, disliked, watched, is_hidden, title) VALUES ((SELECT user_id FROM users WHERE tg_id = $1), $2, $3, $4, $5, $6, $7, $8)",
-                    user_id, tmdb_id, type_,
-                    liked or False,
-                    disliked or False,
-                    watched or False,
-                    is_hidden or False,
-                    title
-                )
-            return True
+            user_id = await get_user_id(conn, tg_id)
+            if user_id is None:
+                return None
+            row = await conn.fetchrow("""
+                INSERT INTO ratings AS r (user_id, tmdb_id, type, liked, disliked, watched, is_hidden, title)
+                VALUES ($1, $2, $3,
+                        COALESCE($4, FALSE), COALESCE($5, FALSE), COALESCE($6, FALSE), COALESCE($7, FALSE), $8)
+                ON CONFLICT (user_id, tmdb_id, type) DO UPDATE SET
+                    liked = COALESCE($4, r.liked),
+                    disliked = COALESCE($5, r.disliked),
+                    watched = COALESCE($6, r.watched),
+                    is_hidden = COALESCE($7, r.is_hidden),
+                    title = COALESCE($8, r.title)
+                RETURNING liked, disliked, watched, is_hidden
+            """, user_id, tmdb_id, type_, liked, disliked, watched, is_hidden, title)
+        remember_watched(tg_id, tmdb_id, type_, row["watched"])
+        cf_apply(user_id, (tmdb_id, type_), cf_weight(row["liked"], row["disliked"], row["watched"]), title)
+        return dict(row)
     except Exception as e:
         print(f"Error in add_rating: {e}")
-        return False
+        return None
+
+
+SQL_GET_RATINGS = """
+                  SELECT likes, dislikes, watches
+                  FROM title_stats
+                  WHERE tmdb_id = $1
+                    AND type = $2
+                  """
 
 
 async def get_ratings(tmdb_id: int, type_: str):
     async with db.acquire() as conn:
-        row = await conn.fetchrow("""
-                                  SELECT COUNT(CASE WHEN liked = TRUE THEN 1 END)    as likes,
-                                         COUNT(CASE WHEN disliked = TRUE THEN 1 END) as dislikes,
-                                         COUNT(CASE WHEN watched = TRUE THEN 1 END)  as watches
-                                  FROM ratings
-                                  WHERE tmdb_id = $1
-                                    AND type = $2
-                                  """, tmdb_id, type_)
+        row = await conn.fetchrow(SQL_GET_RATINGS, tmdb_id, type_)
         if row:
             return {
                 "likes": row["likes"] or 0,
@@ -458,25 +805,205 @@ async def get_ratings(tmdb_id: int, type_: str):
             }
         return {"likes": 0, "dislikes": 0, "watches": 0}
 
+
+title_stats_reconcile = {"runs": 0, "repaired": 0}
+
+
+async def claim_maintenance(conn, job: str, interval: int | None) -> bool:
+    """Закрепляет фоновую задачу за этим процессом; вызывается в транзакции задачи.
+    False — задачу прямо сейчас выполняет другой процесс или она уже выполнялась
+    за последние interval секунд (interval=None — выполнялась хоть раз)"""
+    if not await conn.fetchval("SELECT pg_try_advisory_xact_lock(hashtext($1))", f"maintenance:{job}"):
+        return False
+    claimed = await conn.fetchval("""
+        INSERT INTO maintenance_runs AS m (job, ran_at) VALUES ($1, NOW())
+        ON CONFLICT (job) DO UPDATE SET ran_at = NOW()
+        WHERE $2::int IS NOT NULL AND m.ran_at < NOW() - make_interval(secs => $2)
+        RETURNING TRUE
+    """, job, interval)
+    return bool(claimed)
+
+
+async def reconcile_title_stats(interval: int | None) -> int | None:
+    """Пересчитывает title_stats по таблице ratings, возвращает число исправленных строк.
+    None — пересчет не понадобился: см. claim_maintenance"""
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            if not await claim_maintenance(conn, "title_stats", interval):
+                return None
+            # Блокируем запись в ratings на время пересчета, иначе триггер и сверка могут разойтись
+            await conn.execute("LOCK TABLE ratings IN SHARE MODE")
+            upserted = await conn.execute("""
+                INSERT INTO title_stats AS s (tmdb_id, type, likes, dislikes, watches)
+                SELECT tmdb_id, type,
+                       COUNT(*) FILTER (WHERE liked),
+                       COUNT(*) FILTER (WHERE disliked),
+                       COUNT(*) FILTER (WHERE watched)
+                FROM ratings
+                GROUP BY tmdb_id, type
+                ON CONFLICT (tmdb_id, type) DO UPDATE SET
+                    likes = EXCLUDED.likes,
+                    dislikes = EXCLUDED.dislikes,
+                    watches = EXCLUDED.watches
+                WHERE (s.likes, s.dislikes, s.watches)
+                      IS DISTINCT FROM (EXCLUDED.likes, EXCLUDED.dislikes, EXCLUDED.watches)
+            """)
+            deleted = await conn.execute("""
+                DELETE FROM title_stats s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM ratings r WHERE r.tmdb_id = s.tmdb_id AND r.type = s.type
+                )
+            """)
+    # Статус вида "INSERT 0 3" / "DELETE 2"
+    repaired = int(upserted.split()[-1]) + int(deleted.split()[-1])
+    title_stats_reconcile["runs"] += 1
+    title_stats_reconcile["repaired"] += repaired
+    return repaired
+
+
+async def title_stats_reconcile_loop():
+    """Периодически сверяет счетчики title_stats и friend_signals"""
+    while True:
+        await asyncio.sleep(TITLE_STATS_RECONCILE_INTERVAL)
+        try:
+            # Половина интервала: процессы просыпаются вразнобой, но сверяет один из них раз за цикл
+            repaired = await reconcile_title_stats(TITLE_STATS_RECONCILE_INTERVAL // 2)
+            if repaired:
+                print(f"title_stats: исправлено строк: {repaired}")
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Ошибка сверки title_stats: {e}")
+        try:
+            repaired = await reconcile_friend_signals(TITLE_STATS_RECONCILE_INTERVAL // 2)
+            if repaired:
+                print(f"friend_signals: исправлено строк: {repaired}")
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Ошибка сверки friend_signals: {e}")
+
+# Бан-лист держим в памяти: загружается при старте, изменения из других процессов
+# приходят через LISTEN/NOTIFY. Пока зеркало не готово, is_banned ходит в базу.
+BANNED_CHANNEL = "banned_content_changed"
+banned_items: set[tuple[int, str]] = set()
+banned_ready = False
+banned_loading = False
+banned_pending: list[tuple[str, tuple[int, str]]] = []  # Уведомления, пришедшие во время загрузки
+banned_listener: asyncpg.Connection | None = None
+banned_reconnect: asyncio.Task | None = None  # Храним ссылку: event loop держит задачи только слабо
+banned_closing = False
+
+def apply_banned_change(op: str, key: tuple[int, str]):
+    """Применяет изменение бан-листа к зеркалу в памяти"""
+    if op == "ban":
+        banned_items.add(key)
+    else:
+        banned_items.discard(key)
+
+def on_banned_notify(conn, pid, channel, payload):
+    """Обрабатывает уведомление об изменении бан-листа"""
+    try:
+        data = json.loads(payload)
+        op, key = data["op"], (int(data["tmdb_id"]), data["type"])
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Некорректное уведомление бан-листа {payload!r}: {e}")
+        return
+    if banned_loading:
+        banned_pending.append((op, key))
+    apply_banned_change(op, key)
+
+def on_banned_listener_lost(conn):
+    """Соединение слушателя потеряно: переходим на запросы к базе и переподключаемся"""
+    global banned_ready, banned_listener, banned_reconnect
+    banned_ready = False
+    banned_listener = None
+    if not banned_closing and (banned_reconnect is None or banned_reconnect.done()):
+        banned_reconnect = asyncio.get_running_loop().create_task(start_banned_listener())
+
+async def load_banned_items():
+    """Загружает бан-лист целиком в память"""
+    global banned_items, banned_ready, banned_loading
+    banned_loading = True
+    banned_pending.clear()
+    try:
+        async with db.acquire() as conn:
+            rows = await conn.fetch("SELECT tmdb_id, type FROM banned_content")
+        banned_items = {(row["tmdb_id"], row["type"]) for row in rows}
+        # Уведомления, пришедшие пока шел запрос, могли не попасть в снимок
+        for op, key in banned_pending:
+            apply_banned_change(op, key)
+        banned_ready = True
+    finally:
+        banned_loading = False
+        banned_pending.clear()
+
+async def start_banned_listener(retry_delay: float = 5):
+    """Подписывается на изменения бан-листа и загружает его в память"""
+    global banned_listener
+    while not banned_closing:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener(BANNED_CHANNEL, on_banned_notify)
+            conn.add_termination_listener(on_banned_listener_lost)
+            banned_listener = conn
+            # Загружаем после подписки, чтобы не пропустить изменения между ними
+            await load_banned_items()
+            return
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Ошибка подписки на бан-лист: {e}")
+            if conn is not None and not conn.is_closed():
+                conn.remove_termination_listener(on_banned_listener_lost)
+                await conn.close()
+            banned_listener = None
+            await asyncio.sleep(retry_delay)
+
+async def stop_banned_listener():
+    """Закрывает соединение слушателя бан-листа"""
+    global banned_closing, banned_listener, banned_ready, banned_reconnect
+    banned_closing = True
+    banned_ready = False
+    if banned_reconnect is not None:
+        banned_reconnect.cancel()
+        try:
+            await banned_reconnect
+        except asyncio.CancelledError:
+            pass
+        banned_reconnect = None
+    if banned_listener is not None and not banned_listener.is_closed():
+        banned_listener.remove_termination_listener(on_banned_listener_lost)
+        await banned_listener.close()
+    banned_listener = None
+
+async def notify_banned_change(conn, op: str, tmdb_id: int, type_: str):
+    """Оповещает все процессы об изменении бан-листа (доставляется после коммита)"""
+    payload = json.dumps({"op": op, "tmdb_id": tmdb_id, "type": type_})
+    await conn.execute("SELECT pg_notify($1, $2)", BANNED_CHANNEL, payload)
+
 async def ban_content(tmdb_id: int, type_: str, title: str, banned_by: int, reason: str = None):
     """Добавляет контент в бан-лист"""
     async with db.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO banned_content (tmdb_id, type, title, banned_by, reason)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (tmdb_id, type) DO NOTHING
-        """, tmdb_id, type_, title, banned_by, reason)
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO banned_content (tmdb_id, type, title, banned_by, reason)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (tmdb_id, type) DO NOTHING
+            """, tmdb_id, type_, title, banned_by, reason)
+            await notify_banned_change(conn, "ban", tmdb_id, type_)
+    apply_banned_change("ban", (tmdb_id, type_))
 
 async def unban_content(tmdb_id: int, type_: str):
     """Убирает контент из бан-листа"""
     async with db.acquire() as conn:
-        await conn.execute("""
-            DELETE FROM banned_content 
-            WHERE tmdb_id = $1 AND type = $2
-        """, tmdb_id, type_)
+        async with conn.transaction():
+            await conn.execute("""
+                DELETE FROM banned_content 
+                WHERE tmdb_id = $1 AND type = $2
+            """, tmdb_id, type_)
+            await notify_banned_change(conn, "unban", tmdb_id, type_)
+    apply_banned_change("unban", (tmdb_id, type_))
 
 async def is_banned(tmdb_id: int, type_: str) -> bool:
     """Проверяет, забанен ли контент"""
+    if banned_ready:
+        return (tmdb_id, type_) in banned_items
     async with db.acquire() as conn:
         row = await conn.fetchrow("""
             SELECT 1 FROM banned_content 
@@ -484,6 +1011,37 @@ async def is_banned(tmdb_id: int, type_: str) -> bool:
         """, tmdb_id, type_)
         return bool(row)
 
+async def banned_keys(keys) -> set[tuple[int, str]]:
+    """Возвращает забаненные пары (tmdb_id, type) из переданных — одним запросом"""
+    keys = {(int(tmdb_id), type_) for tmdb_id, type_ in keys}
+    if not keys:
+        return set()
+    if banned_ready:
+        return keys & banned_items
+    ids, types = zip(*keys)
+    async with db.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT b.tmdb_id, b.type
+            FROM banned_content b
+            JOIN unnest($1::int[], $2::text[]) AS k(tmdb_id, type)
+              ON b.tmdb_id = k.tmdb_id AND b.type = k.type
+        """, list(ids), list(types))
+    return {(row["tmdb_id"], row["type"]) for row in rows}
+
+async def filter_banned(items: list, type_: str = None, id_key: str = "id", type_key: str = "media_type") -> list:
+    """Убирает забаненный контент из списка. Тип берется из type_ или из поля type_key;
+    элементы другого типа (например, person) не проверяются"""
+    def key(item):
+        media_type = type_ or item.get(type_key)
+        if media_type in ("movie", "tv"):
+            return item[id_key], media_type
+        return None
+
+    banned = await banned_keys(k for k in map(key, items) if k is not None)
+    if not banned:
+        return list(items)
+    return [item for item in items if key(item) not in banned]
+
 async def get_banned_list(limit: int = 50):
     """Возвращает список забаненного контента"""
     async with db.acquire() as conn:
@@ -493,232 +1051,1615 @@ async def get_banned_list(limit: int = 50):
             LIMIT $1
         """, limit)
 
-# -------------------- TMDB --------------------
-def tmdb_get(url: str, params: dict):
-    headers = {"accept": "application/json", "Authorization": f"Bearer {TMDB_TOKEN}"}
-    return requests.get(url, headers=headers, params=params, timeout=10)
-
-
-async def discover_tmdb(type_: str, genre_id: int | None = None, vote_count_min: int = 50, filters: dict = None):
-    base_url = f"https://api.themoviedb.org/3/discover/{type_}"
-    common = {
-        "language": "ru-RU",
-        "sort_by": random.choice(["popularity.desc", "vote_average.desc", "primary_release_date.desc"]),
-        "vote_count.gte": vote_count_min,
-        "page": 1,  # Сначала получаем первую страницу чтобы узнать total_pages
-        "include_adult": "false",
-    }
+# -------------------- INDEX ADVISOR --------------------
+# Горячие запросы: (название, SQL, пример параметров). EXPLAIN выполняется с
+# enable_seqscan = off — если планировщик все равно сканирует таблицу целиком,
+# подходящего индекса нет, и это регрессия
+def hot_queries() -> tuple:
+    """Список горячих запросов (SQL объявлен рядом с функциями, которые его выполняют)"""
+    return (
+        ("get_ratings", SQL_GET_RATINGS, (0, "movie")),
+        ("get_user_rating", SQL_GET_USER_RATING, (0, 0, "movie")),
+        ("get_collection", SQL_GET_COLLECTION, (0, 4, 0)),
+        ("is_in_user_collection", SQL_IN_COLLECTION, (0, 0, "movie")),
+        ("load_watched", SQL_GET_WATCHED_IDS, (0,)),
+        ("get_friends_likes", SQL_GET_FRIENDS_LIKES, (0, 20)),
+        ("get_friend_signal", SQL_GET_FRIEND_SIGNAL, (0, 0, "movie")),
+        ("get_pending_friend_requests", SQL_PENDING_REQUESTS, (0,)),
+    )
 
-    if genre_id:
-        common["with_genres"] = genre_id
-
-    # Применяем дополнительные фильтры
-    if filters:
-        if filters.get('start_year') and filters.get('end_year'):
-            start_year = filters['start_year']
-            end_year = filters['end_year']
-            if type_ == "movie":
-                common["primary_release_date.gte"] = f"{start_year}-01-01"
-                common["primary_release_date.lte"] = f"{end_year}-12-31"
-            else:
-                common["first_air_date.gte"] = f"{start_year}-01-01"
-                common["first_air_date.lte"] = f"{end_year}-12-31"
 
-        if filters.get('country'):
-            common["with_origin_country"] = filters['country']
+def walk_plan(node: dict):
+    """Обходит узлы плана EXPLAIN (FORMAT JSON)"""
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk_plan(child)
 
-        if filters.get('rating'):
-            common["vote_average.gte"] = filters['rating']
 
-    # 🔴 ИСПРАВЛЕНИЕ: Сначала получаем total_pages
-    r1 = tmdb_get(base_url, common)
-    if r1.status_code != 200:
-        return []
+async def explain_hot_queries() -> list[dict]:
+    """Строит планы горячих запросов и ищет в них последовательные сканирования"""
+    report = []
+    async with db.acquire() as conn:
+        for name, sql, args in hot_queries():
+            try:
+                async with conn.transaction():
+                    await conn.execute("SET LOCAL enable_seqscan = off")
+                    plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+            except asyncpg.PostgresError as e:
+                report.append({"name": name, "error": str(e)})
+                continue
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            nodes = list(walk_plan(plan[0]["Plan"]))
+            report.append({
+                "name": name,
+                "seq_scans": sorted({n["Relation Name"] for n in nodes if n["Node Type"] == "Seq Scan"}),
+                "indexes": sorted({n["Index Name"] for n in nodes if "Index Name" in n}),
+            })
+    return report
+
+
+def format_explain_report(report: list[dict]) -> str:
+    """Текст отчета по индексам для админа"""
+    lines = ["🔎 Планы горячих запросов\n"]
+    for entry in report:
+        if "error" in entry:
+            lines.append(f"❌ <b>{entry['name']}</b>: {entry['error']}")
+        elif entry["seq_scans"]:
+            lines.append(f"⚠️ <b>{entry['name']}</b>: Seq Scan по {', '.join(entry['seq_scans'])}")
+        else:
+            lines.append(f"✅ <b>{entry['name']}</b>: {', '.join(entry['indexes']) or 'без индексов'}")
+    return "\n".join(lines)
+
+
+# -------------------- CACHE --------------------
+class TTLCache:
+    """LRU-кэш с временем жизни записей, опциональным вторым уровнем на диске (SQLite) и счетчиками.
+    Чтение с диска и запись на него идут в отдельном потоке, запись — пачками раз в flush_interval"""
+
+    def __init__(self, name: str, maxsize: int, ttl: int, disk_path: str | None = None,
+                 flush_interval: float = TMDB_CACHE_FLUSH_INTERVAL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flush_interval = flush_interval
+        self._disk = None
+        self._disk_lock = asyncio.Lock()  # соединение SQLite используется одним потоком за раз
+        self._pending: dict[str, tuple[float, str]] = {}  # записи, еще не сброшенные на диск
+        self._flush_task: asyncio.Task | None = None
+        if disk_path:
+            try:
+                # Открывается при импорте, до запуска event loop; дальше работа только через asyncio.to_thread
+                self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+                self._disk.execute(
+                    "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+                )
+                self._disk.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+                self._disk.commit()
+            except sqlite3.Error as e:
+                print(f"Disk cache {name} disabled: {e}")
+                self._disk = None
+
+    async def get(self, key):
+        now = time.time()
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._data[key]
+            self.expirations += 1
+
+        if self._disk is not None:
+            disk_key = json.dumps(key)
+            row = self._pending.get(disk_key)
+            if row is None:
+                try:
+                    async with self._disk_lock:
+                        row = await asyncio.to_thread(self._read_disk, disk_key)
+                except sqlite3.Error as e:
+                    print(f"Disk cache {self.name} read error: {e}")
+                    row = None
+            if row and row[0] > now:
+                value = json.loads(row[1])
+                self._store(key, value, row[0])
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
 
-    data1 = r1.json()
-    results = data1.get("results", [])
-    total_pages = min(data1.get("total_pages", 1), 500)  # Ограничиваем 500 страницами
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._store(key, value, expires_at)
+        if self._disk is not None:
+            self._pending[json.dumps(key)] = (expires_at, json.dumps(value, ensure_ascii=False))
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _read_disk(self, disk_key: str):
+        return self._disk.execute(
+            "SELECT expires_at, value FROM cache WHERE key = ?", (disk_key,)
+        ).fetchone()
+
+    def _write_disk(self, rows: list[tuple[str, float, str]]):
+        with self._disk:  # одна транзакция и один commit на пачку
+            self._disk.executemany(
+                "INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)", rows
+            )
 
-    # 🟢 ТЕПЕРЬ выбираем случайную страницу
-    if total_pages > 1:
-        random_page = random.randint(1, total_pages)
-        if random_page != 1:
-            common["page"] = random_page
-            r2 = tmdb_get(base_url, common)
-            if r2.status_code == 200:
-                results = r2.json().get("results", [])
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
 
-    # Если ничего не нашли, пробуем снизить порог голосов
-    if not results and vote_count_min > 10:
-        return await discover_tmdb(type_, genre_id=genre_id, vote_count_min=10, filters=filters)
+    async def flush(self):
+        """Сбрасывает накопленные записи на диск одной транзакцией"""
+        if self._disk is None or not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        rows = [(disk_key, expires_at, value) for disk_key, (expires_at, value) in batch.items()]
+        try:
+            async with self._disk_lock:
+                await asyncio.to_thread(self._write_disk, rows)
+        except sqlite3.Error as e:
+            print(f"Disk cache {self.name} write error: {e}")
+
+    async def close(self):
+        """Дописывает отложенные записи и закрывает файл кэша (при остановке бота)"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        if self._disk is not None:
+            async with self._disk_lock:
+                await asyncio.to_thread(self._disk.close)
+            self._disk = None
+
+    def _store(self, key, value, expires_at: float):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
 
-    # Фильтруем забаненный контент
-    async def filter_banned_items(items):
-        filtered_items = []
-        for item in items:
-            if not await is_banned(item["id"], type_):
-                filtered_items.append(item)
-        return filtered_items
 
-    results = await filter_banned_items(results)
-    return results
+details_cache = TTLCache("tmdb_details", TMDB_CACHE_SIZE, TMDB_CACHE_TTL, TMDB_CACHE_PATH)
+
+
+def deep_sizeof(obj, seen: set | None = None) -> int:
+    """Приблизительный размер объекта в памяти вместе с вложенными объектами"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if hasattr(obj, "items"):  # dict и asyncpg.Record
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += deep_sizeof(value, seen)
+    return size
+
+
+class SessionStore:
+    """Сессии чатов: TTL с последнего обращения, общий бюджет памяти с LRU-вытеснением
+    и учет размера каждой сессии. Повторяет интерфейс dict, которым пользуются обработчики"""
+
+    def __init__(self, name: str, ttl: int, max_bytes: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data: OrderedDict[int, dict] = OrderedDict()
+        self._expires: dict[int, float] = {}
+        self._sizes: dict[int, int] = {}
+        self._dirty: set[int] = set()  # Сессии, которые могли измениться по ссылке с прошлого пересчета
+        self._pinned: set[int] = set()  # Чаты, чей апдейт сейчас обрабатывается: их не вытесняем
+        self._total = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _alive(self, chat_id: int) -> bool:
+        expires = self._expires.get(chat_id)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            self._drop(chat_id)
+            self.expirations += 1
+            return False
+        return True
 
+    def _touch(self, chat_id: int):
+        self._data.move_to_end(chat_id)
+        self._expires[chat_id] = time.monotonic() + self.ttl
+        self._dirty.add(chat_id)
+
+    def _drop(self, chat_id: int):
+        self._data.pop(chat_id, None)
+        self._expires.pop(chat_id, None)
+        self._dirty.discard(chat_id)
+        self._total -= self._sizes.pop(chat_id, 0)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self._alive(chat_id)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __getitem__(self, chat_id: int) -> dict:
+        if not self._alive(chat_id):
+            raise KeyError(chat_id)
+        self._touch(chat_id)
+        return self._data[chat_id]
+
+    def __setitem__(self, chat_id: int, session: dict):
+        self._data[chat_id] = session
+        self._touch(chat_id)
+        self.enforce()
+
+    def get(self, chat_id: int, default=None):
+        if not self._alive(chat_id):
+            return default
+        self._touch(chat_id)
+        return self._data[chat_id]
+
+    def setdefault(self, chat_id: int, default: dict) -> dict:
+        if not self._alive(chat_id):
+            self[chat_id] = default
+        return self[chat_id]
+
+    def pop(self, chat_id: int, default=None):
+        if not self._alive(chat_id):
+            return default
+        session = self._data[chat_id]
+        self._drop(chat_id)
+        return session
+
+    def pin(self, chat_id: int):
+        self._pinned.add(chat_id)
+
+    def unpin(self, chat_id: int):
+        self._pinned.discard(chat_id)
+
+    def enforce(self):
+        """Пересчитывает размер измененных сессий и вытесняет самые старые сверх бюджета"""
+        for chat_id in self._dirty:
+            size = deep_sizeof(self._data[chat_id])
+            self._total += size - self._sizes.get(chat_id, 0)
+            self._sizes[chat_id] = size
+        self._dirty.clear()
+        # Самую свежую сессию не трогаем, даже если она одна больше бюджета
+        while self._total > self.max_bytes and len(self._data) > 1:
+            victim = next(
+                (chat_id for chat_id in itertools.islice(self._data, len(self._data) - 1)
+                 if chat_id not in self._pinned),
+                None
+            )
+            if victim is None:
+                break
+            self._drop(victim)
+            self.evictions += 1
+
+    def sweep(self) -> int:
+        """Удаляет истекшие сессии и применяет бюджет, возвращает число удаленных"""
+        now = time.monotonic()
+        expired = [
+            chat_id for chat_id, expires in self._expires.items()
+            if expires < now and chat_id not in self._pinned
+        ]
+        for chat_id in expired:
+            self._drop(chat_id)
+        self.expirations += len(expired)
+        self.enforce()
+        return len(expired)
+
+    def stats(self) -> dict:
+        self.enforce()
+        fields: dict[str, int] = {}
+        for session in self._data.values():
+            for key, value in session.items():
+                fields[key] = fields.get(key, 0) + deep_sizeof(value)
+        return {
+            "size": len(self._data),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "fields": sorted(fields.items(), key=lambda kv: kv[1], reverse=True),
+        }
 
-def get_item_details(type_: str, tmdb_id: int):
-    url = f"https://api.themoviedb.org/3/{type_}/{tmdb_id}"
-    r = tmdb_get(url, {"language": "ru-RU"})
-    if r.status_code == 200:
-        return r.json()
-    return {}
-
-
-def get_trailer_url(type_, tmdb_id):
-    url = f"https://api.themoviedb.org/3/{type_}/{tmdb_id}/videos"
-    r = tmdb_get(url, {"language": "ru-RU"})
-    if r.status_code == 200:
-        for v in r.json().get("results", []):
-            if v.get("type") == "Trailer" and v.get("site") == "YouTube":
-                return f"https://www.youtube.com/watch?v={v.get('key')}"
-    return None
 
+user_sessions = SessionStore("sessions", SESSION_TTL, SESSION_MEMORY_MB * 1024 * 1024)
+# Кэш настроек из users; обновляется вместе с базой в update_user_filter
+user_filters = SessionStore("prefs", SESSION_TTL, PREFS_MEMORY_MB * 1024 * 1024)
+# Просмотренное пользователей (load_watched); обновляется в add_rating
+watched_sets = SessionStore("watched", SESSION_TTL, WATCHED_MEMORY_MB * 1024 * 1024)
 
-def get_trending(media_type: str, time_window: str = "week"):
-    """Получает трендовые фильмы/сериалы за неделю"""
-    url = f"https://api.themoviedb.org/3/trending/{media_type}/{time_window}"
-    r = tmdb_get(url, {"language": "ru-RU"})
-    if r.status_code == 200:
-        return r.json().get("results", [])
-    return []
 
+async def session_sweep_loop():
+    """Периодически чистит истекшие сессии"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        user_sessions.sweep()
+        user_filters.sweep()
+        watched_sets.sweep()
+        sweep_card_prefetch()
+        try:
+            await session_backend.expire(SESSION_TTL)
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Ошибка очистки сессий: {e}")
+
+
+# -------------------- SESSION BACKEND --------------------
+# Состояние чата (сессия, ожидание ввода, фильтры) между апдейтами. По умолчанию живет
+# только в памяти процесса; с SESSION_BACKEND=postgres загружается перед каждым апдейтом
+# и сохраняется после него, так что несколько процессов и перезапуски видят одно и то же.
+# Запись условная (по номеру версии): если за время апдейта состояние чата сохранил другой
+# процесс, изменения этого апдейта отбрасываются, а не затирают чужие
+def pack_state(obj):
+    """Приводит состояние к JSON-совместимому виду, помечая типы, которых нет в JSON"""
+    if isinstance(obj, (dict, asyncpg.Record)):
+        if all(isinstance(key, str) for key in obj.keys()):
+            return {key: pack_state(value) for key, value in obj.items()}
+        return {"__map__": [[pack_state(key), pack_state(value)] for key, value in obj.items()]}
+    if isinstance(obj, MediaRef):
+        return {"__ref__": [obj.id, obj.media_type, obj.title, obj.year, list(obj.roles)]}
+    if isinstance(obj, (set, frozenset)):
+        values = [pack_state(value) for value in obj]
+        try:
+            values.sort()  # Стабильный порядок, чтобы неизмененное состояние давало те же байты
+        except TypeError:
+            pass
+        return {"__set__": values}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [pack_state(value) for value in obj]}
+    if isinstance(obj, list):
+        return [pack_state(value) for value in obj]
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, datetime):
+        return {"__dt__": obj.isoformat()}
+    return obj
+
+
+def unpack_state(obj):
+    """Обратное преобразование для pack_state"""
+    if isinstance(obj, list):
+        return [unpack_state(value) for value in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if len(obj) == 1:
+        (tag, value), = obj.items()
+        if tag == "__set__":
+            return {unpack_state(v) for v in value}
+        if tag == "__tuple__":
+            return tuple(unpack_state(v) for v in value)
+        if tag == "__map__":
+            return {unpack_state(k): unpack_state(v) for k, v in value}
+        if tag == "__dt__":
+            return datetime.fromisoformat(value)
+        if tag == "__ref__":
+            return MediaRef(*value[:4], tuple(value[4]))
+    return {key: unpack_state(value) for key, value in obj.items()}
+
+
+def dump_chat_state(chat_id: int) -> bytes | None:
+    """Сериализует состояние чата в сжатый компактный JSON (None — состояния нет)"""
+    state = {
+        "session": user_sessions.get(chat_id),
+        "waiting": user_input_waiting.get(chat_id),
+        "filters": user_filters.get(chat_id),
+    }
+    state = {key: value for key, value in state.items() if value is not None}
+    if not state:
+        return None
+    raw = json.dumps(pack_state(state), ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(raw.encode("utf-8"))
 
-def is_anime_by_details(type_: str, details: dict, item: dict) -> bool:
-    genre_ids = [g.get("id") for g in details.get("genres", []) if g.get("id")] or item.get("genre_ids", [])
-    if 16 not in genre_ids:
-        return False
-    prod_countries = [c.get("iso_3166_1") for c in details.get("production_countries", []) if c.get("iso_3166_1")]
-    origin_country = details.get("origin_country", []) or []
-    codes = set(prod_countries + origin_country)
-    return "JP" in codes
 
+def restore_chat_state(chat_id: int, blob: bytes | None):
+    """Заменяет локальное состояние чата сохраненным"""
+    state = unpack_state(json.loads(zlib.decompress(blob))) if blob else {}
+    for key, store in (("session", user_sessions), ("waiting", user_input_waiting), ("filters", user_filters)):
+        if key in state:
+            store[chat_id] = state[key]
+        else:
+            store.pop(chat_id, None)
 
-def is_cartoons_by_details(type_: str, details: dict, item: dict) -> bool:
-    genre_ids = [g.get("id") for g in details.get("genres", []) if g.get("id")] or item.get("genre_ids", [])
-    return 16 in genre_ids
 
+class SessionBackend:
+    """Хранилище состояния чатов вне процесса. Базовый вариант — ничего не хранит (все в памяти)"""
+    shared = False
 
-# -------------------- KEYBOARDS --------------------
-def kb_main():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Поиск", callback_data="search_menu")],
-        [InlineKeyboardButton(text="⚡ Фильтры поиска", callback_data="search_filters")],
-        [InlineKeyboardButton(text="👥 Друзья", callback_data="friends_menu")],  # Новая кнопка
-        [InlineKeyboardButton(text="📚 Коллекция", callback_data="show_collection")],
-        [InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings")],
-    ])
+    def __init__(self):
+        self.conflicts = 0
 
+    async def setup(self):
+        pass
 
-def kb_search_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎲 Случайный поиск", callback_data="random_search")],
-        [InlineKeyboardButton(text="🔍 Поиск по названию", callback_data="search_by_title")],
-        [InlineKeyboardButton(text="🎭 Поиск по актеру", callback_data="search_by_person")],
-        [InlineKeyboardButton(text="🎯 На основе предпочтений", callback_data="preferences")],
-        [InlineKeyboardButton(text="🔥 В тренде сейчас", callback_data="trending_menu")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")],
-    ])
+    async def load(self, chat_id: int) -> tuple[bytes | None, int | None]:
+        """Состояние чата и версия записи (None — записи нет)"""
+        return None, None
 
+    async def save(self, chat_id: int, blob: bytes | None, version: int | None) -> bool:
+        """Сохраняет состояние, если версия записи не изменилась после load; False — конфликт"""
+        return True
 
-def kb_random_search():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎬 Случайный фильм", callback_data="discover_movie")],
-        [InlineKeyboardButton(text="📺 Случайный сериал", callback_data="discover_tv")],
-        [InlineKeyboardButton(text="🧭 Случайный поиск по жанрам", callback_data="search_genre")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")],
-    ])
+    async def expire(self, ttl: int):
+        pass
 
 
-def kb_settings(filters):
-    anime_status = "✅" if filters.get("exclude_anime") else "❌"
-    cartoons_status = "✅" if filters.get("exclude_cartoons") else "❌"
-    watched_status = "✅" if filters.get("exclude_watched") else "❌"
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"{anime_status} Скрывать аниме", callback_data="toggle_anime")],
-        [InlineKeyboardButton(text=f"{cartoons_status} Скрывать мультфильмы", callback_data="toggle_cartoons")],
-        [InlineKeyboardButton(text=f"{watched_status} Скрывать просмотренное", callback_data="toggle_watched")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")],
-    ])
+class PostgresSessionBackend(SessionBackend):
+    """Состояние чатов в таблице bot_sessions (сжатый JSON в BYTEA)"""
+    shared = True
 
-def kb_admin_panel():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Поиск для бана", callback_data="admin_search_ban")],
-        [InlineKeyboardButton(text="📋 Список банов", callback_data="admin_ban_list")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-    ])
+    def __init__(self, ttl: int):
+        super().__init__()
+        self.ttl = ttl
 
+    async def setup(self):
+        async with db.acquire() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS bot_sessions (
+                    chat_id BIGINT PRIMARY KEY,
+                    data BYTEA NOT NULL,
+                    version BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT NOW()
+                );
+                ALTER TABLE bot_sessions ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS idx_bot_sessions_updated ON bot_sessions (updated_at);
+            """)
+
+    async def load(self, chat_id: int) -> tuple[bytes | None, int | None]:
+        async with db.acquire() as conn:
+            # Истекшая запись читается как пустое состояние, но ее версия нужна для условной записи
+            row = await conn.fetchrow("""
+                SELECT CASE WHEN updated_at > NOW() - make_interval(secs => $2) THEN data END AS data, version
+                FROM bot_sessions WHERE chat_id = $1
+            """, chat_id, self.ttl)
+        if row is None:
+            return None, None
+        return row["data"], row["version"]
+
+    async def save(self, chat_id: int, blob: bytes | None, version: int | None) -> bool:
+        async with db.acquire() as conn:
+            if version is None:
+                if blob is None:
+                    return True
+                status = await conn.execute("""
+                    INSERT INTO bot_sessions (chat_id, data, version, updated_at)
+                    VALUES ($1, $2, 0, NOW())
+                    ON CONFLICT (chat_id) DO NOTHING
+                """, chat_id, blob)
+            elif blob is None:
+                status = await conn.execute(
+                    "DELETE FROM bot_sessions WHERE chat_id = $1 AND version = $2", chat_id, version
+                )
+            else:
+                status = await conn.execute("""
+                    UPDATE bot_sessions SET data = $2, version = version + 1, updated_at = NOW()
+                    WHERE chat_id = $1 AND version = $3
+                """, chat_id, blob, version)
+        if status.endswith(" 0"):
+            self.conflicts += 1
+            return False
+        return True
 
-def kb_admin_stats(sort_by: str, page: int, total_pages: int):
-    """Клавиатура для панели статистики"""
-    sort_buttons = [
-        [
-            InlineKeyboardButton(
-                text=f"🕐 По дате {'✅' if sort_by == 'updated' else ''}",
-                callback_data="stats_sort_updated"
-            ),
-            InlineKeyboardButton(
-                text=f"👍 По лайкам {'✅' if sort_by == 'likes' else ''}",
-                callback_data="stats_sort_likes"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text=f"👎 По дизлайкам {'✅' if sort_by == 'dislikes' else ''}",
-                callback_data="stats_sort_dislikes"
-            ),
-            InlineKeyboardButton(
-                text=f"👀 По просмотрам {'✅' if sort_by == 'watches' else ''}",
-                callback_data="stats_sort_watches"
+    async def expire(self, ttl: int):
+        async with db.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM bot_sessions WHERE updated_at < NOW() - make_interval(secs => $1)", ttl
             )
-        ]
-    ]
 
-    # Кнопки пагинации
-    pagination_buttons = []
-    if page > 0:
-        pagination_buttons.append(
-            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"stats_page_{page - 1}_{sort_by}"))
 
-    pagination_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="stats_info"))
+if SESSION_BACKEND == "postgres":
+    session_backend = PostgresSessionBackend(SESSION_TTL)
+else:
+    session_backend = SessionBackend()
 
-    if page < total_pages - 1:
-        pagination_buttons.append(
-            InlineKeyboardButton(text="Вперед ➡️", callback_data=f"stats_page_{page + 1}_{sort_by}"))
 
-    if pagination_buttons:
-        sort_buttons.append(pagination_buttons)
+def update_chat_id(update: types.Update) -> int | None:
+    """Чат, к которому относится апдейт"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
 
-    # НОВЫЕ КНОПКИ ЭКСПОРТА
-    sort_buttons.append([
-        InlineKeyboardButton(text="📄 Выгрузить в PDF", callback_data="stats_export_pdf"),
-        InlineKeyboardButton(text="📊 Диаграммы в PDF", callback_data="stats_charts_pdf")
-    ])
 
-    sort_buttons.append([
-        InlineKeyboardButton(text="⬅️ В админ-панель", callback_data="admin_panel")
-    ])
+# Апдейты одного чата (aiogram запускает каждый отдельной задачей) проходят load → обработчик → save
+# по очереди: иначе restore_chat_state второго апдейта подменит объекты, которые еще меняет первый
+chat_locks: dict[int, asyncio.Lock] = {}
+chat_lock_users = Counter()  # Сколько апдейтов держат или ждут блокировку чата
 
-    return InlineKeyboardMarkup(inline_keyboard=sort_buttons)
 
-async def set_bot_commands():
-    commands = [
-        BotCommand(command="start", description="Запустить бота"),
-        BotCommand(command="admin", description="Админ-панель"),
-        BotCommand(command="search", description="Поиск по TMDB ID"),
-        BotCommand(command="myid", description="Показать ваш ID"),
-    ]
+async def handle_with_chat_state(handler, event: types.Update, data: dict, chat_id: int):
+    """Загрузка состояния, обработчик и сохранение; вызывается под блокировкой чата"""
+    try:
+        blob, version = await session_backend.load(chat_id)
+        restore_chat_state(chat_id, blob)
+    except (OSError, asyncpg.PostgresError, ValueError, zlib.error) as e:
+        # Работаем с тем, что есть в памяти, и не перезаписываем чужое состояние
+        print(f"Ошибка загрузки сессии {chat_id}: {e}")
+        return await handler(event, data)
+
+    # Пока апдейт обрабатывается, его объекты не вытесняются из памяти, поэтому после
+    # обработчика в хранилищах лежит ровно то, что восстановил или записал этот апдейт
+    for store in (user_sessions, user_filters):
+        store.pin(chat_id)
+    try:
+        return await handler(event, data)
+    finally:
+        # Ошибка сохранения не должна подменять исключение обработчика или его результат
+        try:
+            new_blob = dump_chat_state(chat_id)
+            if new_blob != blob and not await session_backend.save(chat_id, new_blob, version):
+                print(f"Сессия {chat_id} изменена другим процессом, изменения апдейта не сохранены")
+        except Exception as e:
+            print(f"Ошибка сохранения сессии {chat_id}: {e}")
+        finally:
+            for store in (user_sessions, user_filters):
+                store.unpin(chat_id)
 
-    await bot.set_my_commands(commands)
-    print("✅ Команды бота установлены")
+
+@dp.update.outer_middleware()
+async def session_middleware(handler, event: types.Update, data: dict):
+    """Подгружает состояние чата перед обработкой апдейта и сохраняет его, если оно изменилось"""
+    chat_id = update_chat_id(event) if session_backend.shared else None
+    if chat_id is None:
+        return await handler(event, data)
+
+    lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+    chat_lock_users[chat_id] += 1
+    try:
+        async with lock:
+            return await handle_with_chat_state(handler, event, data, chat_id)
+    finally:
+        chat_lock_users[chat_id] -= 1
+        if not chat_lock_users[chat_id]:
+            del chat_lock_users[chat_id]
+            del chat_locks[chat_id]
+
+
+def format_metrics() -> str:
+    """Текст с метриками для админа"""
+    lines = [
+        "📈 Метрики\n",
+        f"<b>TMDB</b>: запросов: {tmdb_stats['requests']} | объединено: {tmdb_stats['coalesced']} | "
+        f"повышено: {tmdb_stats['promoted']}\n"
+        f"   429: {tmdb_stats['throttled']} | повторов: {tmdb_stats['retries']}",
+        f"<b>Бан-лист</b>: {len(banned_items)} в памяти | "
+        f"{'синхронизирован' if banned_ready else 'запросы к базе'}",
+        f"<b>title_stats</b>: сверок: {title_stats_reconcile['runs']} | "
+        f"исправлено строк: {title_stats_reconcile['repaired']}",
+        f"<b>friend_signals</b>: сверок: {friend_signals_reconcile['runs']} | "
+        f"исправлено строк: {friend_signals_reconcile['repaired']}",
+    ]
+    st = user_sessions.stats()
+    top_fields = ", ".join(f"{key}: {size // 1024} КБ" for key, size in st["fields"][:3]) or "—"
+    lines.append(
+        f"<b>{user_sessions.name}</b>: {st['size']} | {st['bytes'] // 1024}/{st['max_bytes'] // 1024} КБ\n"
+        f"   evictions: {st['evictions']} | expired: {st['expirations']}\n"
+        f"   больше всего: {top_fields}"
+        + (f"\n   конфликтов записи: {session_backend.conflicts}" if session_backend.shared else "")
+    )
+    for store in (user_filters, watched_sets):
+        st = store.stats()
+        lines.append(
+            f"<b>{store.name}</b>: {st['size']} | {st['bytes'] // 1024}/{st['max_bytes'] // 1024} КБ | "
+            f"evictions: {st['evictions']} | expired: {st['expirations']}"
+        )
+    lines.append(
+        f"<b>Предзагрузка карточек</b>: попаданий: {card_prefetch_stats['hits']} | "
+        f"промахов: {card_prefetch_stats['misses']} | сброшено: {card_prefetch_stats['invalidated']}"
+    )
+    lines.append(
+        f"<b>Постеры</b>: по file_id: {poster_stats['file_id']} | по URL: {poster_stats['url']} | "
+        f"устаревших file_id: {poster_stats['stale']} | известно: {len(poster_file_ids)}"
+    )
+    st = cf_model.stats
+    cf_ms = st["time"] / st["requests"] * 1000 if st["requests"] else 0
+    lines.append(
+        f"<b>Рекомендации по оценкам</b>: тайтлов: {len(cf_model.item_users)} | "
+        f"пользователей: {len(cf_model.user_items)} | соседей в кэше: {len(cf_model.neighbors)}\n"
+        f"   запросов: {st['requests']} | avg {cf_ms:.1f} мс | обновлений: {st['updates']}"
+    )
+    st = discover_pool.stats
+    lines.append(
+        f"<b>Пул discover</b>: наборов фильтров: {len(discover_pool.pools)} | попаданий: {st['hits']} | "
+        f"промахов: {st['misses']}\n"
+        f"   подгружено страниц: {st['refills']} | evictions: {st['evictions']}"
+    )
+    rejections = ", ".join(f"{reason}: {count}" for reason, count in candidate_rejections.most_common(6)) or "—"
+    lines.append(f"<b>Отклонено кандидатов</b>: {rejections}")
+    routes = sorted(callback_router.stats.items(), key=lambda kv: kv[1][0], reverse=True)
+    lookup_us = callback_router.lookup_time / callback_router.lookups * 1e6 if callback_router.lookups else 0
+    lines.append(
+        f"<b>callbacks</b>: маршрутов: {len(callback_router.stats)} | неизвестных: {callback_router.unmatched} | "
+        f"поиск маршрута: {lookup_us:.1f} мкс"
+    )
+    for name, (count, total, longest) in routes[:10]:
+        lines.append(f"   {name}: {count} | avg {total / count * 1000:.0f} мс | max {longest * 1000:.0f} мс")
+    for cache in (details_cache,):
+        st = cache.stats()
+        lines.append(
+            f"<b>{cache.name}</b>: {st['size']}/{st['maxsize']}\n"
+            f"   hit rate: {st['hit_rate']:.1%} | hits: {st['hits']} | disk: {st['disk_hits']} | "
+            f"misses: {st['misses']}\n"
+            f"   evictions: {st['evictions']} | expired: {st['expirations']}"
+        )
+    return "\n".join(lines)
+
+
+# -------------------- TMDB --------------------
+# Классы приоритета запросов: интерактивные (карточки) обслуживаются раньше фоновых (PDF, фильмографии)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class TokenBucket:
+    """Глобальный лимитер запросов (token bucket) с очередью по приоритетам"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # пауза после 429 (Retry-After)
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, ticket: dict | None = None):
+        """ticket — билет запроса {"priority", "waiter"}: через него promote поднимает уже ждущий запрос"""
+        future = asyncio.get_running_loop().create_future()
+        if ticket is not None:
+            priority = min(priority, ticket["priority"])
+            ticket["waiter"] = future
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._dispatch()
+        await future
+
+    def promote(self, ticket: dict, priority: int) -> bool:
+        """Повышает приоритет запроса, к которому присоединился более срочный вызывающий"""
+        if priority >= ticket["priority"]:
+            return False
+        ticket["priority"] = priority
+        future = ticket.get("waiter")
+        if future is not None and not future.done():
+            # Старая запись в куче останется и будет пропущена как выполненная
+            heapq.heappush(self._waiters, (priority, next(self._seq), future))
+            self._dispatch()
+        return True
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов на seconds секунд (ответ 429)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        while self._waiters:
+            if self._waiters[0][2].done():  # ожидающий отменен
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.blocked_until:
+                self._schedule(self.blocked_until - now)
+                return
+            if self.tokens < 1:
+                self._schedule((1 - self.tokens) / self.rate)
+                return
+            _, _, future = heapq.heappop(self._waiters)
+            self.tokens -= 1
+            future.set_result(None)
+
+    def _schedule(self, delay: float):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+tmdb_limiter = TokenBucket(TMDB_RATE_LIMIT, TMDB_RATE_BURST)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Разбирает заголовок Retry-After (секунды)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+def get_tmdb_http() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию с keep-alive пулом соединений"""
+    global tmdb_http
+    if tmdb_http is None or tmdb_http.closed:
+        tmdb_http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=TMDB_MAX_CONNECTIONS, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=TMDB_TIMEOUT),
+        )
+    return tmdb_http
+
+
+async def close_tmdb_http():
+    """Закрывает HTTP-сессию при остановке бота"""
+    if tmdb_http is not None and not tmdb_http.closed:
+        await tmdb_http.close()
+
+
+async def tmdb_get(url: str, params: dict, priority: int = PRIORITY_INTERACTIVE) -> dict | None:
+    """Асинхронный запрос к TMDB API. Возвращает JSON или None при ошибке.
+
+    Одновременные запросы с одинаковыми url и params объединяются в один HTTP-запрос
+    с приоритетом самого срочного из ожидающих: интерактивный вызов, присоединившийся
+    к фоновому запросу, поднимает его в очереди лимитера.
+    """
+    key = (url, tuple(sorted((k, str(v)) for k, v in params.items())))
+    inflight = tmdb_inflight.get(key)
+    if inflight is None:
+        ticket = {"priority": priority, "waiter": None}
+        future = asyncio.ensure_future(_tmdb_request(url, dict(params), ticket))
+        tmdb_inflight[key] = (future, ticket)
+
+        def _forget(done):
+            if key in tmdb_inflight and tmdb_inflight[key][0] is done:
+                del tmdb_inflight[key]
+
+        future.add_done_callback(_forget)
+    else:
+        future, ticket = inflight
+        tmdb_stats["coalesced"] += 1
+        if tmdb_limiter.promote(ticket, priority):
+            tmdb_stats["promoted"] += 1
+
+    # shield: отмена одного из ожидающих не должна отменять общий запрос
+    return await asyncio.shield(future)
+
+
+async def _tmdb_request(url: str, params: dict, ticket: dict) -> dict | None:
+    headers = {"accept": "application/json", "Authorization": f"Bearer {TMDB_TOKEN}"}
+    for attempt in range(TMDB_MAX_RETRIES + 1):
+        await tmdb_limiter.acquire(ticket["priority"], ticket)
+        tmdb_stats["requests"] += 1
+        retry_after = None
+        try:
+            async with tmdb_semaphore:
+                async with get_tmdb_http().get(url, headers=headers, params=params) as r:
+                    if r.status == 200:
+                        return await r.json()
+                    if r.status == 429:
+                        tmdb_stats["throttled"] += 1
+                        retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                        tmdb_limiter.pause(retry_after if retry_after is not None else TMDB_RETRY_BASE * 2 ** attempt)
+                    elif r.status < 500:
+                        print(f"TMDB error {r.status}: {url}")
+                        return None
+                    else:
+                        print(f"TMDB error {r.status} (attempt {attempt + 1}): {url}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"TMDB request error ({url}, attempt {attempt + 1}): {e}")
+
+        if attempt == TMDB_MAX_RETRIES:
+            break
+        # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли пачкой
+        delay = random.uniform(0, TMDB_RETRY_BASE * 2 ** attempt)
+        if retry_after is not None:
+            delay += retry_after
+        tmdb_stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+    print(f"TMDB request failed after {TMDB_MAX_RETRIES + 1} attempts: {url}")
+    return None
+
+
+async def fetch_image(url: str) -> bytes | None:
+    """Скачивает картинку (постер) через общий пул соединений"""
+    try:
+        async with tmdb_semaphore:
+            async with get_tmdb_http().get(url) as r:
+                if r.status != 200:
+                    return None
+                return await r.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Image request error ({url}): {e}")
+        return None
+
+
+DISCOVER_SORTS = ("popularity.desc", "vote_average.desc", "primary_release_date.desc")
+DISCOVER_VOTE_COUNTS = (50, 10)  # Если с порогом 50 ничего нет, пробуем 10
+# Поля выдачи discover, которые нужны боту (записи в сессии и фильтры по жанру/стране)
+DISCOVER_FIELDS = ("id", "title", "name", "release_date", "first_air_date", "genre_ids",
+                   "origin_country", "original_language")
+
+
+class DiscoverPool:
+    """Общий для всех пользователей запас случайных страниц discover.
+
+    Ключ — нормализованная подпись фильтров (тип, жанр, годы, страна, рейтинг и
+    исключение мультфильмов, которое TMDB умеет применять сам через without_genres).
+    Выданная страница из пула удаляется, пул пополняется в фоне; total_pages
+    запоминается, так что случайная страница берется одним запросом, а не двумя.
+    """
+
+    def __init__(self, depth: int, max_signatures: int, total_ttl: int):
+        self.depth = depth
+        self.max_signatures = max_signatures
+        self.total_ttl = total_ttl
+        self.pools: OrderedDict[tuple, dict] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "refills": 0, "evictions": 0}
+
+    @staticmethod
+    def signature(type_: str, genre_id: int | None, filters: dict | None,
+                  exclude_cartoons: bool = False) -> tuple:
+        filters = filters or {}
+        years = (filters.get("start_year"), filters.get("end_year"))
+        if not all(years):
+            years = (None, None)
+        rating = filters.get("rating")
+        return (type_, int(genre_id) if genre_id else None, *years,
+                filters.get("country") or None, float(rating) if rating else None,
+                ANIMATION_GENRE_ID if exclude_cartoons else None)
+
+    @staticmethod
+    def params(signature: tuple, vote_count_min: int) -> dict:
+        type_, genre_id, start_year, end_year, country, rating, without_genre = signature
+        params = {
+            "language": "ru-RU",
+            "sort_by": random.choice(DISCOVER_SORTS),
+            "vote_count.gte": vote_count_min,
+            "include_adult": "false",
+        }
+        if genre_id:
+            params["with_genres"] = genre_id
+        if without_genre:
+            params["without_genres"] = without_genre
+        if start_year:
+            date_field = "primary_release_date" if type_ == "movie" else "first_air_date"
+            params[f"{date_field}.gte"] = f"{start_year}-01-01"
+            params[f"{date_field}.lte"] = f"{end_year}-12-31"
+        if country:
+            params["with_origin_country"] = country
+        if rating:
+            params["vote_average.gte"] = rating
+        return params
+
+    def entry(self, signature: tuple) -> dict:
+        entry = self.pools.get(signature)
+        if entry is None:
+            entry = self.pools[signature] = {"pages": [], "totals": {}, "task": None}
+            while len(self.pools) > self.max_signatures:
+                _, old = self.pools.popitem(last=False)
+                if old["task"]:
+                    old["task"].cancel()
+                self.stats["evictions"] += 1
+        self.pools.move_to_end(signature)
+        return entry
+
+    async def fetch_page(self, signature: tuple, entry: dict, priority: int) -> list:
+        """Одна случайная страница; при известном total_pages — одним запросом"""
+        url = f"https://api.themoviedb.org/3/discover/{signature[0]}"
+        now = time.monotonic()
+        for vote_count_min in DISCOVER_VOTE_COUNTS:
+            params = self.params(signature, vote_count_min)
+            total, learned_at = entry["totals"].get(vote_count_min, (None, 0))
+            if total is None or now - learned_at > self.total_ttl:
+                # Сначала получаем первую страницу чтобы узнать total_pages
+                data = await tmdb_get(url, {**params, "page": 1}, priority)
+                if data is None:
+                    return []
+                total = min(data.get("total_pages", 1), 500)  # Ограничиваем 500 страницами
+                entry["totals"][vote_count_min] = (total, now)
+                page = random.randint(1, total) if total > 1 else 1
+                if page == 1:
+                    results = data.get("results", [])
+                else:
+                    data = await tmdb_get(url, {**params, "page": page}, priority)
+                    results = data.get("results", []) if data is not None else []
+            elif total:
+                data = await tmdb_get(url, {**params, "page": random.randint(1, total)}, priority)
+                results = data.get("results", []) if data is not None else []
+            else:
+                results = []
+            if results:
+                return [{field: r[field] for field in DISCOVER_FIELDS if field in r} for r in results]
+        return []
+
+    async def refill(self, signature: tuple, entry: dict):
+        try:
+            while len(entry["pages"]) < self.depth:
+                page = await self.fetch_page(signature, entry, PRIORITY_BACKGROUND)
+                if not page:
+                    break
+                entry["pages"].append(page)
+                self.stats["refills"] += 1
+        except Exception as e:
+            print(f"Ошибка пополнения пула discover {signature}: {e}")
+
+    async def draw(self, type_: str, genre_id: int | None = None, filters: dict | None = None,
+                   exclude_cartoons: bool = False) -> list:
+        """Случайная страница выдачи: из пула, если есть готовая, иначе запросом к TMDB"""
+        signature = self.signature(type_, genre_id, filters, exclude_cartoons)
+        entry = self.entry(signature)
+        if entry["pages"]:
+            self.stats["hits"] += 1
+            page = entry["pages"].pop(random.randrange(len(entry["pages"])))
+        else:
+            self.stats["misses"] += 1
+            page = await self.fetch_page(signature, entry, PRIORITY_INTERACTIVE)
+        if self.depth and (entry["task"] is None or entry["task"].done()):
+            entry["task"] = asyncio.create_task(self.refill(signature, entry))
+        return page
+
+    def close(self):
+        for entry in self.pools.values():
+            if entry["task"]:
+                entry["task"].cancel()
+
+
+discover_pool = DiscoverPool(DISCOVER_POOL_PAGES, DISCOVER_POOL_SIGNATURES, DISCOVER_TOTAL_TTL)
+
+
+async def discover_tmdb(type_: str, genre_id: int | None = None, filters: dict = None, prefs: dict = None):
+    """Случайная страница discover с фильтрами поиска (filters) и настройками пользователя (prefs)"""
+    exclude_cartoons = bool(prefs and prefs.get("exclude_cartoons"))
+    results = await discover_pool.draw(type_, genre_id, filters, exclude_cartoons)
+    # Аниме TMDB отфильтровать не умеет — отсекаем по полям выдачи, без запроса деталей
+    results = prefilter_payload(results, prefs)
+    # Фильтруем забаненный контент (бан мог появиться, пока страница лежала в пуле)
+    return await filter_banned(results, type_)
+
+# Видео и рекомендации приходят вместе с деталями одним запросом (append_to_response)
+TMDB_DETAILS_APPEND = "videos,recommendations"
+RECOMMENDATION_FIELDS = ("id", "media_type", "title", "name", "genre_ids", "origin_country",
+                         "original_language", "release_date", "first_air_date")
+
+
+def compact_appended(details: dict) -> dict:
+    """Оставляет во вложенных videos/recommendations только поля, которые использует бот"""
+    videos = (details.get("videos") or {}).get("results", [])
+    details["videos"] = {"results": [
+        {"type": v.get("type"), "site": v.get("site"), "key": v.get("key")}
+        for v in videos
+        if v.get("type") == "Trailer" and v.get("site") == "YouTube"
+    ]}
+    recommendations = (details.get("recommendations") or {}).get("results", [])
+    details["recommendations"] = {"results": [
+        {field: r[field] for field in RECOMMENDATION_FIELDS if field in r}
+        for r in recommendations
+    ]}
+    return details
+
+
+async def get_item_details(type_: str, tmdb_id: int, language: str = "ru-RU",
+                           priority: int = PRIORITY_INTERACTIVE):
+    """Детали фильма/сериала вместе с трейлерами и рекомендациями (одна запись в кэше)"""
+    cache_key = (type_, tmdb_id, language)
+    cached = await details_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    url = f"https://api.themoviedb.org/3/{type_}/{tmdb_id}"
+    data = await tmdb_get(url, {"language": language, "append_to_response": TMDB_DETAILS_APPEND}, priority)
+    if data is None:
+        return {}
+    data = compact_appended(data)
+    details_cache.set(cache_key, data)
+    return data
+
+
+def extract_trailer_url(details: dict):
+    for v in (details.get("videos") or {}).get("results", []):
+        if v.get("type") == "Trailer" and v.get("site") == "YouTube":
+            return f"https://www.youtube.com/watch?v={v.get('key')}"
+    return None
+
+
+async def get_trailer_url(type_, tmdb_id):
+    details = await get_item_details(type_, tmdb_id)
+    return extract_trailer_url(details)
+
+
+async def get_trending(media_type: str, time_window: str = "week"):
+    """Получает трендовые фильмы/сериалы за неделю"""
+    url = f"https://api.themoviedb.org/3/trending/{media_type}/{time_window}"
+    data = await tmdb_get(url, {"language": "ru-RU"})
+    if data is not None:
+        return data.get("results", [])
+    return []
+
+
+ANIMATION_GENRE_ID = 16
+
+
+def is_anime_by_details(type_: str, details: dict, item: dict | None = None) -> bool:
+    genre_ids = [g.get("id") for g in details.get("genres", []) if g.get("id")] or (item or {}).get("genre_ids", [])
+    if ANIMATION_GENRE_ID not in genre_ids:
+        return False
+    prod_countries = [c.get("iso_3166_1") for c in details.get("production_countries", []) if c.get("iso_3166_1")]
+    origin_country = details.get("origin_country", []) or []
+    codes = set(prod_countries + origin_country)
+    return "JP" in codes
+
+
+def is_cartoons_by_details(type_: str, details: dict, item: dict | None = None) -> bool:
+    genre_ids = [g.get("id") for g in details.get("genres", []) if g.get("id")] or (item or {}).get("genre_ids", [])
+    return ANIMATION_GENRE_ID in genre_ids
+
+
+def is_anime_by_payload(item: dict) -> bool:
+    """Аниме по полям выдачи TMDB (genre_ids, origin_country) — без деталей. Срабатывает только
+    там, где is_anime_by_details тоже сказал бы «аниме»; у фильмов в выдаче нет origin_country,
+    поэтому они (как и любые сомнительные случаи) остаются на проверку по деталям"""
+    if ANIMATION_GENRE_ID not in (item.get("genre_ids") or ()):
+        return False
+    return "JP" in (item.get("origin_country") or ())
+
+
+class MediaRef(NamedTuple):
+    """Элемент списка в сессии: только поля для кнопок и пагинации.
+    Все остальное по id берется из кэша деталей"""
+    id: int
+    media_type: str
+    title: str
+    year: str = ""
+    roles: tuple = ()
+
+    @classmethod
+    def from_tmdb(cls, item: dict, media_type: str | None = None) -> "MediaRef":
+        media_type = media_type or item.get("media_type")
+        if media_type == "person":
+            title = item.get("name") or "Без имени"
+        else:
+            title = item.get("title") or item.get("name") or "Без названия"
+        year = (item.get("release_date") or item.get("first_air_date") or "")[:4]
+        return cls(item["id"], media_type, title, year, tuple(item.get("person_role", ())))
+
+
+def to_refs(items: list, media_type: str | None = None) -> list[MediaRef]:
+    """Превращает выдачу TMDB в компактные записи для сессии"""
+    return [MediaRef.from_tmdb(item, media_type) for item in items]
+
+
+# -------------------- CANDIDATES --------------------
+# Подбор карточки: источник отдает пачки кандидатов, пачка целиком проверяется на бан и
+# просмотренное (по запросу на пачку), детали запрашиваются только для прошедших.
+# Отклонения считаются по причинам и ограничены бюджетом — без рекурсии и бесконечных повторов
+candidate_rejections = Counter()
+
+
+class Candidate(NamedTuple):
+    item: MediaRef
+    type_: str
+    details: dict
+    pos: int  # Позиция в своей пачке
+
+
+def prefilter_payload(items: list, prefs: dict | None) -> list:
+    """Отсекает аниме и мультфильмы по полям выдачи, до запроса деталей"""
+    exclude_anime = bool(prefs and prefs.get("exclude_anime"))
+    exclude_cartoons = bool(prefs and prefs.get("exclude_cartoons"))
+    if not (exclude_anime or exclude_cartoons):
+        return items
+    kept = []
+    for item in items:
+        if exclude_cartoons and ANIMATION_GENRE_ID in (item.get("genre_ids") or ()):
+            candidate_rejections["cartoons_prefilter"] += 1
+        elif exclude_anime and is_anime_by_payload(item):
+            candidate_rejections["anime_prefilter"] += 1
+        else:
+            kept.append(item)
+    return kept
+
+
+async def single_batch(type_: str, items: list[MediaRef]):
+    """Источник из одной пачки"""
+    yield type_, items
+
+
+async def stream_candidates(chat_id: int, batches, skip=(), budget: int = CANDIDATE_BUDGET,
+                            priority: int = PRIORITY_INTERACTIVE, prefs: dict | None = None):
+    """Отдает кандидатов, прошедших бан и фильтры пользователя.
+    batches — асинхронный итератор пар (тип, список MediaRef); skip — id, которые уже показаны;
+    prefs — уже загруженные настройки пользователя"""
+    filters = prefs or await get_user_filters(chat_id)
+    watched_by_type = {}
+    rejected = 0
+
+    async for type_, items in batches:
+        banned = await banned_keys((item.id, type_) for item in items)
+        if filters["exclude_watched"] and type_ not in watched_by_type:
+            watched_by_type[type_] = await get_watched_ids(chat_id, type_)
+        watched = watched_by_type.get(type_, ())
+
+        for pos, item in enumerate(items):
+            if rejected >= budget:
+                candidate_rejections["budget"] += 1
+                return
+            if item.id in skip:
+                reason = "shown"
+            elif (item.id, type_) in banned:
+                reason = "banned"
+            elif item.id in watched:
+                reason = "watched"
+            else:
+                details = await get_item_details(type_, item.id, priority=priority)
+                if not details:
+                    reason = "no_details"
+                elif filters["exclude_anime"] and is_anime_by_details(type_, details):
+                    reason = "anime"
+                elif filters["exclude_cartoons"] and is_cartoons_by_details(type_, details):
+                    reason = "cartoons"
+                else:
+                    yield Candidate(item, type_, details, pos)
+                    continue
+            candidate_rejections[reason] += 1
+            rejected += 1
+
+
+async def first_candidate(chat_id: int, batches, **kwargs) -> Candidate | None:
+    """Первый подходящий кандидат или None, если источник или бюджет исчерпаны"""
+    stream = stream_candidates(chat_id, batches, **kwargs)
+    try:
+        return await anext(stream, None)
+    finally:
+        await stream.aclose()
+
+
+# -------------------- POSTERS --------------------
+# Постер, однажды отправленный по URL, Telegram хранит у себя: повторно отправляем его по
+# file_id — без повторной загрузки с image.tmdb.org и без зависимости от его доступности
+poster_file_ids: dict[tuple[str, str], str] = {}  # (poster_path, size) -> file_id
+poster_stats = {"file_id": 0, "url": 0, "stale": 0}
+
+
+def poster_url(poster_path: str, size: str = "w500") -> str:
+    return f"https://image.tmdb.org/t/p/{size}{poster_path}"
+
+
+def poster_media(poster_path: str, size: str = "w500") -> str:
+    """file_id постера, если он уже есть в Telegram, иначе URL"""
+    return poster_file_ids.get((poster_path, size)) or poster_url(poster_path, size)
+
+
+async def load_poster_file_ids():
+    async with db.acquire() as conn:
+        rows = await conn.fetch("SELECT poster_path, size, file_id FROM poster_file_ids")
+    poster_file_ids.update({(row["poster_path"], row["size"]): row["file_id"] for row in rows})
+
+
+async def remember_poster(poster_path: str, size: str, message: types.Message | None):
+    """Запоминает file_id из ответа Telegram на отправку постера по URL"""
+    if not message or not message.photo:
+        return
+    file_id = message.photo[-1].file_id
+    if poster_file_ids.get((poster_path, size)) == file_id:
+        return
+    poster_file_ids[(poster_path, size)] = file_id
+    try:
+        async with db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO poster_file_ids (poster_path, size, file_id)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (poster_path, size) DO UPDATE SET file_id = EXCLUDED.file_id
+            """, poster_path, size, file_id)
+    except (OSError, asyncpg.PostgresError) as e:
+        print(f"Ошибка сохранения file_id постера: {e}")
+
+
+def is_stale_file_id_error(error: TelegramBadRequest) -> bool:
+    """Telegram отверг сам file_id ("wrong file identifier", "wrong remote file identifier", ...)"""
+    text = error.message.lower()
+    return "file identifier" in text or "file_id" in text
+
+
+async def forget_poster(poster_path: str, size: str, file_id: str):
+    """Удаляет недействительный file_id из памяти и из базы (если его еще не заменили)"""
+    if poster_file_ids.get((poster_path, size)) == file_id:
+        del poster_file_ids[(poster_path, size)]
+    try:
+        async with db.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM poster_file_ids WHERE poster_path = $1 AND size = $2 AND file_id = $3",
+                poster_path, size, file_id
+            )
+    except (OSError, asyncpg.PostgresError) as e:
+        print(f"Ошибка удаления file_id постера: {e}")
+
+
+async def send_poster(chat_id: int, poster_path: str, size: str = "w500", **kwargs) -> types.Message:
+    """send_photo для постера TMDB: по file_id, если он известен, иначе по URL с запоминанием file_id"""
+    key = (poster_path, size)
+    file_id = poster_file_ids.get(key)
+    if file_id:
+        try:
+            message = await bot.send_photo(chat_id, photo=file_id, **kwargs)
+            poster_stats["file_id"] += 1
+            return message
+        except TelegramBadRequest as e:
+            # Остальные ошибки (сеть, flood control, подпись, клавиатура) к file_id отношения не имеют
+            if not is_stale_file_id_error(e):
+                raise
+            # file_id стал недействительным (например, после смены токена бота)
+            print(f"Ошибка отправки постера по file_id {poster_path}: {e}")
+            await forget_poster(poster_path, size, file_id)
+            poster_stats["stale"] += 1
+
+    message = await bot.send_photo(chat_id, photo=poster_url(poster_path, size), **kwargs)
+    poster_stats["url"] += 1
+    await remember_poster(poster_path, size, message)
+    return message
+
+
+# -------------------- RECOMMENDER --------------------
+# Item-item рекомендации по таблице ratings: разреженная матрица пользователь×тайтл
+# (лайк — 1, просмотр без дизлайка — 0.5), косинусная близость тайтлов и top-K соседей
+# на тайтл, которые считаются по запросу и кэшируются. Новые оценки применяются сразу
+# (add_rating), сбрасывая кэш соседей только у затронутых тайтлов; раз в
+# CF_REBUILD_INTERVAL модель пересобирается из базы (оценки из других процессов)
+SQL_LOAD_CF = """
+    SELECT user_id, tmdb_id, type, title, liked, disliked, watched
+    FROM ratings
+    WHERE liked = true OR watched = true
+"""
+
+
+def cf_weight(liked, disliked, watched) -> float:
+    """Вес оценки в матрице: лайк — 1, просмотр без дизлайка — 0.5, иначе 0"""
+    if liked:
+        return 1.0
+    if watched and not disliked:
+        return 0.5
+    return 0.0
+
+
+class ItemSimilarity:
+    """Модель item-item косинусной близости по неявным оценкам"""
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        self.user_items: dict[int, dict[tuple[int, str], float]] = {}
+        self.item_users: dict[tuple[int, str], dict[int, float]] = {}
+        self.item_norms: dict[tuple[int, str], float] = {}  # Сумма квадратов весов
+        self.titles: dict[tuple[int, str], str] = {}
+        self.neighbors: dict[tuple[int, str], list[tuple[float, tuple[int, str]]]] = {}
+        self.stats = {"updates": 0, "computed": 0, "requests": 0, "time": 0.0}
+
+    def set(self, user_id: int, key: tuple[int, str], weight: float, title: str | None = None) -> bool:
+        """Записывает вес в матрицу без сброса кэша соседей; False — вес не изменился"""
+        old = self.user_items.get(user_id, {}).get(key, 0.0)
+        if title:
+            self.titles[key] = title
+        if old == weight:
+            return False
+        if weight:
+            self.user_items.setdefault(user_id, {})[key] = weight
+            self.item_users.setdefault(key, {})[user_id] = weight
+        else:
+            self.user_items.get(user_id, {}).pop(key, None)
+            self.item_users.get(key, {}).pop(user_id, None)
+        self.item_norms[key] = self.item_norms.get(key, 0.0) + weight * weight - old * old
+        if not self.item_users.get(key):
+            self.item_users.pop(key, None)
+            self.item_norms.pop(key, None)
+        return True
+
+    def update(self, user_id: int, key: tuple[int, str], weight: float, title: str | None = None):
+        """Применяет новую оценку и сбрасывает соседей у всех тайтлов, чья близость к key могла измениться"""
+        # Тайтлы, встречающиеся вместе с key: их близость зависит от нормы key. Собираем до
+        # и после записи — так учитывается и пользователь, чья оценка добавилась или пропала
+        affected = {key}
+        for user in self.item_users.get(key, ()):
+            affected.update(self.user_items[user])
+        if not self.set(user_id, key, weight, title):
+            return
+        affected.update(self.user_items.get(user_id, ()))
+        for other in affected:
+            self.neighbors.pop(other, None)
+        self.stats["updates"] += 1
+
+    def similar(self, key: tuple[int, str]) -> list[tuple[float, tuple[int, str]]]:
+        """top-K самых близких тайтлов (близость, ключ)"""
+        cached = self.neighbors.get(key)
+        if cached is not None:
+            return cached
+        dots: dict[tuple[int, str], float] = {}
+        for user_id, weight in self.item_users.get(key, {}).items():
+            for other, other_weight in self.user_items[user_id].items():
+                if other != key:
+                    dots[other] = dots.get(other, 0.0) + weight * other_weight
+        norm = math.sqrt(self.item_norms.get(key, 0.0))
+        result = heapq.nlargest(self.top_k, (
+            (dot / (norm * math.sqrt(self.item_norms[other])), other)
+            for other, dot in dots.items() if dot > 0
+        )) if norm else []
+        self.neighbors[key] = result
+        self.stats["computed"] += 1
+        return result
+
+    def recommend(self, seeds, exclude=(), limit: int = 20) -> list[MediaRef]:
+        """Тайтлы, близкие к seeds (например, лайкнутым пользователем), по убыванию суммарной близости.
+        exclude — ключи (tmdb_id, type), которые рекомендовать нельзя"""
+        started = time.perf_counter()
+        seeds = set(seeds)
+        scores: dict[tuple[int, str], float] = {}
+        for seed in seeds:
+            for similarity, other in self.similar(seed):
+                if other not in seeds and other not in exclude:
+                    scores[other] = scores.get(other, 0.0) + similarity
+        best = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        self.stats["requests"] += 1
+        self.stats["time"] += time.perf_counter() - started
+        return [MediaRef(tmdb_id, type_, self.titles.get((tmdb_id, type_)) or "Без названия")
+                for (tmdb_id, type_), _ in best]
+
+
+cf_model = ItemSimilarity(CF_TOP_K)
+cf_pending: list[tuple] | None = None  # Оценки, пришедшие во время пересборки модели
+
+
+def cf_apply(user_id: int, key: tuple[int, str], weight: float, title: str | None = None):
+    """Применяет оценку к модели; во время пересборки запоминает ее для новой модели"""
+    cf_model.update(user_id, key, weight, title)
+    if cf_pending is not None:
+        cf_pending.append((user_id, key, weight, title))
+
+
+async def build_cf_model():
+    """Собирает модель заново из таблицы ratings"""
+    global cf_model, cf_pending
+    cf_pending = []
+    try:
+        async with db.acquire() as conn:
+            rows = await conn.fetch(SQL_LOAD_CF)
+        model = ItemSimilarity(CF_TOP_K)
+        for row in rows:
+            weight = cf_weight(row["liked"], row["disliked"], row["watched"])
+            if weight:
+                model.set(row["user_id"], (row["tmdb_id"], row["type"]), weight, row["title"])
+        # Оценки, сохраненные пока шла выборка, могли в нее не попасть. Веса абсолютные,
+        # так что повторное применение уже учтенных безвредно
+        for args in cf_pending:
+            model.set(*args)
+        cf_model = model
+    finally:
+        cf_pending = None
+
+
+async def cf_rebuild_loop():
+    """Периодически пересобирает модель рекомендаций"""
+    while True:
+        await asyncio.sleep(CF_REBUILD_INTERVAL)
+        try:
+            await build_cf_model()
+        except (OSError, asyncpg.PostgresError) as e:
+            print(f"Ошибка пересборки рекомендаций: {e}")
+
+
+# -------------------- CALLBACK DATA --------------------
+# Кнопки действий над фильмом/сериалом кодируются компактно: "~" + base64url от
+# [версия][код действия][varint(tmdb_id << 1 | тип)][varint доп. параметров...].
+# Старые строковые кнопки вида like_{tmdb_id}_{type} разбираются в тот же CallbackPayload
+CALLBACK_MARKER = "~"
+CALLBACK_VERSION = 1
+# Код действия — индекс в кортеже. Только дописывать в конец: коды уже лежат в отправленных кнопках
+CALLBACK_ACTIONS = (
+    "select", "add", "remove", "like", "dislike", "reset_rating", "mark_watched", "toggle_hide",
+    "show_collection_item", "similar", "admin_preban", "confirm_ban", "confirm_unban",
+)
+CALLBACK_ACTION_CODES = {action: code for code, action in enumerate(CALLBACK_ACTIONS)}
+CALLBACK_TYPES = ("movie", "tv")
+
+
+class CallbackPayload(NamedTuple):
+    action: str
+    tmdb_id: int
+    type_: str
+    extra: tuple = ()  # Контекст кнопки: страница, источник списка и т.п.
+
+
+def write_varint(buf: bytearray, value: int):
+    if value < 0:
+        raise ValueError(f"varint не поддерживает отрицательные числа: {value}")
+    while value > 0x7F:
+        buf.append(value & 0x7F | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def read_varint(raw: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = raw[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_callback(action: str, tmdb_id: int, type_: str, *extra: int) -> str:
+    """Упаковывает действие над фильмом/сериалом в callback_data"""
+    buf = bytearray((CALLBACK_VERSION, CALLBACK_ACTION_CODES[action]))
+    write_varint(buf, int(tmdb_id) << 1 | CALLBACK_TYPES.index(type_))
+    for value in extra:
+        write_varint(buf, value)
+    return CALLBACK_MARKER + base64.urlsafe_b64encode(bytes(buf)).rstrip(b"=").decode("ascii")
+
+
+def decode_callback(data: str, action: str | None = None) -> CallbackPayload | None:
+    """Разбирает callback_data (новый формат или старый строковый). None — данные некорректны"""
+    if not data.startswith(CALLBACK_MARKER):
+        return parse_legacy_callback(data, action)
+    encoded = data[1:]
+    try:
+        raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        if raw[0] != CALLBACK_VERSION:
+            return None
+        value, pos = read_varint(raw, 2)
+        extra = []
+        while pos < len(raw):
+            item, pos = read_varint(raw, pos)
+            extra.append(item)
+        return CallbackPayload(CALLBACK_ACTIONS[raw[1]], value >> 1, CALLBACK_TYPES[value & 1], tuple(extra))
+    except (ValueError, IndexError):
+        return None
+
+
+def parse_legacy_callback(data: str, action: str | None = None) -> CallbackPayload | None:
+    """Старый формат {action}_{tmdb_id}_{type} (у mark_watched тип мог отсутствовать)"""
+    if action is None:
+        action = max((a for a in CALLBACK_ACTIONS if data.startswith(a + "_")), key=len, default=None)
+        if action is None:
+            return None
+    id_part, _, type_ = data[len(action) + 1:].partition("_")
+    if not id_part.isdigit():
+        return None
+    type_ = type_ or "movie"
+    if type_ not in CALLBACK_TYPES:
+        return None
+    return CallbackPayload(action, int(id_part), type_)
+
+
+# -------------------- KEYBOARDS --------------------
+def kb_main():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔍 Поиск", callback_data="search_menu")],
+        [InlineKeyboardButton(text="⚡ Фильтры поиска", callback_data="search_filters")],
+        [InlineKeyboardButton(text="👥 Друзья", callback_data="friends_menu")],  # Новая кнопка
+        [InlineKeyboardButton(text="📚 Коллекция", callback_data="show_collection")],
+        [InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings")],
+    ])
+
+
+def kb_search_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎲 Случайный поиск", callback_data="random_search")],
+        [InlineKeyboardButton(text="🔍 Поиск по названию", callback_data="search_by_title")],
+        [InlineKeyboardButton(text="🎭 Поиск по актеру", callback_data="search_by_person")],
+        [InlineKeyboardButton(text="🎯 На основе предпочтений", callback_data="preferences")],
+        [InlineKeyboardButton(text="🔥 В тренде сейчас", callback_data="trending_menu")],
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")],
+    ])
+
+
+def kb_random_search():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎬 Случайный фильм", callback_data="discover_movie")],
+        [InlineKeyboardButton(text="📺 Случайный сериал", callback_data="discover_tv")],
+        [InlineKeyboardButton(text="🧭 Случайный поиск по жанрам", callback_data="search_genre")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")],
+    ])
+
+
+def kb_settings(filters):
+    anime_status = "✅" if filters.get("exclude_anime") else "❌"
+    cartoons_status = "✅" if filters.get("exclude_cartoons") else "❌"
+    watched_status = "✅" if filters.get("exclude_watched") else "❌"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{anime_status} Скрывать аниме", callback_data="toggle_anime")],
+        [InlineKeyboardButton(text=f"{cartoons_status} Скрывать мультфильмы", callback_data="toggle_cartoons")],
+        [InlineKeyboardButton(text=f"{watched_status} Скрывать просмотренное", callback_data="toggle_watched")],
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")],
+    ])
+
+def kb_admin_panel():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔍 Поиск для бана", callback_data="admin_search_ban")],
+        [InlineKeyboardButton(text="📋 Список банов", callback_data="admin_ban_list")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+    ])
+
+
+def kb_admin_stats(sort_by: str, page: int, total_pages: int):
+    """Клавиатура для панели статистики"""
+    sort_buttons = [
+        [
+            InlineKeyboardButton(
+                text=f"🕐 По дате {'✅' if sort_by == 'updated' else ''}",
+                callback_data="stats_sort_updated"
+            ),
+            InlineKeyboardButton(
+                text=f"👍 По лайкам {'✅' if sort_by == 'likes' else ''}",
+                callback_data="stats_sort_likes"
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                text=f"👎 По дизлайкам {'✅' if sort_by == 'dislikes' else ''}",
+                callback_data="stats_sort_dislikes"
+            ),
+            InlineKeyboardButton(
+                text=f"👀 По просмотрам {'✅' if sort_by == 'watches' else ''}",
+                callback_data="stats_sort_watches"
+            )
+        ]
+    ]
+
+    # Кнопки пагинации
+    pagination_buttons = []
+    if page > 0:
+        pagination_buttons.append(
+            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"stats_page_{page - 1}_{sort_by}"))
+
+    pagination_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="stats_info"))
+
+    if page < total_pages - 1:
+        pagination_buttons.append(
+            InlineKeyboardButton(text="Вперед ➡️", callback_data=f"stats_page_{page + 1}_{sort_by}"))
+
+    if pagination_buttons:
+        sort_buttons.append(pagination_buttons)
+
+    # НОВЫЕ КНОПКИ ЭКСПОРТА
+    sort_buttons.append([
+        InlineKeyboardButton(text="📄 Выгрузить в PDF", callback_data="stats_export_pdf"),
+        InlineKeyboardButton(text="📊 Диаграммы в PDF", callback_data="stats_charts_pdf")
+    ])
+
+    sort_buttons.append([
+        InlineKeyboardButton(text="⬅️ В админ-панель", callback_data="admin_panel")
+    ])
+
+    return InlineKeyboardMarkup(inline_keyboard=sort_buttons)
+
+async def set_bot_commands():
+    commands = [
+        BotCommand(command="start", description="Запустить бота"),
+        BotCommand(command="admin", description="Админ-панель"),
+        BotCommand(command="search", description="Поиск по TMDB ID"),
+        BotCommand(command="myid", description="Показать ваш ID"),
+    ]
+
+    await bot.set_my_commands(commands)
+    print("✅ Команды бота установлены")
 
 
 async def kb_ban_confirmation(tmdb_id: int, type_: str, title: str):
@@ -728,14 +2669,14 @@ async def kb_ban_confirmation(tmdb_id: int, type_: str, title: str):
     if is_already_banned:
         return InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text="🔓 Разбанить", callback_data=f"confirm_unban_{tmdb_id}_{type_}"),
+                InlineKeyboardButton(text="🔓 Разбанить", callback_data=encode_callback("confirm_unban", tmdb_id, type_)),
                 InlineKeyboardButton(text="❌ Отмена", callback_data="delete_message")
             ]
         ])
     else:
         return InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text="🚫 Забанить", callback_data=f"confirm_ban_{tmdb_id}_{type_}"),
+                InlineKeyboardButton(text="🚫 Забанить", callback_data=encode_callback("confirm_ban", tmdb_id, type_)),
                 InlineKeyboardButton(text="❌ Отмена", callback_data="delete_message")
             ]
         ])
@@ -799,24 +2740,27 @@ def kb_rating_selection():
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+SQL_IN_COLLECTION = """
+    SELECT 1 FROM collection 
+    WHERE user_id = $1 AND tmdb_id = $2 AND type = $3
+"""
+
+
 async def is_in_user_collection(tg_id: int, tmdb_id: int, type_: str) -> bool:
     """Проверяет, находится ли контент в коллекции пользователя"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return False
 
-        row = await conn.fetchrow("""
-            SELECT 1 FROM collection 
-            WHERE user_id = $1 AND tmdb_id = $2 AND type = $3
-        """, user["user_id"], tmdb_id, type_)
+        row = await conn.fetchrow(SQL_IN_COLLECTION, user_id, tmdb_id, type_)
 
         return bool(row)
 
 
 async def kb_card(chat_id: int, tmdb_id: int, type_: str, is_genre_search: bool = False, is_trending: bool = False):
     buttons = []
-    trailer_url = get_trailer_url(type_, tmdb_id)
+    trailer_url = await get_trailer_url(type_, tmdb_id)
     if trailer_url:
         buttons.append([InlineKeyboardButton(text="▶️ Трейлер", url=trailer_url)])
 
@@ -828,7 +2772,7 @@ async def kb_card(chat_id: int, tmdb_id: int, type_: str, is_genre_search: bool
         ])
     else:
         buttons.append([
-            InlineKeyboardButton(text="➕ В коллекцию", callback_data=f"add_{tmdb_id}_{type_}"),
+            InlineKeyboardButton(text="➕ В коллекцию", callback_data=encode_callback("add", tmdb_id, type_)),
         ])
     buttons.append([InlineKeyboardButton(text="➡️ Следующий", callback_data="next_item")])
 
@@ -843,15 +2787,15 @@ async def kb_card(chat_id: int, tmdb_id: int, type_: str, is_genre_search: bool
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def kb_collection_item(tmdb_id: int, type_: str, watched: bool = False, liked: bool | None = None,
+async def kb_collection_item(tmdb_id: int, type_: str, watched: bool = False, liked: bool | None = None,
                        disliked: bool | None = None, is_hidden: bool = False):
     buttons = []
-    trailer_url = get_trailer_url(type_, tmdb_id)
+    trailer_url = await get_trailer_url(type_, tmdb_id)
     if trailer_url:
         buttons.append([InlineKeyboardButton(text="▶️ Трейлер", url=trailer_url)])
 
     watched_text = "✅ Просмотрено" if watched else "👀 Отметить просмотр"
-    buttons.append([InlineKeyboardButton(text=watched_text, callback_data=f"mark_watched_{tmdb_id}_{type_}")])
+    buttons.append([InlineKeyboardButton(text=watched_text, callback_data=encode_callback("mark_watched", tmdb_id, type_))])
 
     like_text = "👍 Лайк ✅" if liked is True else "👍 Лайк"
     dislike_text = "👎 Дизлайк ✅" if disliked is True else "👎 Дизлайк"
@@ -860,21 +2804,21 @@ def kb_collection_item(tmdb_id: int, type_: str, watched: bool = False, liked: b
     hide_text = "🙈 Скрыть от друзей ✅" if is_hidden else "🙈 Скрыть от друзей"
 
     buttons.append([
-        InlineKeyboardButton(text=like_text, callback_data=f"like_{tmdb_id}_{type_}"),
-        InlineKeyboardButton(text=dislike_text, callback_data=f"dislike_{tmdb_id}_{type_}")
+        InlineKeyboardButton(text=like_text, callback_data=encode_callback("like", tmdb_id, type_)),
+        InlineKeyboardButton(text=dislike_text, callback_data=encode_callback("dislike", tmdb_id, type_))
     ])
 
     # Показываем кнопку скрытия только если есть оценка
     if liked is True or disliked is True:
         buttons.append([
-            InlineKeyboardButton(text=hide_text, callback_data=f"toggle_hide_{tmdb_id}_{type_}")
+            InlineKeyboardButton(text=hide_text, callback_data=encode_callback("toggle_hide", tmdb_id, type_))
         ])
 
     # Добавляем кнопку "Снять оценку", показываем только если была оценка
     if (liked is True) or (disliked is True):
-        buttons.append([InlineKeyboardButton(text="🔄 Снять оценку", callback_data=f"reset_rating_{tmdb_id}_{type_}")])
+        buttons.append([InlineKeyboardButton(text="🔄 Снять оценку", callback_data=encode_callback("reset_rating", tmdb_id, type_))])
 
-    buttons.append([InlineKeyboardButton(text="❌ Удалить", callback_data=f"remove_{tmdb_id}_{type_}")])
+    buttons.append([InlineKeyboardButton(text="❌ Удалить", callback_data=encode_callback("remove", tmdb_id, type_))])
     buttons.append([InlineKeyboardButton(text="⬅️ К коллекции", callback_data="show_collection")])
     buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -888,30 +2832,91 @@ def kb_trending_menu():
     ])
 
 
-async def filter_watched_items(tg_id: int, items: list, type_: str):
+SQL_GET_WATCHED_IDS = """
+    SELECT type, tmdb_id
+    FROM ratings
+    WHERE user_id = $1
+    AND watched = true
+    ORDER BY type, tmdb_id
+"""
+
+
+class WatchedIds(array):
+    """Отсортированный массив id (4 байта на запись); проверка вхождения — бинарным поиском"""
+
+    def __new__(cls, ids=()):
+        return super().__new__(cls, "i", sorted(ids))
+
+    def __contains__(self, tmdb_id) -> bool:
+        i = bisect.bisect_left(self, tmdb_id)
+        return i < len(self) and self[i] == tmdb_id
+
+    def add(self, tmdb_id: int):
+        i = bisect.bisect_left(self, tmdb_id)
+        if i == len(self) or self[i] != tmdb_id:
+            self.insert(i, tmdb_id)
+
+    def discard(self, tmdb_id: int):
+        i = bisect.bisect_left(self, tmdb_id)
+        if i < len(self) and self[i] == tmdb_id:
+            del self[i]
+
+
+async def load_watched(tg_id: int) -> dict[str, WatchedIds]:
+    """Просмотренное пользователем по типам: один запрос, дальше — из watched_sets"""
+    sets = watched_sets.get(tg_id)
+    if sets is not None:
+        return sets
+    sets = {"movie": WatchedIds(), "tv": WatchedIds()}
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
-            return items
-        watched_ids = await conn.fetch(
-            "SELECT tmdb_id FROM ratings WHERE user_id=$1 AND type=$2 AND watched = true",
-            user["user_id"], type_
-        )
-        watched_ids = {row["tmdb_id"] for row in watched_ids}
-        return [item for item in items if item["id"] not in watched_ids]
+        user_id = await get_user_id(conn, tg_id)
+        rows = await conn.fetch(SQL_GET_WATCHED_IDS, user_id) if user_id is not None else []
+    for row in rows:
+        # Строки уже отсортированы по tmdb_id — просто дописываем
+        sets.setdefault(row["type"], WatchedIds()).append(row["tmdb_id"])
+    watched_sets[tg_id] = sets
+    return sets
+
+
+def remember_watched(tg_id: int, tmdb_id: int, type_: str, watched: bool):
+    """Обновляет загруженный набор просмотренного после сохранения оценки"""
+    sets = watched_sets.get(tg_id)
+    if sets is None:
+        return
+    ids = sets.setdefault(type_, WatchedIds())
+    if watched:
+        ids.add(tmdb_id)
+    else:
+        ids.discard(tmdb_id)
+    watched_sets[tg_id] = sets  # Пересчет размера
+
+
+async def get_watched_ids(tg_id: int, type_: str) -> WatchedIds:
+    """id просмотренного пользователем контента данного типа"""
+    sets = await load_watched(tg_id)
+    return sets.get(type_) or WatchedIds()
+
+
+async def is_watched(tg_id: int, tmdb_id: int, type_: str) -> bool:
+    return tmdb_id in await get_watched_ids(tg_id, type_)
+
+
+async def filter_watched_items(tg_id: int, items: list, type_: str):
+    watched_ids = await get_watched_ids(tg_id, type_)
+    return [item for item in items if item["id"] not in watched_ids]
 
 
 async def get_user_likes(tg_id: int):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return []
         rows = await conn.fetch("""
                                 SELECT tmdb_id, type
                                 FROM ratings
                                 WHERE user_id = $1
                                   AND liked = true
-                                """, user["user_id"])
+                                """, user_id)
         return [{"tmdb_id": row["tmdb_id"], "type": row["type"]} for row in rows]
 
 
@@ -919,15 +2924,13 @@ async def kb_collection(tg_id: int, page: int, total_pages: int):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     collection = await get_collection(tg_id, limit=4, offset=page * 4)
 
-    for item in collection:
-        # Используем item['type'] вместо неопределенной переменной type_
-        if not await is_banned(item["tmdb_id"], item["type"]):  # ← ИСПРАВЛЕНО ЗДЕСЬ
-            keyboard.inline_keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{item['title']} ({item['year']})",
-                    callback_data=f"show_collection_item_{item['tmdb_id']}_{item['type']}"
-                )
-            ])
+    for item in await filter_banned(collection, id_key="tmdb_id", type_key="type"):
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(
+                text=f"{item['title']} ({item['year']})",
+                callback_data=encode_callback("show_collection_item", item["tmdb_id"], item["type"])
+            )
+        ])
 
     navigation = []
     if page > 0:
@@ -996,10 +2999,10 @@ def kb_my_friends(friends_list, page=0, friends_per_page=10):
 async def remove_friend(user_tg_id: int, friend_tg_id: int):
     """Удаляет друга"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", user_tg_id)
-        friend = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", friend_tg_id)
+        user_id = await get_user_id(conn, user_tg_id)
+        friend_user_id = await get_user_id(conn, friend_tg_id)
 
-        if not user or not friend:
+        if user_id is None or friend_user_id is None:
             return False
 
         # Удаляем взаимную дружбу
@@ -1007,7 +3010,7 @@ async def remove_friend(user_tg_id: int, friend_tg_id: int):
             DELETE FROM user_friends 
             WHERE (user_id = $1 AND friend_user_id = $2) 
                OR (user_id = $2 AND friend_user_id = $1)
-        """, user["user_id"], friend["user_id"])
+        """, user_id, friend_user_id)
 
         return True
 
@@ -1065,12 +3068,12 @@ async def generate_stats_pdf(stats_data: dict, sort_by: str):
 
         if item.get('tmdb_id'):
             try:
-                details = get_item_details(item['type'], item['tmdb_id'])
+                details = await get_item_details(item['type'], item['tmdb_id'], priority=PRIORITY_BACKGROUND)
                 if details and details.get('poster_path') and details['poster_path'] != "/default.jpg":
                     poster_url = f"https://image.tmdb.org/t/p/w154{details['poster_path']}"
-                    response = requests.get(poster_url, timeout=10)
-                    if response.status_code == 200:
-                        img_data = io.BytesIO(response.content)
+                    content = await fetch_image(poster_url)
+                    if content:
+                        img_data = io.BytesIO(content)
                         img_reader = ImageReader(img_data)
                         pdf.drawImage(img_reader, poster_x, poster_y,
                                       width=poster_width, height=poster_height,
@@ -1394,12 +3397,9 @@ def register_russian_font():
     return False
 
 
-def get_recommendations(type_: str, tmdb_id: int):
-    url = f"https://api.themoviedb.org/3/{type_}/{tmdb_id}/recommendations"
-    r = tmdb_get(url, {"language": "ru-RU", "page": 1})
-    if r.status_code == 200:
-        return r.json().get("results", [])
-    return []
+async def get_recommendations(type_: str, tmdb_id: int):
+    details = await get_item_details(type_, tmdb_id)
+    return (details.get("recommendations") or {}).get("results", [])
 
 
 def kb_genres(type_: str):
@@ -1417,7 +3417,7 @@ def kb_genres(type_: str):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def search_by_title(title: str, type_: str = None, page: int = 1):
+async def search_by_title(title: str, type_: str = None, page: int = 1):
     """Поиск контента по названию через TMDB API с проверкой банов"""
     url = "https://api.themoviedb.org/3/search/multi"
     params = {
@@ -1427,26 +3427,21 @@ def search_by_title(title: str, type_: str = None, page: int = 1):
         "include_adult": "false"
     }
 
-    r = tmdb_get(url, params)
-    if r.status_code == 200:
-        data = r.json()
-        results = data.get("results", [])
+    data = await tmdb_get(url, params)
+    if data is not None:
+        results = list(data.get("results", []))
         total_pages = data.get("total_pages", 1)
 
         # Если нужно больше результатов, получаем дополнительные страницы
         if total_pages > 1 and page == 1:
-            # Ограничим максимум 3 страницы (60 результатов)
+            # Ограничим максимум 3 страницы (60 результатов), запрашиваем их параллельно
             max_pages = min(total_pages, 3)
-            for next_page in range(2, max_pages + 1):
-                try:
-                    params["page"] = next_page
-                    next_r = tmdb_get(url, params)
-                    if next_r.status_code == 200:
-                        next_data = next_r.json()
-                        results.extend(next_data.get("results", []))
-                except Exception as e:
-                    print(f"Error fetching page {next_page}: {e}")
-                    break
+            pages = await asyncio.gather(*(
+                tmdb_get(url, {**params, "page": next_page}) for next_page in range(2, max_pages + 1)
+            ))
+            for next_data in pages:
+                if next_data is not None:
+                    results.extend(next_data.get("results", []))
 
         # Фильтруем по типу если указан
         if type_:
@@ -1456,7 +3451,7 @@ def search_by_title(title: str, type_: str = None, page: int = 1):
     return []
 
 
-def search_by_person(name: str):
+async def search_by_person(name: str):
     """Поиск актеров/режиссеров через TMDB API"""
     url = "https://api.themoviedb.org/3/search/person"
     params = {
@@ -1468,32 +3463,27 @@ def search_by_person(name: str):
 
     print(f"DEBUG: Searching for person: {name}")  # Отладка
 
-    r = tmdb_get(url, params)
-    if r.status_code == 200:
-        data = r.json()
-        results = data.get("results", [])
+    data = await tmdb_get(url, params)
+    if data is not None:
+        results = list(data.get("results", []))
 
         print(f"DEBUG: Found {len(results)} persons")  # Отладка
 
-        # Получаем дополнительные страницы если есть
+        # Получаем дополнительные страницы если есть (параллельно)
         total_pages = data.get("total_pages", 1)
         if total_pages > 1:
             max_pages = min(total_pages, 3)
-            for next_page in range(2, max_pages + 1):
-                try:
-                    params["page"] = next_page
-                    next_r = tmdb_get(url, params)
-                    if next_r.status_code == 200:
-                        next_data = next_r.json()
-                        results.extend(next_data.get("results", []))
-                except Exception as e:
-                    print(f"Error fetching person page {next_page}: {e}")
-                    break
+            pages = await asyncio.gather(*(
+                tmdb_get(url, {**params, "page": next_page}) for next_page in range(2, max_pages + 1)
+            ))
+            for next_data in pages:
+                if next_data is not None:
+                    results.extend(next_data.get("results", []))
 
         print(f"DEBUG: Total persons after pagination: {len(results)}")  # Отладка
         return results
 
-    print(f"DEBUG: TMDB API error: {r.status_code}")  # Отладка
+    print(f"DEBUG: TMDB API error for person search: {name}")  # Отладка
     return []
 
 
@@ -1506,9 +3496,8 @@ async def get_person_filmography(person_id: int):
 
     print(f"DEBUG: Getting filmography for person_id: {person_id}")
 
-    r = tmdb_get(url, params)
-    if r.status_code == 200:
-        data = r.json()
+    data = await tmdb_get(url, params)
+    if data is not None:
         cast = data.get("cast", [])
         crew = data.get("crew", [])
 
@@ -1625,7 +3614,7 @@ async def get_person_filmography(person_id: int):
             # Для сериалов - только если это не эпизодическая режиссура
             if media_type == "tv":
                 # Получаем детали сериала для проверки
-                series_details = get_item_details("tv", item.get("id"))
+                series_details = await get_item_details("tv", item.get("id"), priority=PRIORITY_BACKGROUND)
                 if series_details:
                     # Проверяем создателей сериала
                     created_by = series_details.get("created_by", [])
@@ -1670,18 +3659,7 @@ async def get_person_filmography(person_id: int):
             print(f"DEBUG: Filmography item {i}: {title} ({media_type}) - Roles: {roles}")
 
         # ФИЛЬТРАЦИЯ ЗАБАНЕННОГО КОНТЕНТА
-        async def filter_banned_filmography(items):
-            filtered_items = []
-            for item in items:
-                media_type = item.get("media_type")
-                if not await is_banned(item["id"], media_type):
-                    filtered_items.append(item)
-                else:
-                    print(f"DEBUG: Excluding banned content from filmography: {item.get('title')} (ID: {item['id']})")
-            return filtered_items
-
-        # Применяем фильтрацию банов
-        filmography = await filter_banned_filmography(filmography)
+        filmography = await filter_banned(filmography)
 
         print(f"DEBUG: Final filmography count (with ban filter): {len(filmography)}")
 
@@ -1693,7 +3671,7 @@ async def get_person_filmography(person_id: int):
 
         return filmography
 
-    print(f"DEBUG: TMDB API error: {r.status_code}")
+    print(f"DEBUG: TMDB API error for person_id: {person_id}")
     return []  # ВАЖНО: возвращаем пустой список при ошибке
 
 def format_banned_page(banned_list: list, page: int, items_per_page: int = 15):
@@ -1788,19 +3766,15 @@ def kb_search_results(results, search_query: str, page: int = 0, results_per_pag
     keyboard = []
 
     for item in page_results:
-        media_type = item.get("media_type")
-        title = item.get("title") or item.get("name")
-        year = (item.get("release_date") or item.get("first_air_date") or "")[:4]
-
-        if media_type in ["movie", "tv"]:
-            btn_text = f"{'🎬' if media_type == 'movie' else '📺'} {title}"
-            if year:
-                btn_text += f" ({year})"
+        if item.media_type in ["movie", "tv"]:
+            btn_text = f"{'🎬' if item.media_type == 'movie' else '📺'} {item.title}"
+            if item.year:
+                btn_text += f" ({item.year})"
 
             keyboard.append([
                 InlineKeyboardButton(
                     text=btn_text,
-                    callback_data=f"admin_preban_{item['id']}_{media_type}"
+                    callback_data=encode_callback("admin_preban", item.id, item.media_type)
                 )
             ])
 
@@ -1829,11 +3803,7 @@ async def send_search_results_page(chat_id: int, results: list, search_query: st
     page_results = results[start_idx:end_idx]
 
     # СЧИТАЕМ ТОЛЬКО ОТОБРАЖАЕМЫЕ РЕЗУЛЬТАТЫ (movie/tv)
-    displayable_results = []
-    for item in page_results:
-        media_type = item.get("media_type")
-        if media_type in ["movie", "tv"]:
-            displayable_results.append(item)
+    displayable_results = [item for item in page_results if item.media_type in ["movie", "tv"]]
 
     actual_display_count = len(displayable_results)
     total_pages = (actual_display_count + results_per_page - 1) // results_per_page
@@ -1843,18 +3813,14 @@ async def send_search_results_page(chat_id: int, results: list, search_query: st
     keyboard = []
 
     for item in displayable_results:
-        media_type = item.get("media_type")
-        title = item.get("title") or item.get("name")
-        year = (item.get("release_date") or item.get("first_air_date") or "")[:4]
-
-        btn_text = f"{'🎬' if media_type == 'movie' else '📺'} {title}"
-        if year:
-            btn_text += f" ({year})"
+        btn_text = f"{'🎬' if item.media_type == 'movie' else '📺'} {item.title}"
+        if item.year:
+            btn_text += f" ({item.year})"
 
         keyboard.append([
             InlineKeyboardButton(
                 text=btn_text,
-                callback_data=f"select_{item['id']}_{media_type}"
+                callback_data=encode_callback("select", item.id, item.media_type)
             )
         ])
 
@@ -1889,7 +3855,7 @@ async def search_by_tmdb_id(message: types.Message):
     if type_ not in ["movie", "tv"]:
         await message.answer("❌ Некорректный тип. Укажите movie или tv.")
         return
-    details = get_item_details(type_, tmdb_id)
+    details = await get_item_details(type_, tmdb_id)
 
     if await is_banned(tmdb_id, type_):
         await message.answer("❌ Этот контент заблокирован администратором и недоступен для просмотра.")
@@ -1904,7 +3870,7 @@ async def search_by_tmdb_id(message: types.Message):
     overview = details.get("overview") or "Описание отсутствует."
     if len(overview) > 2000:
         overview = overview[:2000] + "..."
-    poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
+    poster = details.get("poster_path")
     avg_ratings = await get_ratings(tmdb_id, type_)
     watched_text = ""
     user_rating = await get_user_rating(message.chat.id, tmdb_id, type_)
@@ -1917,9 +3883,9 @@ async def search_by_tmdb_id(message: types.Message):
         f"{watched_text}\n\n{overview}"
     )
     if poster:
-        await message.answer_photo(photo=poster, caption=caption, reply_markup=kb_card(tmdb_id, type_))
+        await send_poster(message.chat.id, poster, caption=caption, reply_markup=await kb_card(message.chat.id, tmdb_id, type_))
     else:
-        await message.answer(text=caption, reply_markup=kb_card(tmdb_id, type_))
+        await message.answer(text=caption, reply_markup=await kb_card(message.chat.id, tmdb_id, type_))
 
 
 @dp.message(Command("unban"))
@@ -1985,13 +3951,30 @@ async def ban_command(message: types.Message):  # Название функци
         return
 
     # Получаем название для бана
-    details = get_item_details(type_, tmdb_id)
+    details = await get_item_details(type_, tmdb_id)
     title = details.get("title") or details.get("name") or "Unknown"
 
     # Баним контент
     await ban_content(tmdb_id, type_, title, message.chat.id, "Бан через команду")
     await message.answer(f"✅ Контент {type_} с ID {tmdb_id} забанен!")
 
+@dp.message(Command("metrics"))
+async def metrics_command(message: types.Message):
+    if not is_admin(message.chat.id):
+        await message.answer("❌ Нет доступа к админ-панели!")
+        return
+
+    await message.answer(format_metrics(), parse_mode="HTML")
+
+@dp.message(Command("explain"))
+async def explain_command(message: types.Message):
+    if not is_admin(message.chat.id):
+        await message.answer("❌ Нет доступа к админ-панели!")
+        return
+
+    report = await explain_hot_queries()
+    await message.answer(format_explain_report(report), parse_mode="HTML")
+
 @dp.message(Command("admin"))
 async def admin_command(message: types.Message):
     if not is_admin(message.chat.id):
@@ -2004,8 +3987,7 @@ async def admin_command(message: types.Message):
 @dp.message(Command("start"))
 async def start(message: types.Message):
     await get_or_create_user(message.chat.id, message.from_user.username)
-    filters = await get_user_filters(message.chat.id)
-    user_filters[message.chat.id] = filters
+    await get_user_filters(message.chat.id)  # Прогреваем кэш настроек
 
     # Загружаем сохраненные фильтры поиска
     search_filters = await load_search_filters(message.chat.id)
@@ -2044,7 +4026,7 @@ async def handle_user_input(message: types.Message):
             type_filter = "tv"
             search_query = search_query.replace(" tv", "").strip()
 
-        results = search_by_title(search_query, type_filter)
+        results = to_refs(await search_by_title(search_query, type_filter))
         user_sessions[chat_id]["search_results"] = results
         user_sessions[chat_id]["search_query"] = search_query
 
@@ -2063,7 +4045,7 @@ async def handle_user_input(message: types.Message):
         user_sessions[chat_id]["waiting_title_search"] = False
 
         search_query = user_input
-        results = search_by_title(search_query)
+        results = await search_by_title(search_query)
 
         if not results:
             await message.answer("❌ Ничего не найдено")
@@ -2071,14 +4053,7 @@ async def handle_user_input(message: types.Message):
             return
 
         # ФИЛЬТРАЦИЯ ЗАБАНЕННОГО КОНТЕНТА
-        filtered_results = []
-        for item in results:
-            media_type = item.get("media_type")
-            if media_type in ["movie", "tv"]:
-                if not await is_banned(item["id"], media_type):
-                    filtered_results.append(item)
-            else:
-                filtered_results.append(item)  # Для person и других типов не проверяем бан
+        filtered_results = to_refs(await filter_banned(results))  # person и другие типы не проверяются
 
         if not filtered_results:
             await message.answer("❌ Все найденные результаты заблокированы администратором")
@@ -2177,6 +4152,8 @@ async def handle_user_input(message: types.Message):
                 await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
             await message.answer("✅ Фильтр года убран")
         else:
+            # Сессия могла истечь, пока пользователь вводил год: поднимаем фильтры из БД
+            await get_current_filters(chat_id)
             # Парсим ввод
             current_year = 2025
 
@@ -2255,7 +4232,7 @@ async def handle_user_input(message: types.Message):
         user_sessions[chat_id]["waiting_person_search"] = False
 
         search_query = user_input
-        results = search_by_person(search_query)
+        results = await search_by_person(search_query)
 
         if not results:
             await message.answer("❌ Ничего не найдено")
@@ -2263,6 +4240,7 @@ async def handle_user_input(message: types.Message):
             return
 
         # Сохраняем результаты в сессию
+        results = to_refs(results, "person")
         user_sessions[chat_id]["person_results"] = results
         user_sessions[chat_id]["person_query"] = search_query
         user_sessions[chat_id]["person_page"] = 0
@@ -2271,1587 +4249,1767 @@ async def handle_user_input(message: types.Message):
         return
 
 
+# -------------------- CALLBACK ROUTER --------------------
+class CallbackRouter:
+    """Маршрутизация callback_data: точное совпадение через dict, иначе самый длинный
+    зарегистрированный префикс через префиксное дерево. Считает вызовы и время по маршрутам"""
+
+    def __init__(self):
+        self.exact_routes: dict[str, tuple[str, object]] = {}
+        self.prefix_tree: dict = {}  # символ -> узел; маршрут узла хранится под ключом None
+        self.action_routes: dict[str, tuple[str, object]] = {}  # Действия с CallbackPayload
+        self.stats: dict[str, list] = {}  # маршрут -> [вызовов, суммарное время, максимум]
+        self.unmatched = 0
+        self.lookup_time = 0.0
+        self.lookups = 0
+
+    def exact(self, *keys: str):
+        """Регистрирует обработчик для точных значений callback_data"""
+        def decorator(handler):
+            for key in keys:
+                if key in self.exact_routes:
+                    raise ValueError(f"Маршрут {key!r} уже зарегистрирован")
+                self.exact_routes[key] = (key, handler)
+            return handler
+        return decorator
+
+    def prefix(self, *prefixes: str):
+        """Регистрирует обработчик для callback_data, начинающихся с префикса"""
+        def decorator(handler):
+            for prefix in prefixes:
+                node = self.prefix_tree
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                if None in node:
+                    raise ValueError(f"Префикс {prefix!r} уже зарегистрирован")
+                node[None] = (prefix + "*", handler)
+            return handler
+        return decorator
+
+    def action(self, name: str):
+        """Регистрирует обработчик действия над фильмом/сериалом. Обработчик получает
+        разобранный CallbackPayload вместо строки — и для новых кнопок, и для старых name_{id}_{type}"""
+        def decorator(handler):
+            route = (name, handler)
+            self.action_routes[name] = route
+            node = self.prefix_tree
+            for char in name + "_":
+                node = node.setdefault(char, {})
+            if None in node:
+                raise ValueError(f"Префикс {name!r} уже зарегистрирован")
+            node[None] = route
+            return handler
+        return decorator
+
+    def resolve(self, data: str):
+        """Возвращает (маршрут, обработчик) или None. Длина callback_data ограничена 64 байтами,
+        поэтому проход по дереву занимает ограниченное время"""
+        route = self.exact_routes.get(data)
+        if route is not None:
+            return route
+        node = self.prefix_tree
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(None, route)
+        return route
+
+    async def dispatch(self, callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int) -> bool:
+        started = time.perf_counter()
+        payload = None
+        if data.startswith(CALLBACK_MARKER):
+            payload = decode_callback(data)
+            route = self.action_routes.get(payload.action) if payload else None
+        else:
+            route = self.resolve(data)
+            if route is not None and route[0] in self.action_routes:
+                payload = parse_legacy_callback(data, route[0])
+        self.lookup_time += time.perf_counter() - started
+        self.lookups += 1
+        if route is None:
+            self.unmatched += 1
+            return False
+
+        name, handler = route
+        if name in self.action_routes:
+            if payload is None:
+                await callback.answer("Ошибка: некорректные данные.")
+                return True
+            data = payload
+        started = time.perf_counter()
+        try:
+            await handler(callback, chat_id, data, old_msg_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            st = self.stats.setdefault(name, [0, 0.0, 0.0])
+            st[0] += 1
+            st[1] += elapsed
+            st[2] = max(st[2], elapsed)
+        return True
+
+
+callback_router = CallbackRouter()
+
+
 @dp.callback_query()
 async def handle_callback(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     data = callback.data
     old_msg_id = callback.message.message_id
 
-    # В handle_callback добавьте:
-    if data == "already_in_collection":
-        await callback.answer("✅ Этот контент уже в вашей коллекции!")
-        return
+    if not await callback_router.dispatch(callback, chat_id, data, old_msg_id):
+        print(f"Неизвестный callback: {data}")
+        await callback.answer()
 
-    if data == "delete_message":
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
-        await callback.answer("❌ Действие отменено")
-        return
 
-    # В handle_callback добавьте:
-    if data == "friends_menu":
-        await navigate_to_menu(chat_id, old_msg_id, "👥 Система друзей:", kb_friends_menu())
-        return
+@callback_router.exact("already_in_collection")
+async def cb_already_in_collection(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer("✅ Этот контент уже в вашей коллекции!")
 
-    if data == "my_friends":
-        friends = await get_user_friends(chat_id)
-        if not friends:
-            await callback.answer("❌ У вас пока нет друзей")
-            await navigate_to_menu(
-                chat_id, old_msg_id,
-                "📭 У вас пока нет друзей. Добавьте друзей, чтобы вискать их рекомендации!",
-                InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
-                ])
-            )
-        else:
-            await navigate_to_menu(
-                chat_id, old_msg_id,
-                f"👥 Ваши друзья ({len(friends)}):",
-                kb_my_friends(friends, 0)
-            )
-        return
 
-    if data == "friends_recommendations":
-        # Используем улучшенную версию с тегами
-        recommendations = await get_friends_likes(
-            chat_id)  # или get_friends_likes_enhanced если выберете второй вариант
-        if not recommendations:
-            await callback.answer("❌ Нет рекомендаций от друзей")
-            await navigate_to_menu(
-                chat_id, old_msg_id,
-                "📭 Пока нет рекомендаций от друзей.\n\nДобавьте друзей и попросите их ставить лайки фильмам и сериалам!",
-                InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
-                ])
-            )
-            return
+@callback_router.exact("delete_message")
+async def cb_delete_message(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+    await callback.answer("❌ Действие отменено")
 
-        # Сохраняем рекомендации в сессию
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
 
-        user_sessions[chat_id]["friends_recommendations"] = recommendations
-        user_sessions[chat_id]["friends_rec_index"] = 0
+@callback_router.exact("friends_menu")
+async def cb_friends_menu(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(chat_id, old_msg_id, "👥 Система друзей:", kb_friends_menu())
 
-        await send_friend_recommendation_card(chat_id, old_msg_id)  # или send_friend_recommendation_card_enhanced
-        return
 
-    if data == "add_friend":
+@callback_router.exact("my_friends")
+async def cb_my_friends(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    friends = await get_user_friends(chat_id)
+    if not friends:
+        await callback.answer("❌ У вас пока нет друзей")
         await navigate_to_menu(
             chat_id, old_msg_id,
-            "👥 Чтобы добавить друга:\n\n"
-            "1. Попросите друга написать боту\n"
-            "2. Попросите друга отправить команду /myid\n"
-            "3. Отправьте мне ID вашего друга\n\n"
-            "Ваш ID для друзей:",
+            "📭 У вас пока нет друзей. Добавьте друзей, чтобы вискать их рекомендации!",
             InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔢 Узнать мой ID", callback_data="get_my_id")],
-                [InlineKeyboardButton(text="🔢 Ввести ID друга", callback_data="input_friend_id")],
-                [InlineKeyboardButton(text="📨 Мои заявки", callback_data="friend_requests")],
+                [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
                 [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
             ])
         )
-        return
-
-    if data == "friend_requests":
-        requests = await get_pending_friend_requests(chat_id)
-        if not requests:
-            await callback.answer("❌ Нет входящих заявок")
-            await navigate_to_menu(
-                chat_id, old_msg_id,
-                "📭 Нет входящих заявок в друзья",
-                InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
-                ])
-            )
-            return
+    else:
+        await navigate_to_menu(
+            chat_id, old_msg_id,
+            f"👥 Ваши друзья ({len(friends)}):",
+            kb_my_friends(friends, 0)
+        )
 
-        text = "📨 Входящие заявки в друзья:\n\n"
-        keyboard = []
 
-        for req in requests:
-            username = req['username'] or f"Пользователь {req['tg_id']}"
-            text += f"👤 {username}\n"
-            keyboard.append([
-                InlineKeyboardButton(text=f"✅ Принять {username}", callback_data=f"accept_request_{req['request_id']}"),
-                InlineKeyboardButton(text=f"❌ Отклонить", callback_data=f"reject_request_{req['request_id']}")
+@callback_router.exact("friends_recommendations")
+async def cb_friends_recommendations(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    recommendations = await get_friends_likes(
+        chat_id)  # или get_friends_likes_enhanced если выберете второй вариант
+    if not recommendations:
+        await callback.answer("❌ Нет рекомендаций от друзей")
+        await navigate_to_menu(
+            chat_id, old_msg_id,
+            "📭 Пока нет рекомендаций от друзей.\n\nДобавьте друзей и попросите их ставить лайки фильмам и сериалам!",
+            InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
             ])
+        )
+        return
 
-        keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")])
+    # Сохраняем рекомендации в сессию
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+
+    user_sessions[chat_id]["friends_recommendations"] = recommendations
+    user_sessions[chat_id]["friends_rec_index"] = 0
+
+    await send_friend_recommendation_card(chat_id, old_msg_id)  # или send_friend_recommendation_card_enhanced
+
+
+@callback_router.exact("add_friend")
+async def cb_add_friend(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(
+        chat_id, old_msg_id,
+        "👥 Чтобы добавить друга:\n\n"
+        "1. Попросите друга написать боту\n"
+        "2. Попросите друга отправить команду /myid\n"
+        "3. Отправьте мне ID вашего друга\n\n"
+        "Ваш ID для друзей:",
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔢 Узнать мой ID", callback_data="get_my_id")],
+            [InlineKeyboardButton(text="🔢 Ввести ID друга", callback_data="input_friend_id")],
+            [InlineKeyboardButton(text="📨 Мои заявки", callback_data="friend_requests")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
+        ])
+    )
 
+
+@callback_router.exact("friend_requests")
+async def cb_friend_requests(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    requests = await get_pending_friend_requests(chat_id)
+    if not requests:
+        await callback.answer("❌ Нет входящих заявок")
         await navigate_to_menu(
             chat_id, old_msg_id,
-            text,
-            InlineKeyboardMarkup(inline_keyboard=keyboard)
+            "📭 Нет входящих заявок в друзья",
+            InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
+            ])
         )
         return
 
-    if data.startswith("accept_request_"):
-        request_id = int(data.split("_")[2])
-        result = await accept_friend_request(request_id)
+    text = "📨 Входящие заявки в друзья:\n\n"
+    keyboard = []
 
-        if result:
-            await callback.answer("✅ Заявка принята!")
-            # Обновляем меню
-            await navigate_to_menu(
-                chat_id, old_msg_id,
-                "✅ Заявка в друзья принята!",
-                InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="👥 К друзьям", callback_data="friends_menu")]
-                ])
-            )
-        else:
-            await callback.answer("❌ Ошибка при принятии заявки")
-        return
+    for req in requests:
+        username = req['username'] or f"Пользователь {req['tg_id']}"
+        text += f"👤 {username}\n"
+        keyboard.append([
+            InlineKeyboardButton(text=f"✅ Принять {username}", callback_data=f"accept_request_{req['request_id']}"),
+            InlineKeyboardButton(text=f"❌ Отклонить", callback_data=f"reject_request_{req['request_id']}")
+        ])
 
-    if data.startswith("reject_request_"):
-        request_id = int(data.split("_")[2])
-        # Просто удаляем заявку
-        async with db.acquire() as conn:
-            await conn.execute("DELETE FROM friend_requests WHERE request_id = $1", request_id)
+    keyboard.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")])
+
+    await navigate_to_menu(
+        chat_id, old_msg_id,
+        text,
+        InlineKeyboardMarkup(inline_keyboard=keyboard)
+    )
 
-        await callback.answer("❌ Заявка отклонена")
+
+@callback_router.prefix("accept_request_")
+async def cb_accept_request(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    request_id = int(data.split("_")[2])
+    result = await accept_friend_request(request_id)
+
+    if result:
+        await callback.answer("✅ Заявка принята!")
+        # Обновляем меню
         await navigate_to_menu(
             chat_id, old_msg_id,
-            "❌ Заявка в друзья отклонена",
+            "✅ Заявка в друзья принята!",
             InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="👥 К друзьям", callback_data="friends_menu")]
             ])
         )
-        return
+    else:
+        await callback.answer("❌ Ошибка при принятии заявки")
 
 
+@callback_router.prefix("reject_request_")
+async def cb_reject_request(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    request_id = int(data.split("_")[2])
+    # Просто удаляем заявку
+    async with db.acquire() as conn:
+        await conn.execute("DELETE FROM friend_requests WHERE request_id = $1", request_id)
+
+    await callback.answer("❌ Заявка отклонена")
+    await navigate_to_menu(
+        chat_id, old_msg_id,
+        "❌ Заявка в друзья отклонена",
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="👥 К друзьям", callback_data="friends_menu")]
+        ])
+    )
 
-    # Добавь этот обработчик
-    if data == "get_my_id":
-        await callback.answer(f"🆔 Ваш ID: {chat_id}\n\nПоделитесь этим ID с друзьями!", show_alert=True)
-        return
 
-    if data == "input_friend_id":
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["waiting_friend_id"] = True
+# Добавь этот обработчик
+@callback_router.exact("get_my_id")
+async def cb_get_my_id(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer(f"🆔 Ваш ID: {chat_id}\n\nПоделитесь этим ID с друзьями!", show_alert=True)
 
-        await callback.message.edit_text(  # ← ИСПРАВЛЕНО: edit_text вместо answer
-            "🔢 Введите ID вашего друга:",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="❌ Отмена", callback_data="friends_menu")]
-            ])
-        )
-        return
 
-    if data == "next_friend_rec":
-        await send_friend_recommendation_card(chat_id, old_msg_id)
-        return
+@callback_router.exact("input_friend_id")
+async def cb_input_friend_id(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["waiting_friend_id"] = True
 
-    if data == "search_filters":
-        # Инициализируем фильтры если их нет
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        if "filters" not in user_sessions[chat_id]:
-            # Пробуем загрузить сохраненные фильтры
-            saved_filters = await load_search_filters(chat_id)
-            user_sessions[chat_id]["filters"] = saved_filters
+    await callback.message.edit_text(  # ← ИСПРАВЛЕНО: edit_text вместо answer
+        "🔢 Введите ID вашего друга:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="friends_menu")]
+        ])
+    )
 
-        current_filters = user_sessions[chat_id]["filters"]
-        await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
-        return
 
-    if data == "search_by_title":
-        # Сохраняем состояние ожидания ввода
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["waiting_title_search"] = True
+@callback_router.exact("next_friend_rec")
+async def cb_next_friend_rec(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await send_friend_recommendation_card(chat_id, old_msg_id)
 
-        await navigate_to_menu(
-            chat_id,
-            old_msg_id,
-            "🔍 Введите название фильма или сериала для поиска:",
-            InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")]
-            ])
-        )
+
+@callback_router.exact("search_filters")
+async def cb_search_filters(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    if "filters" not in user_sessions[chat_id]:
+        # Пробуем загрузить сохраненные фильтры
+        saved_filters = await load_search_filters(chat_id)
+        user_sessions[chat_id]["filters"] = saved_filters
+
+    current_filters = user_sessions[chat_id]["filters"]
+    await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
+
+
+@callback_router.exact("search_by_title")
+async def cb_search_by_title(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["waiting_title_search"] = True
+
+    await navigate_to_menu(
+        chat_id,
+        old_msg_id,
+        "🔍 Введите название фильма или сериала для поиска:",
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")]
+        ])
+    )
+
+
+@callback_router.exact("search_by_person")
+async def cb_search_by_person(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["waiting_person_search"] = True
+
+    await navigate_to_menu(
+        chat_id,
+        old_msg_id,
+        "🎭 Введите имя актера или режиссера:",
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")]
+        ])
+    )
+
+
+@callback_router.exact("admin_ban_list")
+async def cb_admin_ban_list(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # В handle_callback добавьте:
-    if data == "search_by_person":
-        # Сохраняем состояние ожидания ввода
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["waiting_person_search"] = True
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        await navigate_to_menu(
-            chat_id,
-            old_msg_id,
-            "🎭 Введите имя актера или режиссера:",
-            InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")]
+    banned_list = await get_banned_list(100)  # увеличиваем лимит
+    if not banned_list:
+        await callback.message.answer(
+            "📭 Список банов пуст",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")]
             ])
         )
         return
 
+    # Отправляем первую страницу
+    await send_banned_page(chat_id, banned_list, 0)
 
 
-    if data == "admin_ban_list":
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
-
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+# Добавляем обработчик для страниц
+@callback_router.prefix("ban_page_")
+async def cb_ban_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
+        return
 
-        banned_list = await get_banned_list(100)  # увеличиваем лимит
-        if not banned_list:
-            await callback.message.answer(
-                "📭 Список банов пуст",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")]
-                ])
-            )
-            return
+    page = int(data.split("_")[2])
+    banned_list = await get_banned_list(100)
 
-        # Отправляем первую страницу
-        await send_banned_page(chat_id, banned_list, 0)
+    if not banned_list:
+        await callback.answer("❌ Список банов пуст")
         return
 
-    # Добавляем обработчик для страниц
-    if data.startswith("ban_page_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    await callback.message.edit_text(
+        **format_banned_page(banned_list, page),
+        reply_markup=kb_banned_pagination(banned_list, page)
+    )
 
-        page = int(data.split("_")[2])
-        banned_list = await get_banned_list(100)
 
-        if not banned_list:
-            await callback.answer("❌ Список банов пуст")
-            return
+@callback_router.prefix("admin_search_page_")
+async def cb_admin_search_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
+        return
 
-        await callback.message.edit_text(
-            **format_banned_page(banned_list, page),
-            reply_markup=kb_banned_pagination(banned_list, page)
-        )
+    page = int(data.split("_")[3])
+
+    # Получаем сохраненные результаты поиска
+    if "search_results" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    if data.startswith("admin_search_page_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    search_results = user_sessions[chat_id]["search_results"]
+    search_query = user_sessions[chat_id].get("search_query", "")
 
-        page = int(data.split("_")[3])
+    await callback.message.edit_text(
+        f"🔍 Найдено {len(search_results)} результатов по запросу: '{search_query}'\nСтраница {page + 1}",
+        reply_markup=kb_search_results(search_results, search_query, page=page)
+    )
 
-        # Получаем сохраненные результаты поиска
-        if "search_results" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Результаты поиска устарели")
-            return
 
-        search_results = user_sessions[chat_id]["search_results"]
-        search_query = user_sessions[chat_id].get("search_query", "")
+@callback_router.prefix("filmography_page_")
+async def cb_filmography_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    page = int(data.split("_")[2])
 
-        await callback.message.edit_text(
-            f"🔍 Найдено {len(search_results)} результатов по запросу: '{search_query}'\nСтраница {page + 1}",
-            reply_markup=kb_search_results(search_results, search_query, page=page)
-        )
+    if "filmography" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Фильмография не найдена")
         return
 
+    filmography = user_sessions[chat_id]["filmography"]
+    person_name = user_sessions[chat_id].get("filmography_person_name", "Актер")
 
+    # Обновляем страницу в сессии
+    user_sessions[chat_id]["filmography_page"] = page
 
-    if data.startswith("filmography_page_"):
-        page = int(data.split("_")[2])
-
-        if "filmography" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Фильмография не найдена")
-            return
+    text, keyboard = await send_person_filmography_page(
+        chat_id, filmography, person_name, page
+    )
 
-        filmography = user_sessions[chat_id]["filmography"]
-        person_name = user_sessions[chat_id].get("filmography_person_name", "Актер")
+    await callback.message.edit_text(text, reply_markup=keyboard)
 
-        # Обновляем страницу в сессии
-        user_sessions[chat_id]["filmography_page"] = page
 
-        text, keyboard = await send_person_filmography_page(
-            chat_id, filmography, person_name, page
-        )
+@callback_router.prefix("select_person_")
+async def cb_select_person(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    person_id = int(data.split("_")[2])
 
-        await callback.message.edit_text(text, reply_markup=keyboard)
+    # Получаем информацию об актере для отображения имени
+    person_results = user_sessions.get(chat_id, {}).get("person_results")
+    if person_results is None:
+        await callback.answer("❌ Сессия истекла. Начните поиск заново.")
         return
+    person_info = next((p for p in person_results if p.id == person_id), None)
+    person_name = person_info.title if person_info else "Актер"
 
-    # В handle_callback добавьте:
-    if data.startswith("select_person_"):
-        person_id = int(data.split("_")[2])
+    # Получаем фильмографию актера
+    filmography = await get_person_filmography(person_id)
 
-        # Получаем информацию об актере для отображения имени
-        person_results = user_sessions[chat_id]["person_results"]
-        person_info = next((p for p in person_results if p["id"] == person_id), None)
-        person_name = person_info.get("name", "Актер") if person_info else "Актер"
+    if not filmography:
+        await callback.answer("❌ Не удалось загрузить фильмографию или все работы заблокированы")
+        return
 
-        # Получаем фильмографию актера
-        filmography = await get_person_filmography(person_id)  # ДОБАВЬТЕ await
+    # Сохраняем фильмографию в сессию
+    filmography = to_refs(filmography)
+    user_sessions[chat_id]["filmography"] = filmography
+    user_sessions[chat_id]["filmography_person_name"] = person_name
+    user_sessions[chat_id]["filmography_page"] = 0
+    user_sessions[chat_id]["filmography_person_id"] = person_id
 
-        if not filmography:
-            await callback.answer("❌ Не удалось загрузить фильмографию или все работы заблокированы")
-            return
+    # Отправляем первую страницу фильмографии
+    text, keyboard = await send_person_filmography_page(
+        chat_id, filmography, person_name, 0
+    )
+
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        # Сохраняем фильмографию в сессию
-        user_sessions[chat_id]["filmography"] = filmography
-        user_sessions[chat_id]["filmography_person_name"] = person_name
-        user_sessions[chat_id]["filmography_page"] = 0
-        user_sessions[chat_id]["filmography_person_id"] = person_id
+    await bot.send_message(chat_id, text, reply_markup=keyboard)
 
-        # Отправляем первую страницу фильмографии
-        text, keyboard = await send_person_filmography_page(
-            chat_id, filmography, person_name, 0
-        )
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+# Обработчик пагинации для поиска актеров
+@callback_router.prefix("person_page_")
+async def cb_person_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    page = int(data.split("_")[2])
 
-        await bot.send_message(chat_id, text, reply_markup=keyboard)
+    if "person_results" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    # Обработчик пагинации для поиска актеров
-    # В handle_callback добавьте обработчик пагинации:
-    if data.startswith("person_page_"):
-        page = int(data.split("_")[2])
+    person_results = user_sessions[chat_id]["person_results"]
+    person_query = user_sessions[chat_id].get("person_query", "")
 
-        if "person_results" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Результаты поиска устарели")
-            return
+    # Обновляем страницу в сессии
+    user_sessions[chat_id]["person_page"] = page
 
-        person_results = user_sessions[chat_id]["person_results"]
-        person_query = user_sessions[chat_id].get("person_query", "")
+    await send_person_results_page(chat_id, person_results, person_query, page)
 
-        # Обновляем страницу в сессии
-        user_sessions[chat_id]["person_page"] = page
 
-        await send_person_results_page(chat_id, person_results, person_query, page)
+# Пагинация поиска
+@callback_router.prefix("search_page_")
+async def cb_search_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    page = int(data.split("_")[2])
+
+    print(f"DEBUG: search_page_ called, page={page}, chat_id={chat_id}")
+    print(f"DEBUG: user_sessions keys: {list(user_sessions.get(chat_id, {}).keys())}")
+
+    if "search_results" not in user_sessions.get(chat_id, {}):
+        print(f"DEBUG: search_results not found in session!")
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    # Пагинация поиска
-    if data.startswith("search_page_"):
-        page = int(data.split("_")[2])
+    search_results = user_sessions[chat_id]["search_results"]
+    search_query = user_sessions[chat_id].get("search_query", "")
 
-        print(f"DEBUG: search_page_ called, page={page}, chat_id={chat_id}")
-        print(f"DEBUG: user_sessions keys: {list(user_sessions.get(chat_id, {}).keys())}")
+    # Обновляем страницу в сессии
+    user_sessions[chat_id]["search_page"] = page
 
-        if "search_results" not in user_sessions.get(chat_id, {}):
-            print(f"DEBUG: search_results not found in session!")
-            await callback.answer("❌ Результаты поиска устарели")
-            return
+    # ИСПОЛЬЗУЕМ ЛОГИКУ ИЗ send_search_results_page (а не kb_search_results)
+    total_results = len(search_results)
+    results_per_page = 10
+    start_idx = page * results_per_page
+    end_idx = start_idx + results_per_page
+    page_results = search_results[start_idx:end_idx]
+
+    text = f"🔍 Найдено {total_results} результатов по запросу: '{search_query}'\nСтраница {page + 1}/{(total_results + results_per_page - 1) // results_per_page}\n\nВыберите:"
+
+    keyboard = []
 
-        search_results = user_sessions[chat_id]["search_results"]
-        search_query = user_sessions[chat_id].get("search_query", "")
+    for item in page_results:
+        if item.media_type in ["movie", "tv"]:
+            btn_text = f"{'🎬' if item.media_type == 'movie' else '📺'} {item.title}"
+            if item.year:
+                btn_text += f" ({item.year})"
+
+            keyboard.append([
+                InlineKeyboardButton(
+                    text=btn_text,
+                    callback_data=encode_callback("select", item.id, item.media_type)  # ВАЖНО: select_ для обычного поиска
+                )
+            ])
 
-        # Обновляем страницу в сессии
-        user_sessions[chat_id]["search_page"] = page
+    # Пагинация
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"search_page_{page - 1}"))
+    if end_idx < total_results:
+        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"search_page_{page + 1}"))
 
-        # ИСПОЛЬЗУЕМ ЛОГИКУ ИЗ send_search_results_page (а не kb_search_results)
-        total_results = len(search_results)
-        results_per_page = 10
-        start_idx = page * results_per_page
-        end_idx = start_idx + results_per_page
-        page_results = search_results[start_idx:end_idx]
+    if nav_buttons:
+        keyboard.append(nav_buttons)
 
-        text = f"🔍 Найдено {total_results} результатов по запросу: '{search_query}'\nСтраница {page + 1}/{(total_results + results_per_page - 1) // results_per_page}\n\nВыберите:"
+    keyboard.append([InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_by_title")])
+    keyboard.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
 
-        keyboard = []
+    await callback.message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+    )
 
-        for item in page_results:
-            media_type = item.get("media_type")
-            title = item.get("title") or item.get("name")
-            year = (item.get("release_date") or item.get("first_air_date") or "")[:4]
-
-            if media_type in ["movie", "tv"]:
-                btn_text = f"{'🎬' if media_type == 'movie' else '📺'} {title}"
-                if year:
-                    btn_text += f" ({year})"
-
-                keyboard.append([
-                    InlineKeyboardButton(
-                        text=btn_text,
-                        callback_data=f"select_{item['id']}_{media_type}"  # ВАЖНО: select_ для обычного поиска
-                    )
-                ])
 
-        # Пагинация
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"search_page_{page - 1}"))
-        if end_idx < total_results:
-            nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"search_page_{page + 1}"))
+# ДОБАВЬТЕ ЭТОТ ОБРАБОТЧИК - ОН ОТСУТСТВУЕТ В ВАШЕМ КОДЕ!
+@callback_router.action("select")
+async def cb_select(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    print(f"🟢 SELECT handler called: {data}")
 
-        if nav_buttons:
-            keyboard.append(nav_buttons)
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-        keyboard.append([InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_by_title")])
-        keyboard.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        print("Не удалось удалить сообщение с результатами поиска")
 
-        await callback.message.edit_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-        )
+    # Получаем детали фильма/сериала
+    details = await get_item_details(type_, tmdb_id)
+    if not details:
+        await callback.answer("❌ Не удалось загрузить данные")
         return
 
-    # ДОБАВЬТЕ ЭТОТ ОБРАБОТЧИК - ОН ОТСУТСТВУЕТ В ВАШЕМ КОДЕ!
-    if data.startswith("select_"):
-        print(f"🟢 SELECT handler called: {data}")
+    title = details.get("title") or details.get("name") or "Без названия"
+    year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+    rating = details.get("vote_average") or "—"
+    overview = details.get("overview") or "Описание отсутствует."
+    if len(overview) > 2000:
+        overview = overview[:2000] + "..."
+    poster = details.get("poster_path")
+    avg_ratings = await get_ratings(tmdb_id, type_)
 
-        parts = data.split("_")
-        if len(parts) < 3:
-            await callback.answer("❌ Ошибка: некорректные данные.")
-            return
+    # Определяем все роли человека в этом проекте
+    roles = set()
 
-        try:
-            tmdb_id = int(parts[1])
-            type_ = parts[2]
-            print(f"DEBUG: tmdb_id={tmdb_id}, type_={type_}")
-        except (ValueError, IndexError) as e:
-            await callback.answer("❌ Ошибка данных.")
-            return
+    # Проверяем, пришли ли мы из поиска по актерам
+    if "filmography" in user_sessions.get(chat_id, {}):
+        filmography = user_sessions[chat_id]["filmography"]
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            print("Не удалось удалить сообщение с результатами поиска")
+        # Собираем все роли для этого проекта
+        for item in filmography:
+            if item.id == tmdb_id and item.media_type == type_:
+                for role in item.roles:
+                    if role == "director":
+                        roles.add("🎬 Режиссер")
+                    elif role == "actor":
+                        roles.add("🎭 Актер")
+
+    # Формируем информацию о ролях
+    role_info = ""
+    if roles:
+        role_info = ", ".join(sorted(roles)) + "\n"
+
+    # Формируем caption с информацией о ролях
+    caption = (
+        f"{title} ({year})\n"
+        f"{role_info}"
+        f"Рейтинг: {rating} (TMDB)\n"
+        f"👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n\n{overview}"
+    )
 
-        # Получаем детали фильма/сериала
-        details = get_item_details(type_, tmdb_id)
-        if not details:
-            await callback.answer("❌ Не удалось загрузить данные")
-            return
+    # Определяем, откуда пришли - из поиска или из фильмографии
+    is_from_filmography = "filmography" in user_sessions.get(chat_id, {})
 
-        title = details.get("title") or details.get("name") or "Без названия"
-        year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
-        rating = details.get("vote_average") or "—"
-        overview = details.get("overview") or "Описание отсутствует."
-        if len(overview) > 2000:
-            overview = overview[:2000] + "..."
-        poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
-        avg_ratings = await get_ratings(tmdb_id, type_)
-
-        # Определяем все роли человека в этом проекте
-        roles = set()
-
-        # Проверяем, пришли ли мы из поиска по актерам
-        if "filmography" in user_sessions.get(chat_id, {}):
-            filmography = user_sessions[chat_id]["filmography"]
-
-            # Собираем все роли для этого проекта
-            for item in filmography:
-                if item.get("id") == tmdb_id and item.get("media_type") == type_:
-                    item_roles = item.get("person_role", [])  # Теперь это список ролей
-                    for role in item_roles:
-                        if role == "director":
-                            roles.add("🎬 Режиссер")
-                        elif role == "actor":
-                            roles.add("🎭 Актер")
-
-        # Формируем информацию о ролях
-        role_info = ""
-        if roles:
-            role_info = ", ".join(sorted(roles)) + "\n"
-
-        # Формируем caption с информацией о ролях
-        caption = (
-            f"{title} ({year})\n"
-            f"{role_info}"
-            f"Рейтинг: {rating} (TMDB)\n"
-            f"👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n\n{overview}"
-        )
+    if is_from_filmography:
+        # Проверяем, находится ли контент в коллекции
+        is_in_collection = await is_in_user_collection(chat_id, tmdb_id, type_)
 
-        # Определяем, откуда пришли - из поиска или из фильмографии
-        is_from_filmography = "filmography" in user_sessions.get(chat_id, {})
+        # Клавиатура для фильмографии
+        buttons = []
 
-        if is_from_filmography:
-            # Проверяем, находится ли контент в коллекции
-            is_in_collection = await is_in_user_collection(chat_id, tmdb_id, type_)
+        if is_in_collection:
+            buttons.append([
+                InlineKeyboardButton(text="✅ В коллекции", callback_data=f"already_in_collection"),
+            ])
+        else:
+            buttons.append([
+                InlineKeyboardButton(text="➕ В коллекцию", callback_data=encode_callback("add", tmdb_id, type_)),
+            ])
 
-            # Клавиатура для фильмографии
-            buttons = []
+        buttons.append([InlineKeyboardButton(text="🎯 Похожее", callback_data=encode_callback("similar", tmdb_id, type_))])
+        buttons.append([InlineKeyboardButton(text="⬅️ К фильмографии", callback_data="back_to_filmography")])
+        buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
 
-            if is_in_collection:
-                buttons.append([
-                    InlineKeyboardButton(text="✅ В коллекции", callback_data=f"already_in_collection"),
-                ])
-            else:
-                buttons.append([
-                    InlineKeyboardButton(text="➕ В коллекцию", callback_data=f"add_{tmdb_id}_{type_}"),
-                ])
+        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    else:
+        # Проверяем, находится ли контент в коллекции
+        is_in_collection = await is_in_user_collection(chat_id, tmdb_id, type_)
 
-            buttons.append([InlineKeyboardButton(text="🎯 Похожее", callback_data=f"similar_{tmdb_id}_{type_}")])
-            buttons.append([InlineKeyboardButton(text="⬅️ К фильмографии", callback_data="back_to_filmography")])
-            buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
+        # Клавиатура для обычного поиска
+        buttons = []
 
-            keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+        if is_in_collection:
+            buttons.append([
+                InlineKeyboardButton(text="✅ В коллекции", callback_data=f"already_in_collection"),
+            ])
         else:
-            # Проверяем, находится ли контент в коллекции
-            is_in_collection = await is_in_user_collection(chat_id, tmdb_id, type_)
+            buttons.append([
+                InlineKeyboardButton(text="➕ В коллекцию", callback_data=encode_callback("add", tmdb_id, type_)),
+            ])
 
-            # Клавиатура для обычного поиска
-            buttons = []
+        buttons.append([InlineKeyboardButton(text="🎯 Похожее", callback_data=encode_callback("similar", tmdb_id, type_))])
+        buttons.append([InlineKeyboardButton(text="⬅️ К результатам", callback_data="back_to_search_results")])
+        buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
 
-            if is_in_collection:
-                buttons.append([
-                    InlineKeyboardButton(text="✅ В коллекции", callback_data=f"already_in_collection"),
-                ])
-            else:
-                buttons.append([
-                    InlineKeyboardButton(text="➕ В коллекцию", callback_data=f"add_{tmdb_id}_{type_}"),
-                ])
+        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-            buttons.append([InlineKeyboardButton(text="🎯 Похожее", callback_data=f"similar_{tmdb_id}_{type_}")])
-            buttons.append([InlineKeyboardButton(text="⬅️ К результатам", callback_data="back_to_search_results")])
-            buttons.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")])
+    if poster:
+        await send_poster(chat_id, poster, caption=caption, reply_markup=keyboard)
+    else:
+        await callback.message.answer(text=caption, reply_markup=keyboard)
 
-            keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-        if poster:
-            await callback.message.answer_photo(photo=poster, caption=caption, reply_markup=keyboard)
-        else:
-            await callback.message.answer(text=caption, reply_markup=keyboard)
-        return
+# Кнопка "Похожее"
+@callback_router.action("similar")
+async def cb_similar(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-    # Кнопка "Похожее"
-    if data.startswith("similar_"):
-        parts = data.split("_")
-        tmdb_id = int(parts[1])
-        type_ = parts[2]
+    # Сохраняем в сессию для рекомендаций
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
 
-        # Сохраняем в сессию для рекомендаций
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
+    user_sessions[chat_id]["user_likes"] = [{"tmdb_id": tmdb_id, "type": type_}]
+    user_sessions[chat_id]["type"] = "preferences"
+    user_sessions[chat_id]["shown_recommendations"] = []  # очищаем список показанных
 
-        user_sessions[chat_id]["user_likes"] = [{"tmdb_id": tmdb_id, "type": type_}]
-        user_sessions[chat_id]["type"] = "preferences"
-        user_sessions[chat_id]["shown_recommendations"] = []  # очищаем список показанных
+    await send_preference_item(chat_id, callback.message.message_id)
 
-        await send_preference_item(chat_id, callback.message.message_id)
+
+# Назад к результатам поиска
+# Назад к результатам поиска
+@callback_router.exact("back_to_search_results")
+async def cb_back_to_search_results(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if "search_results" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    # Назад к результатам поиска
-    # Назад к результатам поиска
-    if data == "back_to_search_results":
-        if "search_results" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Результаты поиска устарели")
-            return
+    search_results = user_sessions[chat_id]["search_results"]
+    search_query = user_sessions[chat_id].get("search_query", "")
+    search_page = user_sessions[chat_id].get("search_page", 0)
 
-        search_results = user_sessions[chat_id]["search_results"]
-        search_query = user_sessions[chat_id].get("search_query", "")
-        search_page = user_sessions[chat_id].get("search_page", 0)
+    # УДАЛЯЕМ сообщение с карточкой фильма
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+
+    await send_search_results_page(chat_id, search_results, search_query, search_page)
 
-        # УДАЛЯЕМ сообщение с карточкой фильма
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
 
-        await send_search_results_page(chat_id, search_results, search_query, search_page)
+@callback_router.exact("back_to_filmography")
+async def cb_back_to_filmography(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if "filmography" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Фильмография не найдена")
         return
 
-    if data == "back_to_filmography":
-        if "filmography" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Фильмография не найдена")
-            return
+    filmography = user_sessions[chat_id]["filmography"]
+    person_name = user_sessions[chat_id].get("filmography_person_name", "Актер")
+    filmography_page = user_sessions[chat_id].get("filmography_page", 0)
 
-        filmography = user_sessions[chat_id]["filmography"]
-        person_name = user_sessions[chat_id].get("filmography_person_name", "Актер")
-        filmography_page = user_sessions[chat_id].get("filmography_page", 0)
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    text, keyboard = await send_person_filmography_page(
+        chat_id, filmography, person_name, filmography_page
+    )
 
-        text, keyboard = await send_person_filmography_page(
-            chat_id, filmography, person_name, filmography_page
-        )
+    await bot.send_message(chat_id, text, reply_markup=keyboard)
 
-        await bot.send_message(chat_id, text, reply_markup=keyboard)
+
+@callback_router.exact("back_to_person_results")
+async def cb_back_to_person_results(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if "person_results" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    # В handle_callback добавьте:
-    if data == "back_to_person_results":
-        if "person_results" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Результаты поиска устарели")
-            return
+    person_results = user_sessions[chat_id]["person_results"]
+    person_query = user_sessions[chat_id].get("person_query", "")
+    person_page = user_sessions[chat_id].get("person_page", 0)
 
-        person_results = user_sessions[chat_id]["person_results"]
-        person_query = user_sessions[chat_id].get("person_query", "")
-        person_page = user_sessions[chat_id].get("person_page", 0)
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+
+    await send_person_results_page(chat_id, person_results, person_query, person_page)
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
 
-        await send_person_results_page(chat_id, person_results, person_query, person_page)
+@callback_router.exact("back_to_person_list")
+async def cb_back_to_person_list(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if "person_results" not in user_sessions.get(chat_id, {}):
+        await callback.answer("❌ Результаты поиска устарели")
         return
 
-    if data == "back_to_person_list":
-        if "person_results" not in user_sessions.get(chat_id, {}):
-            await callback.answer("❌ Результаты поиска устарели")
-            return
+    person_results = user_sessions[chat_id]["person_results"]
+    person_query = user_sessions[chat_id].get("person_query", "")
+    person_page = user_sessions[chat_id].get("person_page", 0)
 
-        person_results = user_sessions[chat_id]["person_results"]
-        person_query = user_sessions[chat_id].get("person_query", "")
-        person_page = user_sessions[chat_id].get("person_page", 0)
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    await send_person_results_page(chat_id, person_results, person_query, person_page)
 
-        await send_person_results_page(chat_id, person_results, person_query, person_page)
-        return
 
-    # Просмотр профиля друга
-    if data.startswith("friend_"):
-        try:
-            friend_tg_id = int(data.split("_")[1])
+# Просмотр профиля друга
+@callback_router.prefix("friend_")
+async def cb_friend(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        friend_tg_id = int(data.split("_")[1])
 
-            # Получаем информацию о друге
-            async with db.acquire() as conn:
-                # Получаем основную информацию о друге
-                friend = await conn.fetchrow("""
+        # Получаем информацию о друге
+        async with db.acquire() as conn:
+            # Получаем основную информацию о друге
+            friend = await conn.fetchrow("""
                     SELECT tg_id, username 
                     FROM users 
                     WHERE tg_id = $1
                 """, friend_tg_id)
 
-                if not friend:
-                    await callback.answer("❌ Друг не найден")
-                    return
+            if not friend:
+                await callback.answer("❌ Друг не найден")
+                return
 
-                friend_name = friend['username'] or f"Пользователь {friend_tg_id}"
+            friend_name = friend['username'] or f"Пользователь {friend_tg_id}"
+            user_id = await get_user_id(conn, chat_id)
+            friend_user_id = await get_user_id(conn, friend_tg_id)
 
-                # Получаем дату добавления в друзья
-                friendship_data = await conn.fetchrow("""
+            # Получаем дату добавления в друзья
+            friendship_data = await conn.fetchrow("""
                     SELECT created_at 
                     FROM user_friends 
-                    WHERE user_id = (SELECT user_id FROM users WHERE tg_id = $1)
-                    AND friend_user_id = (SELECT user_id FROM users WHERE tg_id = $2)
-                """, chat_id, friend_tg_id)
+                    WHERE user_id = $1
+                    AND friend_user_id = $2
+                """, user_id, friend_user_id)
 
-                # Получаем статистику друга
-                friend_stats = await conn.fetchrow("""
+            # Получаем статистику друга
+            friend_stats = await conn.fetchrow("""
                     SELECT 
                         COUNT(CASE WHEN liked = TRUE THEN 1 END) as likes_count,
                         COUNT(CASE WHEN watched = TRUE THEN 1 END) as watched_count
                     FROM ratings 
-                    WHERE user_id = (SELECT user_id FROM users WHERE tg_id = $1)
-                """, friend_tg_id)
+                    WHERE user_id = $1
+                """, friend_user_id)
 
-                likes_count = friend_stats['likes_count'] if friend_stats else 0
-                watched_count = friend_stats['watched_count'] if friend_stats else 0
-
-                # Форматируем время в друзьях
-                if friendship_data and friendship_data['created_at']:
-                    from datetime import datetime
-                    created_at = friendship_data['created_at']
-                    now = datetime.now()
-
-                    # Точное вычисление разницы в годах, месяцах и днях
-                    def calculate_time_diff(start_date, end_date):
-                        years = end_date.year - start_date.year
-                        months = end_date.month - start_date.month
-                        days = end_date.day - start_date.day
-
-                        # Корректируем отрицательные значения
-                        if days < 0:
-                            # Занимаем дни из предыдущего месяца
-                            months -= 1
-                            # Находим сколько дней в предыдущем месяце
-                            if start_date.month == 1:
-                                prev_month_days = 31  # Декабрь
-                            else:
-                                import calendar
-                                prev_month_days = calendar.monthrange(start_date.year, start_date.month - 1)[1]
-                            days += prev_month_days
+            likes_count = friend_stats['likes_count'] if friend_stats else 0
+            watched_count = friend_stats['watched_count'] if friend_stats else 0
 
-                        if months < 0:
-                            years -= 1
-                            months += 12
+            # Форматируем время в друзьях
+            if friendship_data and friendship_data['created_at']:
+                from datetime import datetime
+                created_at = friendship_data['created_at']
+                now = datetime.now()
+
+                # Точное вычисление разницы в годах, месяцах и днях
+                def calculate_time_diff(start_date, end_date):
+                    years = end_date.year - start_date.year
+                    months = end_date.month - start_date.month
+                    days = end_date.day - start_date.day
+
+                    # Корректируем отрицательные значения
+                    if days < 0:
+                        # Занимаем дни из предыдущего месяца
+                        months -= 1
+                        # Находим сколько дней в предыдущем месяце
+                        if start_date.month == 1:
+                            prev_month_days = 31  # Декабрь
+                        else:
+                            import calendar
+                            prev_month_days = calendar.monthrange(start_date.year, start_date.month - 1)[1]
+                        days += prev_month_days
 
-                        return years, months, days
+                    if months < 0:
+                        years -= 1
+                        months += 12
 
-                    years, months, days = calculate_time_diff(created_at, now)
+                    return years, months, days
 
-                    # Функция для правильного склонения дней
-                    def format_days(days):
-                        if days % 10 == 1 and days % 100 != 11:
-                            return f"{days} день"
-                        elif 2 <= days % 10 <= 4 and (days % 100 < 10 or days % 100 >= 20):
-                            return f"{days} дня"
-                        else:
-                            return f"{days} дней"
-
-                    # Функция для правильного склонения месяцев
-                    def format_months(months):
-                        if months % 10 == 1 and months % 100 != 11:
-                            return f"{months} месяц"
-                        elif 2 <= months % 10 <= 4 and (months % 100 < 10 or months % 100 >= 20):
-                            return f"{months} месяца"
-                        else:
-                            return f"{months} месяцев"
-
-                    # Функция для правильного склонения лет
-                    def format_years(years):
-                        if years % 10 == 1 and years % 100 != 11:
-                            return f"{years} год"
-                        elif 2 <= years % 10 <= 4 and (years % 100 < 10 or years % 100 >= 20):
-                            return f"{years} года"
-                        else:
-                            return f"{years} лет"
-
-                    # Форматируем красивый текст
-                    if years == 0 and months == 0 and days == 0:
-                        # Проверяем разницу в часах для "менее дня"
-                        hours_diff = (now - created_at).total_seconds() / 3600
-                        if hours_diff < 24:
-                            friends_duration = "менее дня"
-                        else:
-                            friends_duration = format_days(days)
-                    elif years == 0 and months == 0:
+                years, months, days = calculate_time_diff(created_at, now)
+
+                # Функция для правильного склонения дней
+                def format_days(days):
+                    if days % 10 == 1 and days % 100 != 11:
+                        return f"{days} день"
+                    elif 2 <= days % 10 <= 4 and (days % 100 < 10 or days % 100 >= 20):
+                        return f"{days} дня"
+                    else:
+                        return f"{days} дней"
+
+                # Функция для правильного склонения месяцев
+                def format_months(months):
+                    if months % 10 == 1 and months % 100 != 11:
+                        return f"{months} месяц"
+                    elif 2 <= months % 10 <= 4 and (months % 100 < 10 or months % 100 >= 20):
+                        return f"{months} месяца"
+                    else:
+                        return f"{months} месяцев"
+
+                # Функция для правильного склонения лет
+                def format_years(years):
+                    if years % 10 == 1 and years % 100 != 11:
+                        return f"{years} год"
+                    elif 2 <= years % 10 <= 4 and (years % 100 < 10 or years % 100 >= 20):
+                        return f"{years} года"
+                    else:
+                        return f"{years} лет"
+
+                # Форматируем красивый текст
+                if years == 0 and months == 0 and days == 0:
+                    # Проверяем разницу в часах для "менее дня"
+                    hours_diff = (now - created_at).total_seconds() / 3600
+                    if hours_diff < 24:
+                        friends_duration = "менее дня"
+                    else:
                         friends_duration = format_days(days)
-                    elif years == 0:
-                        if days == 0:
-                            friends_duration = format_months(months)
-                        else:
-                            friends_duration = f"{format_months(months)} и {format_days(days)}"
+                elif years == 0 and months == 0:
+                    friends_duration = format_days(days)
+                elif years == 0:
+                    if days == 0:
+                        friends_duration = format_months(months)
                     else:
-                        if months == 0 and days == 0:
-                            friends_duration = format_years(years)
-                        elif months == 0:
-                            friends_duration = f"{format_years(years)} и {format_days(days)}"
-                        elif days == 0:
-                            friends_duration = f"{format_years(years)} и {format_months(months)}"
-                        else:
-                            friends_duration = f"{format_years(years)}, {format_months(months)} и {format_days(days)}"
+                        friends_duration = f"{format_months(months)} и {format_days(days)}"
                 else:
-                    friends_duration = "неизвестно"
-
-                text = (
-                    f"👤 Профиль друга\n\n"
-                    f"📛 Имя: @{friend_name}\n"
-                    f"👍 Лайков: {likes_count}\n"
-                    f"🎬 Просмотрено: {watched_count}\n"
-                    f"📅 В друзьях: {friends_duration}\n\n"
-                )
+                    if months == 0 and days == 0:
+                        friends_duration = format_years(years)
+                    elif months == 0:
+                        friends_duration = f"{format_years(years)} и {format_days(days)}"
+                    elif days == 0:
+                        friends_duration = f"{format_years(years)} и {format_months(months)}"
+                    else:
+                        friends_duration = f"{format_years(years)}, {format_months(months)} и {format_days(days)}"
+            else:
+                friends_duration = "неизвестно"
+
+            text = (
+                f"👤 Профиль друга\n\n"
+                f"📛 Имя: @{friend_name}\n"
+                f"👍 Лайков: {likes_count}\n"
+                f"🎬 Просмотрено: {watched_count}\n"
+                f"📅 В друзьях: {friends_duration}\n\n"
+            )
 
-                await navigate_to_menu(
-                    chat_id, old_msg_id,
-                    text,
-                    kb_friend_profile(friend_tg_id)
-                )
+            await navigate_to_menu(
+                chat_id, old_msg_id,
+                text,
+                kb_friend_profile(friend_tg_id)
+            )
 
-        except (ValueError, IndexError) as e:
-            await callback.answer("❌ Ошибка при загрузке профиля друга")
-            print(f"Error loading friend profile: {e}")
-        return
+    except (ValueError, IndexError) as e:
+        await callback.answer("❌ Ошибка при загрузке профиля друга")
+        print(f"Error loading friend profile: {e}")
 
-    # Удаление друга
-    if data.startswith("remove_friend_"):
-        try:
-            friend_tg_id = int(data.split("_")[2])
 
-            # Получаем имя друга для сообщения
-            async with db.acquire() as conn:
-                friend = await conn.fetchrow("""
+# Удаление друга
+@callback_router.prefix("remove_friend_")
+async def cb_remove_friend(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        friend_tg_id = int(data.split("_")[2])
+
+        # Получаем имя друга для сообщения
+        async with db.acquire() as conn:
+            friend = await conn.fetchrow("""
                     SELECT username 
                     FROM users 
                     WHERE tg_id = $1
                 """, friend_tg_id)
 
-                friend_name = friend['username'] or f"Пользователь {friend_tg_id}" if friend else "друг"
+            friend_name = friend['username'] or f"Пользователь {friend_tg_id}" if friend else "друг"
 
-            # Удаляем друга
-            success = await remove_friend(chat_id, friend_tg_id)
+        # Удаляем друга
+        success = await remove_friend(chat_id, friend_tg_id)
 
-            if success:
-                await callback.answer(f"❌ Друг {friend_name} удален")
+        if success:
+            await callback.answer(f"❌ Друг {friend_name} удален")
 
-                # Возвращаемся к списку друзей
-                friends = await get_user_friends(chat_id)
-                if not friends:
-                    await navigate_to_menu(
-                        chat_id, old_msg_id,
-                        "📭 У вас пока нет друзей. Добавьте друзей, чтобы видеть их рекомендации!",
-                        InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
-                            [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
-                        ])
-                    )
-                else:
-                    await navigate_to_menu(
-                        chat_id, old_msg_id,
-                        f"👥 Ваши друзья ({len(friends)}):",
-                        kb_my_friends(friends, 0)
-                    )
+            # Возвращаемся к списку друзей
+            friends = await get_user_friends(chat_id)
+            if not friends:
+                await navigate_to_menu(
+                    chat_id, old_msg_id,
+                    "📭 У вас пока нет друзей. Добавьте друзей, чтобы видеть их рекомендации!",
+                    InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="➕ Добавить друга", callback_data="add_friend")],
+                        [InlineKeyboardButton(text="⬅️ Назад", callback_data="friends_menu")]
+                    ])
+                )
             else:
-                await callback.answer("❌ Ошибка при удалении друга")
-
-        except (ValueError, IndexError) as e:
+                await navigate_to_menu(
+                    chat_id, old_msg_id,
+                    f"👥 Ваши друзья ({len(friends)}):",
+                    kb_my_friends(friends, 0)
+                )
+        else:
             await callback.answer("❌ Ошибка при удалении друга")
-            print(f"Error removing friend: {e}")
-        return
 
-    # Статус фильтров
-    if data == "filters_status":
-        current_filters = user_sessions.get(chat_id, {}).get("filters", {})
-        filters_active = any(current_filters.values())
+    except (ValueError, IndexError) as e:
+        await callback.answer("❌ Ошибка при удалении друга")
+        print(f"Error removing friend: {e}")
 
-        if filters_active:
-            filter_text = "Активные фильтры:\n"
-            if current_filters.get('start_year') and current_filters.get('end_year'):
-                if current_filters['start_year'] == current_filters['end_year']:
-                    filter_text += f"• Год: {current_filters['start_year']}\n"
-                else:
-                    filter_text += f"• Года: {current_filters['start_year']}-{current_filters['end_year']}\n"
-            if current_filters.get('country'):
-                filter_text += f"• Страна: {current_filters['country']}\n"
-            if current_filters.get('rating'):
-                filter_text += f"• Рейтинг: {current_filters['rating']}+\n"
-            filter_text += "\nФильтры применяются к:\n• Случайный поиск\n• Поиск по жанрам"
-        else:
-            filter_text = "❌ Фильтры не активны"
 
-        await callback.answer(filter_text, show_alert=True)
-        return
+# Статус фильтров
+@callback_router.exact("filters_status")
+async def cb_filters_status(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    current_filters = user_sessions.get(chat_id, {}).get("filters", {})
+    filters_active = any(current_filters.values())
 
-    # Обработчик кнопки года
-    if data == "filter_year":
-        # Устанавливаем флаг ожидания ввода диапазона
-        if chat_id not in user_input_waiting:
-            user_input_waiting[chat_id] = {}
-        user_input_waiting[chat_id]["waiting_year"] = True
+    if filters_active:
+        filter_text = "Активные фильтры:\n"
+        if current_filters.get('start_year') and current_filters.get('end_year'):
+            if current_filters['start_year'] == current_filters['end_year']:
+                filter_text += f"• Год: {current_filters['start_year']}\n"
+            else:
+                filter_text += f"• Года: {current_filters['start_year']}-{current_filters['end_year']}\n"
+        if current_filters.get('country'):
+            filter_text += f"• Страна: {current_filters['country']}\n"
+        if current_filters.get('rating'):
+            filter_text += f"• Рейтинг: {current_filters['rating']}+\n"
+        filter_text += "\nФильтры применяются к:\n• Случайный поиск\n• Поиск по жанрам"
+    else:
+        filter_text = "❌ Фильтры не активны"
 
-        # Удаляем текущее сообщение с меню
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    await callback.answer(filter_text, show_alert=True)
 
-        # Отправляем сообщение с инструкцией и сохраняем его ID
-        msg = await callback.message.answer(
-            "📅 Введите год или диапазон годов:\n\n"
-            "• Один год: 2010\n"
-            "• Диапазон: 2010-2020\n"
-            "• От года: 2010-\n"
-            "• До года: -2020\n\n"
-            "❌ Чтобы убрать фильтр года, введите 'any'"
-        )
-        user_input_waiting[chat_id]["message_id"] = msg.message_id
+
+# Обработчик кнопки года
+@callback_router.exact("filter_year")
+async def cb_filter_year(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_input_waiting:
+        user_input_waiting[chat_id] = {}
+    user_input_waiting[chat_id]["waiting_year"] = True
+
+    # Удаляем текущее сообщение с меню
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+
+    # Отправляем сообщение с инструкцией и сохраняем его ID
+    msg = await callback.message.answer(
+        "📅 Введите год или диапазон годов:\n\n"
+        "• Один год: 2010\n"
+        "• Диапазон: 2010-2020\n"
+        "• От года: 2010-\n"
+        "• До года: -2020\n\n"
+        "❌ Чтобы убрать фильтр года, введите 'any'"
+    )
+    user_input_waiting[chat_id]["message_id"] = msg.message_id
+
+
+# Админ-панель
+@callback_router.exact("admin_panel")
+async def cb_admin_panel(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
+    await navigate_to_menu(chat_id, old_msg_id, "⚙️ Админ-панель:", kb_admin_panel())
+
 
-    # Добавь в handle_callback()
+# Поиск для бана
+@callback_router.exact("admin_search_ban")
+async def cb_admin_search_ban(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
+        return
 
-    # Проверка админских прав (замени на свою логику)
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+
+    # Сохраняем состояние ожидания ввода
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["waiting_admin_search"] = True
+
+    await callback.message.answer(
+        "🔍 Введите название фильма или сериала для поиска:\n\n"
+        "Можно уточнить тип:\n"
+        "• 'интерстеллар movie' - только фильмы\n"
+        "• 'breaking bad tv' - только сериалы\n"
+        "• 'матрица' - все результаты"
+    )
 
 
-    # Админ-панель
-    if data == "admin_panel":
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
-        await navigate_to_menu(chat_id, old_msg_id, "⚙️ Админ-панель:", kb_admin_panel())
+# Предпросмотр перед баном
+@callback_router.action("admin_preban")
+async def cb_admin_preban(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Поиск для бана
-    if data == "admin_search_ban":
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    # Получаем детали
+    details = await get_item_details(type_, tmdb_id)
+    if not details:
+        await callback.answer("❌ Не удалось загрузить данные")
+        return
+
+    title = details.get("title") or details.get("name")
+    year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+
+    # Проверяем статус бана
+    is_already_banned = await is_banned(tmdb_id, type_)
+
+    if is_already_banned:
+        caption = f"🎯 Контент ЗАБАНЕН:\n\n{title} ({year})\nID: {tmdb_id} | Тип: {type_}\n\nРазблокировать контент?"
+    else:
+        caption = f"🎯 Подтвердите бан:\n\n{title} ({year})\nID: {tmdb_id} | Тип: {type_}"
+
+    await callback.message.answer(
+        caption,
+        reply_markup=await kb_ban_confirmation(tmdb_id, type_, title)  # не забудь await!
+    )
 
-        # Сохраняем состояние ожидания ввода
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["waiting_admin_search"] = True
 
-        await callback.message.answer(
-            "🔍 Введите название фильма или сериала для поиска:\n\n"
-            "Можно уточнить тип:\n"
-            "• 'интерстеллар movie' - только фильмы\n"
-            "• 'breaking bad tv' - только сериалы\n"
-            "• 'матрица' - все результаты"
-        )
+@callback_router.action("confirm_unban")
+async def cb_confirm_unban(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Предпросмотр перед баном
-    if data.startswith("admin_preban_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-        parts = data.split("_")
-        tmdb_id = int(parts[2])
-        type_ = parts[3]
+    details = await get_item_details(type_, tmdb_id)
+    title = details.get("title") or details.get("name") or "Unknown"
 
-        # Получаем детали
-        details = get_item_details(type_, tmdb_id)
-        if not details:
-            await callback.answer("❌ Не удалось загрузить данные")
-            return
+    await unban_content(tmdb_id, type_)
 
-        title = details.get("title") or details.get("name")
-        year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+    if type_ == "movie":
+        await callback.answer(f"✅ Фильм {title} разбанен!")
+    elif type_ == "tv":
+        await callback.answer(f"✅ Сериал {title} разбанен!")
+    else:
+        await callback.answer(f"❌ Произошла ошибка!")
 
-        # Проверяем статус бана
-        is_already_banned = await is_banned(tmdb_id, type_)
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        if is_already_banned:
-            caption = f"🎯 Контент ЗАБАНЕН:\n\n{title} ({year})\nID: {tmdb_id} | Тип: {type_}\n\nРазблокировать контент?"
-        else:
-            caption = f"🎯 Подтвердите бан:\n\n{title} ({year})\nID: {tmdb_id} | Тип: {type_}"
 
-        await callback.message.answer(
-            caption,
-            reply_markup=await kb_ban_confirmation(tmdb_id, type_, title)  # не забудь await!
-        )
+# Подтверждение бана
+@callback_router.action("confirm_ban")
+async def cb_confirm_ban(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    if data.startswith("confirm_unban_"):
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-        parts = data.split("_")
-        tmdb_id = int(parts[2])
-        type_ = parts[3]
-
-        details = get_item_details(type_, tmdb_id)
-        title = details.get("title") or details.get("name") or "Unknown"
+    # Получаем детали для названия
+    details = await get_item_details(type_, tmdb_id)
+    title = details.get("title") or details.get("name") or "Unknown"
 
-        await unban_content(tmdb_id, type_)
+    await ban_content(tmdb_id, type_, title, chat_id, "Админ-бан")
 
-        if type_ == "movie":
-            await callback.answer(f"✅ Фильм {title} разбанен!")
-        elif type_ == "tv":
-            await callback.answer(f"✅ Сериал {title} разбанен!")
-        else:
-            await callback.answer(f"❌ Произошла ошибка!")
+    if type_ == "movie":
+        await callback.answer(f"✅ Фильм {title} забанен!")
+    elif type_ == "tv":
+        await callback.answer(f"✅ Сериал {title} забанен!")
+    else:
+        await callback.answer(f"❌ Произошла ошибка!")
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
-        return
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-    # Подтверждение бана
-    if data.startswith("confirm_ban_"):
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
 
-        parts = data.split("_")
-        tmdb_id = int(parts[2])
-        type_ = parts[3]
+# Разбан
+@callback_router.prefix("unban_")
+async def cb_unban(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
+        return
 
-        # Получаем детали для названия
-        details = get_item_details(type_, tmdb_id)
-        title = details.get("title") or details.get("name") or "Unknown"
+    parts = data.split("_")
+    tmdb_id = int(parts[1])
+    type_ = parts[2]
 
-        await ban_content(tmdb_id, type_, title, chat_id, "Админ-бан")
+    await unban_content(tmdb_id, type_)
+    await callback.answer("✅ Контент разбанен!")
+    await navigate_to_menu(chat_id, old_msg_id, "⚙️ Админ-панель:", kb_admin_panel())
 
-        if type_ == "movie":
-            await callback.answer(f"✅ Фильм {title} забанен!")
-        elif type_ == "tv":
-            await callback.answer(f"✅ Сериал {title} забанен!")
-        else:
-            await callback.answer(f"❌ Произошла ошибка!")
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+# Статистика админ-панели
+# Статистика админ-панели
+@callback_router.exact("admin_stats")
+async def cb_admin_stats(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Список банов
-    if data == "admin_ban_list":
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    # Сохраняем сортировку по умолчанию
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["current_stats_sort"] = "updated"
 
-        banned_list = await get_banned_list(20)
-        if not banned_list:
-            await callback.message.answer(
-                "📭 Список банов пуст",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")]
-                ])
-            )
-            return
+    # Загружаем первую страницу статистики
+    stats_data = await get_ratings_stats(sort_by="updated", page=0)
+    text = format_stats_page(stats_data, "updated", 0)
 
-        text = "📋 Забаненный контент:\n\n"
-        for item in banned_list:
-            text += f"• {item['title']} (ID: {item['tmdb_id']})\n"
+    await bot.send_message(
+        chat_id,
+        text,
+        reply_markup=kb_admin_stats("updated", 0, stats_data["total_pages"]),
+        parse_mode="HTML"
+    )
 
-        text += f"\nВсего: {len(banned_list)}"
 
-        await callback.message.answer(
-            text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")]
-            ])
-        )
+# Смена сортировки статистики
+@callback_router.prefix("stats_sort_")
+async def cb_stats_sort(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Разбан
-    if data.startswith("unban_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    sort_by = data.split("_")[2]
+
+    # Сохраняем сортировку в сессии
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["current_stats_sort"] = sort_by
+
+    stats_data = await get_ratings_stats(sort_by=sort_by, page=0)
+    text = format_stats_page(stats_data, sort_by, 0)
+
+    await callback.message.edit_text(
+        text,
+        reply_markup=kb_admin_stats(sort_by, 0, stats_data["total_pages"]),
+        parse_mode="HTML"
+    )
 
-        parts = data.split("_")
-        tmdb_id = int(parts[1])
-        type_ = parts[2]
 
-        await unban_content(tmdb_id, type_)
-        await callback.answer("✅ Контент разбанен!")
-        await navigate_to_menu(chat_id, old_msg_id, "⚙️ Админ-панель:", kb_admin_panel())
+# Смена страницы статистики
+@callback_router.prefix("stats_page_")
+async def cb_stats_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer()
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Статистика админ-панели
-    # Статистика админ-панели
-    if data == "admin_stats":
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    parts = data.split("_")
+    page = int(parts[2])
+    sort_by = parts[3]
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    # Сохраняем сортировку в сессии
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    user_sessions[chat_id]["current_stats_sort"] = sort_by
 
-        # Сохраняем сортировку по умолчанию
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["current_stats_sort"] = "updated"
+    stats_data = await get_ratings_stats(sort_by=sort_by, page=page)
+    text = format_stats_page(stats_data, sort_by, page)
 
-        # Загружаем первую страницу статистики
-        stats_data = await get_ratings_stats(sort_by="updated", page=0)
-        text = format_stats_page(stats_data, "updated", 0)
+    await callback.message.edit_text(
+        text,
+        reply_markup=kb_admin_stats(sort_by, page, stats_data["total_pages"]),
+        parse_mode="HTML"
+    )
 
-        await bot.send_message(
-            chat_id,
-            text,
-            reply_markup=kb_admin_stats("updated", 0, stats_data["total_pages"]),
-            parse_mode="HTML"
-        )
-        return
 
-    # Смена сортировки статистики
-    if data.startswith("stats_sort_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+# Информация о статистике
+@callback_router.exact("stats_info")
+async def cb_stats_info(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer("ℹ️ Используйте кнопки для сортировки и навигации", show_alert=True)
 
-        sort_by = data.split("_")[2]
 
-        # Сохраняем сортировку в сессии
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["current_stats_sort"] = sort_by
+# Переключение страны
+@callback_router.exact("filter_country")
+async def cb_filter_country(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    if chat_id not in user_input_waiting:
+        user_input_waiting[chat_id] = {}
+    user_input_waiting[chat_id]["waiting_country"] = True
 
-        stats_data = await get_ratings_stats(sort_by=sort_by, page=0)
-        text = format_stats_page(stats_data, sort_by, 0)
+    # Удаляем текущее сообщение с меню
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+
+    # Отправляем сообщение с инструкцией и сохраняем его ID
+    msg = await callback.message.answer(
+        "🌍 Введите название страны на английском (например: RU, US, FR):\n\n"
+        "❌ Чтобы убрать фильтр страны, введите 'any'"
+    )
+    user_input_waiting[chat_id]["message_id"] = msg.message_id
 
-        await callback.message.edit_text(
-            text,
-            reply_markup=kb_admin_stats(sort_by, 0, stats_data["total_pages"]),
-            parse_mode="HTML"
-        )
-        return
 
-    # Смена страницы статистики
-    if data.startswith("stats_page_"):
-        await callback.answer()
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+@callback_router.exact("filter_rating")
+async def cb_filter_rating(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+    await callback.message.answer("Выберите рейтинг:", reply_markup=kb_rating_selection())
 
-        parts = data.split("_")
-        page = int(parts[2])
-        sort_by = parts[3]
 
-        # Сохраняем сортировку в сессии
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        user_sessions[chat_id]["current_stats_sort"] = sort_by
+# Установка года
+@callback_router.prefix("set_year_")
+async def cb_set_year(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    year = int(data.split("_")[2])
 
-        stats_data = await get_ratings_stats(sort_by=sort_by, page=page)
-        text = format_stats_page(stats_data, sort_by, page)
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    if "filters" not in user_sessions[chat_id]:
+        user_sessions[chat_id]["filters"] = {}
 
-        await callback.message.edit_text(
-            text,
-            reply_markup=kb_admin_stats(sort_by, page, stats_data["total_pages"]),
-            parse_mode="HTML"
-        )
-        return
+    user_sessions[chat_id]["filters"]["year"] = year
+    await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
+    await callback.answer(f"✅ Год установлен: {year}")
 
-    # Информация о статистике
-    if data == "stats_info":
-        await callback.answer("ℹ️ Используйте кнопки для сортировки и навигации", show_alert=True)
-        return
+    # Возвращаемся к меню фильтров
+    current_filters = user_sessions[chat_id]["filters"]
+    await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
 
 
-    # Переключение страны
-    if data == "filter_country":
-        # Устанавливаем флаг ожидания ввода
-        if chat_id not in user_input_waiting:
-            user_input_waiting[chat_id] = {}
-        user_input_waiting[chat_id]["waiting_country"] = True
+# Установка рейтинга
+@callback_router.prefix("set_rating_")
+async def cb_set_rating(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    rating = float(data.split("_")[2])
 
-        # Удаляем текущее сообщение с меню
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+    if chat_id not in user_sessions:
+        user_sessions[chat_id] = {}
+    if "filters" not in user_sessions[chat_id]:
+        user_sessions[chat_id]["filters"] = {}
 
-        # Отправляем сообщение с инструкцией и сохраняем его ID
-        msg = await callback.message.answer(
-            "🌍 Введите название страны на английском (например: RU, US, FR):\n\n"
-            "❌ Чтобы убрать фильтр страны, введите 'any'"
-        )
-        user_input_waiting[chat_id]["message_id"] = msg.message_id
-        return
+    user_sessions[chat_id]["filters"]["rating"] = rating
+    await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
+    await callback.answer(f"✅ Рейтинг установлен: {rating}+")
 
-    if data == "filter_rating":
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
-        await callback.message.answer("Выберите рейтинг:", reply_markup=kb_rating_selection())
-        return
+    current_filters = user_sessions[chat_id]["filters"]
+    await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
 
-    # Установка года
-    if data.startswith("set_year_"):
-        year = int(data.split("_")[2])
 
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        if "filters" not in user_sessions[chat_id]:
-            user_sessions[chat_id]["filters"] = {}
+# Очистка фильтров
+@callback_router.exact("clear_year")
+async def cb_clear_year(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    current_filters = await get_current_filters(chat_id)
+    current_filters["year"] = None
+    await save_search_filters(chat_id, current_filters)
+    await callback.answer("✅ Год сброшен")
 
-        user_sessions[chat_id]["filters"]["year"] = year
-        await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
-        await callback.answer(f"✅ Год установлен: {year}")
+    await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
 
-        # Возвращаемся к меню фильтров
-        current_filters = user_sessions[chat_id]["filters"]
-        await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
-        return
 
-    # Установка рейтинга
-    if data.startswith("set_rating_"):
-        rating = float(data.split("_")[2])
+@callback_router.exact("clear_rating")
+async def cb_clear_rating(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    current_filters = await get_current_filters(chat_id)
+    current_filters["rating"] = None
+    await save_search_filters(chat_id, current_filters)
+    await callback.answer("✅ Рейтинг сброшен")
 
-        if chat_id not in user_sessions:
-            user_sessions[chat_id] = {}
-        if "filters" not in user_sessions[chat_id]:
-            user_sessions[chat_id]["filters"] = {}
+    await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
 
-        user_sessions[chat_id]["filters"]["rating"] = rating
-        await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
-        await callback.answer(f"✅ Рейтинг установлен: {rating}+")
 
-        current_filters = user_sessions[chat_id]["filters"]
-        await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
-        return
+# Сброс всех фильтров
+@callback_router.exact("reset_all_filters")
+async def cb_reset_all_filters(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except:
+        pass
+    if chat_id in user_sessions and "filters" in user_sessions[chat_id]:
+        user_sessions[chat_id]["filters"] = {}
+        await clear_search_filters(chat_id)
+    await callback.answer("✅ Все фильтры сброшены!")
+    current_filters = user_sessions.get(chat_id, {}).get("filters", {})
+    await callback.message.answer("Настройте фильтры поиска:", reply_markup=kb_filters_menu(current_filters))
 
-    # Переключение страны
-    if data == "filter_country":
-        # Устанавливаем флаг ожидания ввода
-        if chat_id not in user_input_waiting:
-            user_input_waiting[chat_id] = {}
-        user_input_waiting[chat_id]["waiting_country"] = True
 
-        # Удаляем текущее сообщение с меню
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
+# Меню трендов
+@callback_router.exact("trending_menu")
+async def cb_trending_menu(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(chat_id, old_msg_id, "Что интересует?", kb_trending_menu())
 
-        # Отправляем сообщение с инструкцией и сохраняем его ID
-        msg = await callback.message.answer(
-            "🌍 Введите название страны на английском (например: RU, US, FR):\n\n"
-            "❌ Чтобы убрать фильтр страны, введите 'any'"
-        )
-        user_input_waiting[chat_id]["message_id"] = msg.message_id
+
+# Трендовые фильмы за неделю
+@callback_router.exact("trending_movie_week")
+async def cb_trending_movie_week(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    items = await get_trending("movie", "week")
+    if not items:
+        await callback.answer("Не удалось получить трендовые фильмы", show_alert=True)
         return
 
-    # Очистка фильтров
-    if data == "clear_year":
-        if chat_id in user_sessions and "filters" in user_sessions[chat_id]:
-            user_sessions[chat_id]["filters"]["year"] = None
-            await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
-        await callback.answer("✅ Год сброшен")
+    user_sessions[chat_id] = {
+        "results": to_refs(items, "movie"),
+        "index": 0,
+        "type": "movie",
+        "mode": "trending"
+    }
+    await send_card(chat_id, old_msg_id)
+
 
-        current_filters = user_sessions[chat_id]["filters"]
-        await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
+# Трендовые сериалы за неделю
+@callback_router.exact("trending_tv_week")
+async def cb_trending_tv_week(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    items = await get_trending("tv", "week")
+    if not items:
+        await callback.answer("Не удалось получить трендовые сериалы", show_alert=True)
         return
 
-    if data == "clear_rating":
-        if chat_id in user_sessions and "filters" in user_sessions[chat_id]:
-            user_sessions[chat_id]["filters"]["rating"] = None
-            await save_search_filters(chat_id, user_sessions[chat_id]["filters"])
-        await callback.answer("✅ Рейтинг сброшен")
+    user_sessions[chat_id] = {
+        "results": to_refs(items, "tv"),
+        "index": 0,
+        "type": "tv",
+        "mode": "trending"
+    }
+    await send_card(chat_id, old_msg_id)
 
-        current_filters = user_sessions[chat_id]["filters"]
-        await navigate_to_menu(chat_id, old_msg_id, "Настройте фильтры поиска:", kb_filters_menu(current_filters))
-        return
 
-    # Сброс всех фильтров
-    if data == "reset_all_filters":
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except:
-            pass
-        if chat_id in user_sessions and "filters" in user_sessions[chat_id]:
-            user_sessions[chat_id]["filters"] = {}
-            await clear_search_filters(chat_id)
-        await callback.answer("✅ Все фильтры сброшены!")
-        current_filters = user_sessions.get(chat_id, {}).get("filters", {})
-        await callback.message.answer("Настройте фильтры поиска:", reply_markup=kb_filters_menu(current_filters))
-        return
+# Главное меню поиска
+@callback_router.exact("search_menu")
+async def cb_search_menu(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(chat_id, old_msg_id, "Выберите тип поиска:", kb_search_menu())
 
-    # Меню трендов
-    if data == "trending_menu":
-        await navigate_to_menu(chat_id, old_msg_id, "Что интересует?", kb_trending_menu())
-        return
 
-    # Трендовые фильмы за неделю
-    if data == "trending_movie_week":
-        items = get_trending("movie", "week")
-        if not items:
-            await callback.answer("Не удалось получить трендовые фильмы", show_alert=True)
-            return
+# Меню случайного поиска
+@callback_router.exact("random_search")
+async def cb_random_search(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(chat_id, old_msg_id, "Выберите что искать:", kb_random_search())
 
-        user_sessions[chat_id] = {
-            "results": items,
-            "index": 0,
-            "type": "movie",
-            "mode": "trending"
-        }
-        await send_card(chat_id, old_msg_id)
-        return
 
-    # Трендовые сериалы за неделю
-    if data == "trending_tv_week":
-        items = get_trending("tv", "week")
-        if not items:
-            await callback.answer("Не удалось получить трендовые сериалы", show_alert=True)
-            return
+@callback_router.exact("export_pdf")
+async def cb_export_pdf(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer("🔄 Создаю PDF...")
 
-        user_sessions[chat_id] = {
-            "results": items,
-            "index": 0,
-            "type": "tv",
-            "mode": "trending"
-        }
-        await send_card(chat_id, old_msg_id)
-        return
+    # Создаем PDF
+    pdf_buffer = await generate_collection_pdf(chat_id)
 
-    # Главное меню поиска
-    if data == "search_menu":
-        await navigate_to_menu(chat_id, old_msg_id, "Выберите тип поиска:", kb_search_menu())
+    if not pdf_buffer:
+        await callback.answer("❌ Коллекция пуста!", show_alert=True)
         return
 
-    # Меню случайного поиска
-    if data == "random_search":
-        await navigate_to_menu(chat_id, old_msg_id, "Выберите что искать:", kb_random_search())
+    # Отправляем файл пользователю
+    try:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=types.BufferedInputFile(
+                pdf_buffer.getvalue(),
+                filename="my_collection.pdf"
+            ),
+            caption="📚 Ваша коллекция фильмов и сериалов"
+        )
+        await callback.answer("✅ PDF готов!")
+    except Exception as e:
+        await callback.answer("❌ Ошибка при создании PDF", show_alert=True)
+        print(f"PDF export error: {e}")
+
+
+# Экспорт статистики в PDF
+@callback_router.exact("stats_export_pdf")
+async def cb_stats_export_pdf(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer("🔄 Генерирую PDF...")
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Добавляем в handle_callback
-    if data == "export_pdf":
-        await callback.answer("🔄 Создаю PDF...")
+    try:
+        # Получаем текущую сортировку из сессии ИЛИ используем ту, что сейчас отображается
+        current_sort = user_sessions.get(chat_id, {}).get("current_stats_sort", "updated")
+
+        # Если нет в сессии, пробуем определить из текущего сообщения
+        if "current_stats_sort" not in user_sessions.get(chat_id, {}):
+            # Парсим текущую сортировку из сообщения
+            message_text = callback.message.text
+            if "Сортировка: по лайкам" in message_text:
+                current_sort = "likes"
+            elif "Сортировка: по дизлайкам" in message_text:
+                current_sort = "dislikes"
+            elif "Сортировка: по просмотрам" in message_text:
+                current_sort = "watches"
+            else:
+                current_sort = "updated"
 
-        # Создаем PDF
-        pdf_buffer = await generate_collection_pdf(chat_id)
+        stats_data = await get_ratings_stats(sort_by=current_sort, page=0, limit=1000)
 
-        if not pdf_buffer:
-            await callback.answer("❌ Коллекция пуста!", show_alert=True)
-            return
+        pdf_buffer = await generate_stats_pdf(stats_data, current_sort)
 
-        # Отправляем файл пользователю
-        try:
+        if pdf_buffer:
+            from datetime import datetime
             await bot.send_document(
                 chat_id=chat_id,
                 document=types.BufferedInputFile(
                     pdf_buffer.getvalue(),
-                    filename="my_collection.pdf"
+                    filename=f"statistics_{current_sort}_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
                 ),
-                caption="📚 Ваша коллекция фильмов и сериалов"
+                caption=f"📊 Статистика контента (сортировка: {current_sort})"
             )
             await callback.answer("✅ PDF готов!")
-        except Exception as e:
+        else:
             await callback.answer("❌ Ошибка при создании PDF", show_alert=True)
-            print(f"PDF export error: {e}")
 
+    except Exception as e:
+        await callback.answer("❌ Ошибка при создании PDF", show_alert=True)
+        print(f"Stats PDF export error: {e}")
+
+
+# Диаграммы статистики в PDF
+@callback_router.exact("stats_charts_pdf")
+async def cb_stats_charts_pdf(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await callback.answer("🔄 Генерирую диаграммы...")
+    if not is_admin(chat_id):
+        await callback.answer("❌ Нет доступа!")
         return
 
-    # Экспорт статистики в PDF
-    if data == "stats_export_pdf":
-        await callback.answer("🔄 Генерирую PDF...")
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    try:
+        stats_data = await get_ratings_stats(sort_by="likes", page=0, limit=1000)
 
-        try:
-            # Получаем текущую сортировку из сессии ИЛИ используем ту, что сейчас отображается
-            current_sort = user_sessions.get(chat_id, {}).get("current_stats_sort", "updated")
-
-            # Если нет в сессии, пробуем определить из текущего сообщения
-            if "current_stats_sort" not in user_sessions.get(chat_id, {}):
-                # Парсим текущую сортировку из сообщения
-                message_text = callback.message.text
-                if "Сортировка: по лайкам" in message_text:
-                    current_sort = "likes"
-                elif "Сортировка: по дизлайкам" in message_text:
-                    current_sort = "dislikes"
-                elif "Сортировка: по просмотрам" in message_text:
-                    current_sort = "watches"
-                else:
-                    current_sort = "updated"
+        pdf_buffer = await generate_stats_charts_pdf(stats_data)
 
-            stats_data = await get_ratings_stats(sort_by=current_sort, page=0, limit=1000)
+        if pdf_buffer:
+            from datetime import datetime  # Добавляем импорт здесь
+            await bot.send_document(
+                chat_id=chat_id,
+                document=types.BufferedInputFile(
+                    pdf_buffer.getvalue(),
+                    filename=f"charts_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
+                ),
+                caption="📊 Диаграммы статистики"
+            )
+            await callback.answer("✅ Диаграммы готовы!")
+        else:
+            await callback.answer("❌ Ошибка при создании диаграмм", show_alert=True)
 
-            pdf_buffer = await generate_stats_pdf(stats_data, current_sort)
+    except Exception as e:
+        await callback.answer("❌ Ошибка при создании диаграмм", show_alert=True)
+        print(f"Charts PDF export error: {e}")
 
-            if pdf_buffer:
-                from datetime import datetime
-                await bot.send_document(
-                    chat_id=chat_id,
-                    document=types.BufferedInputFile(
-                        pdf_buffer.getvalue(),
-                        filename=f"statistics_{current_sort}_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
-                    ),
-                    caption=f"📊 Статистика контента (сортировка: {current_sort})"
-                )
-                await callback.answer("✅ PDF готов!")
-            else:
-                await callback.answer("❌ Ошибка при создании PDF", show_alert=True)
 
-        except Exception as e:
-            await callback.answer("❌ Ошибка при создании PDF", show_alert=True)
-            print(f"Stats PDF export error: {e}")
+# В обработчике preferences заменим:
+@callback_router.exact("preferences")
+async def cb_preferences(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    user_likes = await get_user_likes(chat_id)
+    if not user_likes:
+        await callback.answer("❌ Сначала поставьте лайки некоторым фильмам/сериалам!")
         return
 
-    # Диаграммы статистики в PDF
-    if data == "stats_charts_pdf":
-        await callback.answer("🔄 Генерирую диаграммы...")
-        if not is_admin(chat_id):
-            await callback.answer("❌ Нет доступа!")
-            return
+    # Сохраняем лайки пользователя в сессию
+    user_sessions[chat_id] = {
+        "user_likes": user_likes,
+        "type": "preferences"
+    }
+    await send_preference_item(chat_id, old_msg_id)
 
-        try:
-            stats_data = await get_ratings_stats(sort_by="likes", page=0, limit=1000)
-
-            pdf_buffer = await generate_stats_charts_pdf(stats_data)
-
-            if pdf_buffer:
-                from datetime import datetime  # Добавляем импорт здесь
-                await bot.send_document(
-                    chat_id=chat_id,
-                    document=types.BufferedInputFile(
-                        pdf_buffer.getvalue(),
-                        filename=f"charts_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
-                    ),
-                    caption="📊 Диаграммы статистики"
-                )
-                await callback.answer("✅ Диаграммы готовы!")
-            else:
-                await callback.answer("❌ Ошибка при создании диаграмм", show_alert=True)
 
-        except Exception as e:
-            await callback.answer("❌ Ошибка при создании диаграмм", show_alert=True)
-            print(f"Charts PDF export error: {e}")
-        return
+# Обработчик кнопки "Следующая рекомендация"
+@callback_router.exact("next_preference")
+async def cb_next_preference(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await send_preference_item(chat_id, old_msg_id)
 
-    # В handle_callback добавить:
-    # В обработчике preferences заменим:
-    if data == "preferences":
-        user_likes = await get_user_likes(chat_id)
-        if not user_likes:
-            await callback.answer("❌ Сначала поставьте лайки некоторым фильмам/сериалам!")
-            return
 
-        # Сохраняем лайки пользователя в сессию
-        user_sessions[chat_id] = {
-            "user_likes": user_likes,
-            "type": "preferences"
-        }
-        await send_preference_item(chat_id, old_msg_id)
-        return
+@callback_router.exact("toggle_watched")
+async def cb_toggle_watched(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    filters = await get_user_filters(chat_id)
+    new_value = not filters["exclude_watched"]
+    await update_user_filter(chat_id, "hide_watched", new_value)
+    filters = await get_user_filters(chat_id)
+    await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
 
-    # Обработчик кнопки "Следующая рекомендация"
-    if data == "next_preference":
-        await send_preference_item(chat_id, old_msg_id)
-        return
 
-    if data == "toggle_watched":
-        filters = await get_user_filters(chat_id)
-        new_value = not filters["exclude_watched"]
-        await update_user_filter(chat_id, "hide_watched", new_value)
-        filters = await get_user_filters(chat_id)
-        user_filters[chat_id] = filters
-        await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
-        return
+# Назад в главное меню
+@callback_router.exact("back_to_main")
+async def cb_back_to_main(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except Exception:
+        pass
+    await bot.send_message(chat_id, "Выберите, что хотите получить:", reply_markup=kb_main())
 
-    # Назад в главное меню
-    if data == "back_to_main":
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except Exception:
-            pass
-        await bot.send_message(chat_id, "Выберите, что хотите получить:", reply_markup=kb_main())
+
+# Настройки
+@callback_router.exact("settings")
+async def cb_settings(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    filters = await get_user_filters(chat_id)
+    await navigate_to_menu(chat_id, old_msg_id, "Настройки фильтров:", kb_settings(filters))
+
+
+@callback_router.exact("toggle_anime")
+async def cb_toggle_anime(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    filters = await get_user_filters(chat_id)
+    new_value = not filters["exclude_anime"]
+    await update_user_filter(chat_id, "disable_anime", new_value)
+    filters = await get_user_filters(chat_id)
+    await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
+
+
+@callback_router.exact("toggle_cartoons")
+async def cb_toggle_cartoons(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    filters = await get_user_filters(chat_id)
+    new_value = not filters["exclude_cartoons"]
+    await update_user_filter(chat_id, "disable_cartoons", new_value)
+    filters = await get_user_filters(chat_id)
+    await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
+
+
+# Случайный фильм/сериал (с применением фильтров)
+@callback_router.exact("discover_movie", "discover_tv")
+async def cb_discover(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    type_ = "movie" if data == "discover_movie" else "tv"
+
+    # Получаем активные фильтры пользователя
+    current_filters = await get_current_filters(chat_id)
+
+    prefs = await get_user_filters(chat_id)
+    items = await discover_tmdb(type_, filters=current_filters, prefs=prefs)
+    if prefs["exclude_watched"]:
+        items = await filter_watched_items(chat_id, items, type_)
+    if not items:
+        await callback.message.answer("Не удалось получить данные.")
         return
+    user_sessions[chat_id] = {
+        "results": to_refs(items, type_),
+        "index": 0,
+        "type": type_,
+        "mode": "random"
+    }
+    await send_card(chat_id, old_msg_id)
 
-    # Настройки
-    if data == "settings":
-        filters = await get_user_filters(chat_id)
-        await navigate_to_menu(chat_id, old_msg_id, "Настройки фильтров:", kb_settings(filters))
+
+# Поиск по жанрам (с применением фильтров)
+@callback_router.exact("search_genre")
+async def cb_search_genre(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    await navigate_to_menu(chat_id, old_msg_id, "Выберите тип:",
+                           InlineKeyboardMarkup(inline_keyboard=[
+                               [InlineKeyboardButton(text="🎬 Фильмы", callback_data="genre_type_movie")],
+                               [InlineKeyboardButton(text="📺 Сериалы", callback_data="genre_type_tv")],
+                               [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")],
+                           ]))
+
+
+@callback_router.exact("genre_type_movie", "genre_type_tv")
+async def cb_genre_type(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    type_ = "movie" if data == "genre_type_movie" else "tv"
+    await navigate_to_menu(chat_id, old_msg_id, "Выберите жанр:", kb_genres(type_))
+
+
+# Обновленный обработчик для выбора жанра (с применением фильтров)
+@callback_router.prefix("genre_")
+async def cb_genre(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    parts = data.split("_")
+    if len(parts) < 3:
+        await callback.answer("Ошибка: некорректные данные.")
         return
+    type_ = parts[1]
+    gid = int(parts[2])
+
+    # Получаем активные фильтры пользователя
+    current_filters = await get_current_filters(chat_id)
 
-    if data == "toggle_anime":
-        filters = await get_user_filters(chat_id)
-        new_value = not filters["exclude_anime"]
-        await update_user_filter(chat_id, "disable_anime", new_value)
-        filters = await get_user_filters(chat_id)
-        user_filters[chat_id] = filters
-        await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
+    prefs = await get_user_filters(chat_id)
+    items = await discover_tmdb(type_, genre_id=gid, filters=current_filters, prefs=prefs)
+    if not items:
+        await callback.message.answer("По этому жанру ничего не найдено.")
         return
+    user_sessions[chat_id] = {
+        "results": to_refs(items, type_),
+        "index": 0,
+        "type": type_,
+        "genre_id": gid,
+        "mode": "genre"
+    }
+    await send_card(chat_id, old_msg_id)
 
-    if data == "toggle_cartoons":
-        filters = await get_user_filters(chat_id)
-        new_value = not filters["exclude_cartoons"]
-        await update_user_filter(chat_id, "disable_cartoons", new_value)
-        filters = await get_user_filters(chat_id)
-        user_filters[chat_id] = filters
-        await callback.message.edit_reply_markup(reply_markup=kb_settings(filters))
+
+# Обновленный обработчик для кнопки "Следующий"
+@callback_router.exact("next_item")
+async def cb_next_item(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    session = user_sessions.get(chat_id)
+    if not session or "results" not in session:
+        await callback.answer("Сначала сделайте выбор.")
         return
+    await send_card(chat_id, old_msg_id)
+
 
-    # Случайный фильм/сериал (с применением фильтров)
-    if data in ("discover_movie", "discover_tv"):
-        type_ = "movie" if data == "discover_movie" else "tv"
+# Обновленный обработчик для кнопки "Назад к жанрам"
+@callback_router.prefix("back_to_genres_")
+async def cb_back_to_genres(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    type_ = data.split("_")[-1]
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except Exception:
+        pass
+    await bot.send_message(chat_id, "Выберите жанр:", reply_markup=kb_genres(type_))
 
-        # Получаем активные фильтры пользователя
-        current_filters = await get_current_filters(chat_id)
 
-        items = await discover_tmdb(type_, filters=current_filters)  # ДОБАВЬ await
-        if user_filters.get(chat_id, {}).get("exclude_watched"):
-            items = await filter_watched_items(chat_id, items, type_)
-        if not items:
-            await callback.message.answer("Не удалось получить данные.")
-            return
-        user_sessions[chat_id] = {
-            "results": items,
-            "index": 0,
-            "type": type_,
-            "mode": "random"
-        }
-        await send_card(chat_id, old_msg_id)
+# Коллекция
+@callback_router.exact("show_collection")
+async def cb_show_collection(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except Exception:
+        pass
+    total_items = await get_collection_count(chat_id)
+    total_pages = (total_items + 3) // 4  # Округление вверх
+    keyboard = await kb_collection(chat_id, 0, total_pages)
+    if total_pages == 0:
+        await bot.send_message(
+            chat_id,
+            "Коллекция пуста.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+            ])
+        )
+    else:
+        await bot.send_message(chat_id, "📚 Ваша коллекция:", reply_markup=keyboard)
+
+
+@callback_router.prefix("collection_page_")
+async def cb_collection_page(callback: types.CallbackQuery, chat_id: int, data: str, old_msg_id: int):
+    page = int(data.split("_")[2])
+    total_items = await get_collection_count(chat_id)
+    total_pages = (total_items + 3) // 4  # Округление вверх
+    keyboard = await kb_collection(chat_id, page, total_pages)
+    try:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=old_msg_id, reply_markup=keyboard)
+    except Exception:
+        pass
+
+
+@callback_router.action("show_collection_item")
+async def cb_show_collection_item(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    tmdb_id, type_ = data.tmdb_id, data.type_
+
+    details = await get_item_details(type_, tmdb_id)
+    if not details:
+        await callback.message.answer("Не удалось загрузить данные.")
         return
 
-    # Поиск по жанрам (с применением фильтров)
-    if data == "search_genre":
-        await navigate_to_menu(chat_id, old_msg_id, "Выберите тип:",
-                               InlineKeyboardMarkup(inline_keyboard=[
-                                   [InlineKeyboardButton(text="🎬 Фильмы", callback_data="genre_type_movie")],
-                                   [InlineKeyboardButton(text="📺 Сериалы", callback_data="genre_type_tv")],
-                                   [InlineKeyboardButton(text="⬅️ Назад", callback_data="search_menu")],
-                               ]))
-        return
+    title = details.get("title") or details.get("name") or "Без названия"
+    year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+    rating = details.get("vote_average") or "—"
+    overview = details.get("overview") or "Описание отсутствует."
+    poster = details.get("poster_path")
+    avg_ratings = await get_ratings(tmdb_id, type_)
+
+    user_rating = await get_user_rating(chat_id, tmdb_id, type_)
+    watched = user_rating["watched"] if user_rating else False
+    liked = user_rating["liked"] if user_rating else None
+    disliked = user_rating["disliked"] if user_rating else None
+    is_hidden = user_rating["is_hidden"] if user_rating else False  # Получаем статус скрытия
+
+    caption = f"{title} ({year})\nРейтинг: {rating} (TMDB) | 👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}"
+
+    if watched:
+        caption += "\n✅ Вы смотрели"
+
+    if is_hidden:
+        caption += "\n🙈 Скрыто от друзей"
 
-    if data in ("genre_type_movie", "genre_type_tv"):
-        type_ = "movie" if data == "genre_type_movie" else "tv"
-        await navigate_to_menu(chat_id, old_msg_id, "Выберите жанр:", kb_genres(type_))
-        return
+    caption += f"\n\n{overview}"
 
-    # Обновленный обработчик для выбора жанра (с применением фильтров)
-    if data.startswith("genre_"):
-        parts = data.split("_")
-        if len(parts) < 3:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
-        type_ = parts[1]
-        gid = int(parts[2])
+    try:
+        await bot.delete_message(chat_id, old_msg_id)
+    except Exception:
+        pass
 
-        # Получаем активные фильтры пользователя
-        current_filters = await get_current_filters(chat_id)
+    if poster:
+        await send_poster(chat_id, poster, caption=caption,
+                          reply_markup=await kb_collection_item(tmdb_id, type_, watched, liked, disliked, is_hidden))
+    else:
+        await bot.send_message(chat_id, text=caption,
+                               reply_markup=await kb_collection_item(tmdb_id, type_, watched, liked, disliked, is_hidden))
 
-        items = await discover_tmdb(type_, genre_id=gid, filters=current_filters)  # ДОБАВЬ await
-        if not items:
-            await callback.message.answer("По этому жанру ничего не найдено.")
-            return
-        user_sessions[chat_id] = {
-            "results": items,
-            "index": 0,
-            "type": type_,
-            "genre_id": gid,
-            "mode": "genre"
-        }
-        await send_card(chat_id, old_msg_id)
-        return
 
-    # Обновленный обработчик для кнопки "Следующий"
-    if data == "next_item":
-        session = user_sessions.get(chat_id)
-        if not session or "results" not in session:
-            await callback.answer("Сначала сделайте выбор.")
-            return
-        session["index"] += 1
-        is_genre_search = session.get("mode") == "genre"
-        await send_card(chat_id, old_msg_id)
-        return
+# Добавить в коллекцию
+# Добавить в коллекцию
+@callback_router.action("add")
+async def cb_add(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-    # Обновленный обработчик для кнопки "Назад к жанрам"
-    if data.startswith("back_to_genres_"):
-        type_ = data.split("_")[-1]
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except Exception:
-            pass
-        await bot.send_message(chat_id, "Выберите жанр:", reply_markup=kb_genres(type_))
+    # НЕ ИСПОЛЬЗУЕМ СЕССИЮ ИЗ ПОИСКА ПО НАЗВАНИЮ
+    # Вместо этого получаем детали напрямую по tmdb_id
+    details = await get_item_details(type_, tmdb_id)
+    if not details:
+        await callback.answer("Ошибка: не удалось получить данные.")
         return
 
-    # Коллекция
-    if data == "show_collection":
+    title = details.get("title") or details.get("name") or "Без названия"
+    year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+    poster_path = details.get("poster_path") or "/default.jpg"
+
+    success = await add_to_collection(chat_id, tmdb_id, type_, title, year, poster_path)
+    if success:
+        invalidate_card_prefetch(chat_id, tmdb_id)
+        await callback.answer("✅ Добавлено в коллекцию!")
+    else:
+        await callback.answer("❌ Ошибка при добавлении.")
+
+
+# Удалить из коллекции
+@callback_router.action("remove")
+async def cb_remove(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    tmdb_id, type_ = data.tmdb_id, data.type_
+    success = await remove_from_collection(chat_id, tmdb_id, type_)
+    if success:
+        invalidate_card_prefetch(chat_id, tmdb_id)
+        await callback.answer("Удалено из коллекции!")
         try:
-            await bot.delete_message(chat_id, old_msg_id)
+            await bot.delete_message(chat_id, callback.message.message_id)
         except Exception:
             pass
         total_items = await get_collection_count(chat_id)
-        total_pages = (total_items + 3) // 4  # Округление вверх
-        keyboard = await kb_collection(chat_id, 0, total_pages)
+        total_pages = (total_items + 3) // 4
         if total_pages == 0:
             await bot.send_message(
                 chat_id,
@@ -3861,209 +6019,71 @@ async def handle_callback(callback: types.CallbackQuery):
                 ])
             )
         else:
+            keyboard = await kb_collection(chat_id, 0, total_pages)
             await bot.send_message(chat_id, "📚 Ваша коллекция:", reply_markup=keyboard)
-        return
-
-    if data.startswith("collection_page_"):
-        page = int(data.split("_")[2])
-        total_items = await get_collection_count(chat_id)
-        total_pages = (total_items + 3) // 4  # Округление вверх
-        keyboard = await kb_collection(chat_id, page, total_pages)
-        try:
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=old_msg_id, reply_markup=keyboard)
-        except Exception:
-            pass
-        return
-
-    if data.startswith("show_collection_item_"):
-        parts = data.split("_")
-        if len(parts) < 4:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
-        try:
-            tmdb_id = int(parts[3])
-            type_ = parts[4]
-        except (ValueError, IndexError) as e:
-            await callback.answer("Ошибка: некорректный ID.")
-            return
-
-        details = get_item_details(type_, tmdb_id)
-        if not details:
-            await callback.message.answer("Не удалось загрузить данные.")
-            return
-
-        title = details.get("title") or details.get("name") or "Без названия"
-        year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
-        rating = details.get("vote_average") or "—"
-        overview = details.get("overview") or "Описание отсутствует."
-        poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
-        avg_ratings = await get_ratings(tmdb_id, type_)
-
-        user_rating = await get_user_rating(chat_id, tmdb_id, type_)
-        watched = user_rating["watched"] if user_rating else False
-        liked = user_rating["liked"] if user_rating else None
-        disliked = user_rating["disliked"] if user_rating else None
-        is_hidden = user_rating["is_hidden"] if user_rating else False  # Получаем статус скрытия
+    else:
+        await callback.answer("Ошибка при удалении.")
 
-        caption = f"{title} ({year})\nРейтинг: {rating} (TMDB) | 👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}"
 
-        if watched:
-            caption += "\n✅ Вы смотрели"
+# Просмотрено
+@callback_router.action("like")
+async def cb_like(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    await handle_rating(callback, "like", data.tmdb_id, data.type_)
 
-        if is_hidden:
-            caption += "\n🙈 Скрыто от друзей"
 
-        caption += f"\n\n{overview}"
+@callback_router.action("dislike")
+async def cb_dislike(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    await handle_rating(callback, "dislike", data.tmdb_id, data.type_)
 
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except Exception:
-            pass
 
-        if poster:
-            await bot.send_photo(chat_id, photo=poster, caption=caption,
-                                 reply_markup=kb_collection_item(tmdb_id, type_, watched, liked, disliked, is_hidden))
-        else:
-            await bot.send_message(chat_id, text=caption,
-                                   reply_markup=kb_collection_item(tmdb_id, type_, watched, liked, disliked, is_hidden))
-        return
+@callback_router.action("reset_rating")
+async def cb_reset_rating(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    await handle_rating(callback, "reset", data.tmdb_id, data.type_)
 
-    # Добавить в коллекцию
-    # Добавить в коллекцию
-    if data.startswith("add_"):
-        parts = data.split("_")
-        if len(parts) < 3:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
 
-        tmdb_id = int(parts[1])
-        type_ = parts[2]
+@callback_router.action("mark_watched")
+async def cb_mark_watched(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    await handle_rating(callback, "watch", data.tmdb_id, data.type_)
 
-        # НЕ ИСПОЛЬЗУЕМ СЕССИЮ ИЗ ПОИСКА ПО НАЗВАНИЮ
-        # Вместо этого получаем детали напрямую по tmdb_id
-        details = get_item_details(type_, tmdb_id)
-        if not details:
-            await callback.answer("Ошибка: не удалось получить данные.")
-            return
 
-        title = details.get("title") or details.get("name") or "Без названия"
-        year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
-        poster_path = details.get("poster_path") or "/default.jpg"
+# Обработчик скрытия/показа оценки
+@callback_router.action("toggle_hide")
+async def cb_toggle_hide(callback: types.CallbackQuery, chat_id: int, data: CallbackPayload, old_msg_id: int):
+    tmdb_id, type_ = data.tmdb_id, data.type_
 
-        success = await add_to_collection(chat_id, tmdb_id, type_, title, year, poster_path)
-        if success:
-            await callback.answer("✅ Добавлено в коллекцию!")
-        else:
-            await callback.answer("❌ Ошибка при добавлении.")
-        return
+    details = await get_item_details(type_, tmdb_id)
+    title = details.get("title") or details.get("name") or "Без названия"
 
-    # Удалить из коллекции
-    if data.startswith("remove_"):
-        parts = data.split("_")
-        if len(parts) < 3:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
-        tmdb_id = int(parts[1])
-        type_ = parts[2]
-        success = await remove_from_collection(chat_id, tmdb_id, type_)
-        if success:
-            await callback.answer("Удалено из коллекции!")
-            try:
-                await bot.delete_message(chat_id, callback.message.message_id)
-            except Exception:
-                pass
-            total_items = await get_collection_count(chat_id)
-            total_pages = (total_items + 3) // 4
-            if total_pages == 0:
-                await bot.send_message(
-                    chat_id,
-                    "Коллекция пуста.",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-                    ])
-                )
-            else:
-                keyboard = await kb_collection(chat_id, 0, total_pages)
-                await bot.send_message(chat_id, "📚 Ваша коллекция:", reply_markup=keyboard)
-        else:
-            await callback.answer("Ошибка при удалении.")
-        return
+    # Получаем текущий статус
+    user_rating = await get_user_rating(chat_id, tmdb_id, type_)
+    current_hidden = user_rating["is_hidden"] if user_rating else False
 
-    # Просмотрено
-    if data.startswith("like_"):
-        await handle_rating(callback, "like")
-        return
-    if data.startswith("dislike_"):
-        await handle_rating(callback, "dislike")
-        return
-    if data.startswith("reset_rating_"):
-        parts = data.split("_")
-        if len(parts) < 4:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
-        try:
-            tmdb_id = int(parts[2])
-            type_ = parts[3]
-            await handle_rating(callback, "reset", tmdb_id, type_)
-        except (ValueError, IndexError):
-            await callback.answer("Ошибка: некорректные данные.")
-        return
+    # Переключаем статус
+    new_hidden = not current_hidden
 
-    if data.startswith("mark_watched_"):
-        await handle_rating(callback, "watch")
+    # Обновляем оценку (ТОЛЬКО is_hidden, остальные поля UPSERT не трогает)
+    user_rating_updated = await add_rating(chat_id, tmdb_id, type_, is_hidden=new_hidden, title=title)
+    if user_rating_updated is None:
+        await callback.answer("❌ Не удалось сохранить оценку")
         return
+    invalidate_card_prefetch(chat_id, tmdb_id)
 
-    # Обработчик скрытия/показа оценки
-    if data.startswith("toggle_hide_"):
-        parts = data.split("_")
-        if len(parts) < 4:
-            await callback.answer("Ошибка: некорректные данные.")
-            return
-
-        tmdb_id = int(parts[2])
-        type_ = parts[3]
-
-        details = get_item_details(type_, tmdb_id)
-        title = details.get("title") or details.get("name") or "Без названия"
-
-        # Получаем текущий статус
-        user_rating = await get_user_rating(chat_id, tmdb_id, type_)
-        current_hidden = user_rating["is_hidden"] if user_rating else False
-
-        # Переключаем статус
-        new_hidden = not current_hidden
-
-        # Обновляем оценку (ТОЛЬКО is_hidden, сохраняем текущие лайки)
-        await add_rating(
-            chat_id,
-            tmdb_id,
-            type_,
-            is_hidden=new_hidden,
-            title=title,
-            # ЯВНО передаем текущие значения лайков, чтобы они не сбрасывались
-            liked=user_rating.get('liked') if user_rating else None,
-            disliked=user_rating.get('disliked') if user_rating else None,
-            watched=user_rating.get('watched') if user_rating else None
-        )
-
-        if new_hidden:
-            await callback.answer("🙈 Оценка скрыта от друзей")
-        else:
-            await callback.answer("👀 Оценка видна друзьям")
-
-        # Обновляем интерфейс
-        user_rating_updated = await get_user_rating(chat_id, tmdb_id, type_)
-        keyboard = kb_collection_item(
-            tmdb_id,
-            type_,
-            user_rating_updated.get('watched', False),
-            user_rating_updated.get('liked'),
-            user_rating_updated.get('disliked'),
-            user_rating_updated.get('is_hidden', False)
-        )
+    if new_hidden:
+        await callback.answer("🙈 Оценка скрыта от друзей")
+    else:
+        await callback.answer("👀 Оценка видна друзьям")
+
+    # Обновляем интерфейс
+    keyboard = await kb_collection_item(
+        tmdb_id,
+        type_,
+        user_rating_updated.get('watched', False),
+        user_rating_updated.get('liked'),
+        user_rating_updated.get('disliked'),
+        user_rating_updated.get('is_hidden', False)
+    )
 
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-        return
+    await callback.message.edit_reply_markup(reply_markup=keyboard)
 
 
 async def generate_collection_pdf(tg_id: int):
@@ -4131,9 +6151,9 @@ async def generate_collection_pdf(tg_id: int):
         if item['poster_path'] and item['poster_path'] != "/default.jpg":
             try:
                 poster_url = f"https://image.tmdb.org/t/p/w154{item['poster_path']}"
-                response = requests.get(poster_url, timeout=10)
-                if response.status_code == 200:
-                    img_data = io.BytesIO(response.content)
+                content = await fetch_image(poster_url)
+                if content:
+                    img_data = io.BytesIO(content)
                     img_reader = ImageReader(img_data)
                     pdf.drawImage(img_reader, poster_x, poster_y,
                                   width=poster_width, height=poster_height,
@@ -4210,71 +6230,79 @@ async def navigate_to_menu(chat_id, old_msg_id, text, keyboard):
         await bot.send_message(chat_id, text, reply_markup=keyboard)
 
 
-async def send_preference_item(chat_id, old_msg_id=None):
-    session = user_sessions.get(chat_id)
-    if not session or "user_likes" not in session:
-        await bot.send_message(chat_id, "Ошибка сессии.")
-        return
-
-    # Инициализируем список показанных рекомендаций если его нет
-    if "shown_recommendations" not in session:
-        session["shown_recommendations"] = []
-
-    # Случайно выбираем лайкнутый item
-    liked_item = random.choice(session["user_likes"])
-
-    # Получаем рекомендации
-    recommendations = get_recommendations(liked_item["type"], liked_item["tmdb_id"])
+PREFERENCE_SOURCE_ROUNDS = 5  # Сколько лайкнутых перебрать в поисках рекомендаций
 
-    if not recommendations:
-        # Если нет рекомендаций, пробуем другой лайкнутый item
-        await send_preference_item(chat_id, old_msg_id)
-        return
 
-    # Фильтруем уже показанные рекомендации
-    available_recommendations = [r for r in recommendations if r["id"] not in session["shown_recommendations"]]
+def cf_batches(session: dict, user_id: int | None) -> list[tuple[str, list[MediaRef]]]:
+    """Рекомендации по оценкам других пользователей, сгруппированные по типу.
+    Уже показанное и все, что пользователь сам оценил (в том числе дизлайки), не предлагаем"""
+    seeds = [(item["tmdb_id"], item["type"]) for item in session["user_likes"]]
+    exclude = set(session["shown_recommendations"]) | set(cf_model.user_items.get(user_id, ()))
+    refs = cf_model.recommend(seeds, exclude=exclude)
+    return [(type_, [ref for ref in refs if ref.media_type == type_]) for type_ in ("movie", "tv")
+            if any(ref.media_type == type_ for ref in refs)]
 
-    # Если все рекомендации уже показаны, очищаем список
-    if not available_recommendations:
-        session["shown_recommendations"] = []
-        available_recommendations = recommendations
 
-    # Случайно выбираем одну рекомендацию из доступных
-    chosen_item = random.choice(available_recommendations)
+async def preference_batches(session: dict, prefs: dict, user_id: int | None):
+    """Пачки рекомендаций: по очереди из модели оценок пользователей бота и из рекомендаций TMDB
+    к случайным лайкнутым фильмам/сериалам"""
+    session["preference_round"] = session.get("preference_round", 0) + 1
+    batches = cf_batches(session, user_id)
+    if session["preference_round"] % 2:
+        for batch in batches:
+            yield batch
+        batches = []
+    for _ in range(PREFERENCE_SOURCE_ROUNDS):
+        liked_item = random.choice(session["user_likes"])
+        recommendations = await get_recommendations(liked_item["type"], liked_item["tmdb_id"])
+        if not recommendations:
+            candidate_rejections["no_recommendations"] += 1
+            continue
 
-    # Добавляем в список показанных
-    session["shown_recommendations"].append(chosen_item["id"])
+        # Фильтруем уже показанные рекомендации; если показаны все — начинаем заново
+        available = [r for r in recommendations
+                     if (r["id"], liked_item["type"]) not in session["shown_recommendations"]]
+        if not available:
+            session["shown_recommendations"] = []
+            available = recommendations
+        available = prefilter_payload(available, prefs)
+        random.shuffle(available)
+        yield liked_item["type"], to_refs(available, liked_item["type"])
+    for batch in batches:
+        yield batch
 
-    # Проверяем, не забанен ли контент
-    if await is_banned(chosen_item["id"], liked_item["type"]):
-        print(
-            f"DEBUG: Пропускаем забаненный контент в рекомендациях - ID: {chosen_item['id']}, Type: {liked_item['type']}")
-        await send_preference_item(chat_id, old_msg_id)
-        return
 
-    # Получаем детали
-    details = get_item_details(liked_item["type"], chosen_item["id"])
-    if not details:
-        await send_preference_item(chat_id, old_msg_id)
+async def send_preference_item(chat_id, old_msg_id=None):
+    session = user_sessions.get(chat_id)
+    if not session or "user_likes" not in session:
+        await bot.send_message(chat_id, "Ошибка сессии.")
         return
 
-    # Применяем фильтры пользователя
-    filters = await get_user_filters(chat_id)
-    filters = filters or {"exclude_anime": False, "exclude_cartoons": False, "exclude_watched": False}
-
-    if filters["exclude_anime"] and is_anime_by_details(liked_item["type"], details, chosen_item):
-        await send_preference_item(chat_id, old_msg_id)
-        return
+    # Инициализируем список показанных рекомендаций если его нет
+    if "shown_recommendations" not in session:
+        session["shown_recommendations"] = []
 
-    if filters["exclude_cartoons"] and is_cartoons_by_details(liked_item["type"], details, chosen_item):
-        await send_preference_item(chat_id, old_msg_id)
+    prefs = await get_user_filters(chat_id)  # Один раз на весь подбор
+    async with db.acquire() as conn:
+        user_id = await get_user_id(conn, chat_id)
+    candidate = await first_candidate(chat_id, preference_batches(session, prefs, user_id), prefs=prefs)
+    if candidate is None:
+        if old_msg_id:
+            try:
+                await bot.delete_message(chat_id, old_msg_id)
+            except Exception:
+                pass
+        await bot.send_message(
+            chat_id,
+            "😔 Не удалось подобрать рекомендацию по вашим фильтрам. Попробуйте позже или измените фильтры.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔍 Меню поиска", callback_data="search_menu")]
+            ])
+        )
         return
 
-    if filters["exclude_watched"]:
-        user_rating = await get_user_rating(chat_id, chosen_item["id"], liked_item["type"])
-        if user_rating and user_rating["watched"]:
-            await send_preference_item(chat_id, old_msg_id)
-            return
+    chosen_id, type_, details = candidate.item.id, candidate.type_, candidate.details
+    session["shown_recommendations"].append((chosen_id, type_))
 
     # Формируем карточку
     title = details.get("title") or details.get("name") or "Без названия"
@@ -4283,11 +6311,10 @@ async def send_preference_item(chat_id, old_msg_id=None):
     overview = details.get("overview") or "Описание отсутствует."
     if len(overview) > 2000:
         overview = overview[:2000] + "..."
-    poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
+    poster = details.get("poster_path")
 
-    avg_ratings = await get_ratings(chosen_item["id"], liked_item["type"])
-    user_rating = await get_user_rating(chat_id, chosen_item["id"], liked_item["type"])
-    watched_text = "✅ Вы смотрели" if user_rating and user_rating["watched"] else ""
+    avg_ratings = await get_ratings(chosen_id, type_)
+    watched_text = "✅ Вы смотрели" if await is_watched(chat_id, chosen_id, type_) else ""
 
     caption = (
         f"{title} ({year})\n"
@@ -4310,7 +6337,7 @@ async def send_preference_item(chat_id, old_msg_id=None):
 
     # Клавиатура для рекомендаций
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ В коллекцию", callback_data=f"add_{chosen_item['id']}_{liked_item['type']}")],
+        [InlineKeyboardButton(text="➕ В коллекцию", callback_data=encode_callback("add", chosen_id, type_))],
         [InlineKeyboardButton(text="➡️ Следующая рекомендация", callback_data="next_preference")],
         [InlineKeyboardButton(text="🔍 Меню поиска", callback_data="search_menu")]
     ])
@@ -4323,12 +6350,7 @@ async def send_preference_item(chat_id, old_msg_id=None):
 
     try:
         if poster:
-            # Дополнительная проверка URL
-            if poster.startswith('http') and len(poster) > 10:
-                await bot.send_photo(chat_id, photo=poster, caption=caption, reply_markup=keyboard)
-            else:
-                # Если poster невалидный, отправляем текстовое сообщение
-                await bot.send_message(chat_id, text=caption, reply_markup=keyboard)
+            await send_poster(chat_id, poster, caption=caption, reply_markup=keyboard)
         else:
             await bot.send_message(chat_id, text=caption, reply_markup=keyboard)
     except Exception as e:
@@ -4340,17 +6362,17 @@ async def send_preference_item(chat_id, old_msg_id=None):
 async def send_friend_request(from_tg_id: int, to_tg_id: int):
     """Отправляет заявку в друзья"""
     async with db.acquire() as conn:
-        from_user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", from_tg_id)
-        to_user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", to_tg_id)
+        from_user_id = await get_user_id(conn, from_tg_id)
+        to_user_id = await get_user_id(conn, to_tg_id)
 
-        if not from_user or not to_user or from_user["user_id"] == to_user["user_id"]:
+        if from_user_id is None or to_user_id is None or from_user_id == to_user_id:
             return False
 
         # Проверяем, нет ли уже заявки
         existing = await conn.fetchrow("""
             SELECT 1 FROM friend_requests 
             WHERE from_user_id = $1 AND to_user_id = $2 AND status = 'pending'
-        """, from_user["user_id"], to_user["user_id"])
+        """, from_user_id, to_user_id)
 
         if existing:
             return "already_sent"
@@ -4360,7 +6382,7 @@ async def send_friend_request(from_tg_id: int, to_tg_id: int):
             VALUES ($1, $2, 'pending')
             ON CONFLICT (from_user_id, to_user_id) DO UPDATE 
             SET status = 'pending', created_at = NOW()
-        """, from_user["user_id"], to_user["user_id"])
+        """, from_user_id, to_user_id)
 
         return True
 
@@ -4395,24 +6417,27 @@ async def accept_friend_request(request_id: int):
         return request
 
 
+SQL_PENDING_REQUESTS = """
+    SELECT 
+        fr.request_id,
+        fr.created_at,
+        u.tg_id,
+        u.username
+    FROM friend_requests fr
+    JOIN users u ON fr.from_user_id = u.user_id
+    WHERE fr.to_user_id = $1 AND fr.status = 'pending'
+    ORDER BY fr.created_at DESC
+"""
+
+
 async def get_pending_friend_requests(tg_id: int):
     """Получает входящие заявки в друзья"""
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return []
 
-        rows = await conn.fetch("""
-            SELECT 
-                fr.request_id,
-                fr.created_at,
-                u.tg_id,
-                u.username
-            FROM friend_requests fr
-            JOIN users u ON fr.from_user_id = u.user_id
-            WHERE fr.to_user_id = $1 AND fr.status = 'pending'
-            ORDER BY fr.created_at DESC
-        """, user["user_id"])
+        rows = await conn.fetch(SQL_PENDING_REQUESTS, user_id)
 
         return rows
 
@@ -4436,32 +6461,15 @@ async def send_friend_recommendation_card(chat_id, old_msg_id=None):
     tmdb_id = rec.get('tmdb_id')
     type_ = rec.get('type', 'movie')
 
-    # Получаем реальные username друзей из БД
+    # Кто из друзей лайкнул — одна строка из friend_signals
     friend_usernames = []
+    friend_likes = 0
     try:
-        async with db.acquire() as conn:
-            # Получаем username друзей которые лайкнули этот контент
-            query = """
-            SELECT u.username 
-            FROM ratings r
-            JOIN users u ON r.user_id = u.user_id
-            WHERE r.tmdb_id = $1 AND r.type = $2 AND r.liked = true
-            AND u.user_id IN (
-                SELECT friend_user_id FROM user_friends WHERE user_id = (
-                    SELECT user_id FROM users WHERE tg_id = $3
-                )
-                UNION
-                SELECT user_id FROM user_friends WHERE friend_user_id = (
-                    SELECT user_id FROM users WHERE tg_id = $3
-                )
-            )
-            AND u.username IS NOT NULL AND u.username != ''
-            """
-            user_result = await conn.fetchval("SELECT user_id FROM users WHERE tg_id = $1", chat_id)
-            if user_result:
-                friends_data = await conn.fetch(query, tmdb_id, type_, chat_id)
-                friend_usernames = [friend['username'] for friend in friends_data if friend['username']]
-    except Exception as e:
+        signal = await get_friend_signal(chat_id, tmdb_id, type_)
+        if signal:
+            friend_usernames = list(signal["liker_names"])
+            friend_likes = signal["liker_count"]
+    except (OSError, asyncpg.PostgresError) as e:
         print(f"Error getting friend usernames: {e}")
 
     # Формируем упоминания
@@ -4481,15 +6489,13 @@ async def send_friend_recommendation_card(chat_id, old_msg_id=None):
     else:
         friends_mention = "друзья"
 
-    friend_likes = len(friend_usernames)
-
     # Получаем детали
-    details = get_item_details(type_, tmdb_id)
+    details = await get_item_details(type_, tmdb_id)
 
     if details:
         year = (details.get('release_date') or details.get('first_air_date') or '')[:4]
         rating = details.get('vote_average', '—')
-        poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get('poster_path') else None
+        poster = details.get('poster_path')
     else:
         year = "—"
         rating = "—"
@@ -4511,7 +6517,7 @@ async def send_friend_recommendation_card(chat_id, old_msg_id=None):
         keyboard.append([InlineKeyboardButton(text="✅ В коллекции", callback_data="already_in_collection")])
     else:
         keyboard.append(
-            [InlineKeyboardButton(text="➕ В коллекцию", callback_data=f"add_{tmdb_id}_{type_}")])
+            [InlineKeyboardButton(text="➕ В коллекцию", callback_data=encode_callback("add", tmdb_id, type_))])
 
     keyboard.append([InlineKeyboardButton(text="➡️ Следующая рекомендация", callback_data="next_friend_rec")])
     keyboard.append([InlineKeyboardButton(text="👥 К друзьям", callback_data="friends_menu")])
@@ -4524,9 +6530,9 @@ async def send_friend_recommendation_card(chat_id, old_msg_id=None):
             pass
 
     if poster:
-        await bot.send_photo(
+        await send_poster(
             chat_id,
-            photo=poster,
+            poster,
             caption=caption,
             reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard),
             parse_mode="HTML"
@@ -4553,12 +6559,7 @@ async def send_person_results_page(chat_id: int, results: list, search_query: st
     keyboard = []
 
     for item in page_results:
-        name = item.get("name", "Без имени")
-        known_for = item.get("known_for_department", "Актер")
-
-        # Получаем известные работы для отображения
-
-        btn_text = f"🎭 {name}"
+        btn_text = f"🎭 {item.title}"
 
         # Обрезаем текст если слишком длинный
         if len(btn_text) > 50:
@@ -4567,7 +6568,7 @@ async def send_person_results_page(chat_id: int, results: list, search_query: st
         keyboard.append([
             InlineKeyboardButton(
                 text=btn_text,
-                callback_data=f"select_person_{item['id']}"
+                callback_data=f"select_person_{item.id}"
             )
         ])
 
@@ -4603,17 +6604,12 @@ async def send_person_filmography_page(chat_id: int, filmography: list, person_n
     keyboard = []
 
     for i, item in enumerate(page_results, start=start_idx + 1):
-        media_type = item.get("media_type")
-        title = item.get("title") or "Без названия"
-        year = (item.get("release_date") or "")[:4]
-        roles = item.get("person_role", [])  # Теперь это список ролей
-
         # Формируем текст кнопки
-        type_icon = "🎬" if media_type == "movie" else "📺"
+        type_icon = "🎬" if item.media_type == "movie" else "📺"
 
-        btn_text = f"{type_icon} {title}"
-        if year:
-            btn_text += f" ({year})"
+        btn_text = f"{type_icon} {item.title}"
+        if item.year:
+            btn_text += f" ({item.year})"
 
         # Добавляем информацию о ролях
 
@@ -4625,7 +6621,7 @@ async def send_person_filmography_page(chat_id: int, filmography: list, person_n
         keyboard.append([
             InlineKeyboardButton(
                 text=btn_text,
-                callback_data=f"select_{item['id']}_{media_type}"
+                callback_data=encode_callback("select", item.id, item.media_type)
             )
         ])
 
@@ -4646,209 +6642,274 @@ async def send_person_filmography_page(chat_id: int, filmography: list, person_n
     return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-# Обновленная функция send_card
-# Обновленная функция send_card
-async def send_card(chat_id, old_msg_id=None):
-    session = user_sessions.get(chat_id)
-    if not session or "results" not in session:
-        await bot.send_message(chat_id, "❌ Сессия истекла. Начните поиск заново.")
-        return
+# Предзагрузка карточек: пока пользователь читает текущую карточку, в фоне готовятся
+# следующие (проверки, детали, подпись, клавиатура). Хранится только в памяти процесса
+CARD_PREFETCH_DEPTH = 2
+CARD_PREFETCH_TTL = 300  # секунд; дольше счетчики лайков и статус коллекции могут устареть
+CARD_REFILL_ATTEMPTS = 3  # Сколько раз подгружать новую выборку, если в текущей ничего не подошло
+card_prefetch: dict[int, dict] = {}
+card_prefetch_stats = {"hits": 0, "misses": 0, "invalidated": 0}
 
-    print(
-        f"DEBUG: send_card - session type: {session.get('type')}, results count: {len(session['results'])}, index: {session['index']}")
 
-    # Инициализируем множество показанных ID если его нет
-    if "shown_ids" not in session:
-        session["shown_ids"] = set()
+class RenderedCard(NamedTuple):
+    tmdb_id: int
+    type_: str
+    index: int  # Позиция в session["results"]
+    caption: str
+    poster: str | None  # poster_path TMDB
+    keyboard: InlineKeyboardMarkup
+    created: float
 
-    # Если достигли конца списка или нужно загрузить новые результаты
-    if session["index"] >= len(session["results"]) or len(session["results"]) == 0:
-        print(f"DEBUG: Загружаем новые результаты, показано уже: {len(session['shown_ids'])}")
 
-        # Получаем активные фильтры
-        current_filters = await get_current_filters(chat_id)
+def browse_token(session: dict) -> int:
+    """Метка выдачи: новая сессия поиска получает новую метку, и старая предзагрузка к ней не подходит"""
+    if "browse_token" not in session:
+        session["browse_token"] = random.getrandbits(32)
+    return session["browse_token"]
 
-        # Загружаем новые результаты
-        new_results = await discover_tmdb(
-            session["type"],
-            session.get("genre_id"),
-            filters=current_filters
-        )
 
-        if not new_results:
-            if old_msg_id:
-                try:
-                    await bot.delete_message(chat_id, old_msg_id)
-                except Exception:
-                    pass
+async def render_card(chat_id: int, session: dict, start: int, priority: int = PRIORITY_INTERACTIVE,
+                      prefs: dict | None = None) -> RenderedCard | None:
+    """Находит первую подходящую карточку начиная с позиции start и готовит ее к отправке"""
+    type_ = session["type"]
+    candidate = await first_candidate(chat_id, single_batch(type_, session["results"][start:]),
+                                      skip=session["shown_ids"], priority=priority, prefs=prefs)
+    if candidate is None:
+        return None
+    item, details = candidate.item, candidate.details
 
-            await bot.send_message(
-                chat_id,
-                "❌ Не удалось загрузить новые результаты. Попробуйте изменить фильтры.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🎲 Новый поиск", callback_data="search_menu")],
-                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-                ])
-            )
-            return
+    title = details.get("title") or details.get("name") or "Без названия"
+    year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
+    rating = details.get("vote_average") or "—"
+    overview = details.get("overview") or "Описание отсутствует."
+    if len(overview) > 2000:
+        overview = overview[:2000] + "..."
+    poster = details.get("poster_path")
+    avg_ratings = await get_ratings(item.id, type_)
+    watched_text = "✅ Вы смотрели" if await is_watched(chat_id, item.id, type_) else ""
 
-        # Фильтруем уже показанные элементы
-        filtered_results = []
-        for item in new_results:
-            if item["id"] not in session["shown_ids"]:
-                filtered_results.append(item)
+    header = (
+        f"{title} ({year})\n"
+        f"Рейтинг: {rating} (TMDB)\n"
+        f"👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n"
+        f"{watched_text}\n\n"
+    )
+    if len(header) + len(overview) > 4096:
+        overview = overview[:4096 - len(header)] + "..."
 
-        if not filtered_results:
-            # Если все новые результаты уже были показаны
-            if old_msg_id:
-                try:
-                    await bot.delete_message(chat_id, old_msg_id)
-                except Exception:
-                    pass
+    keyboard = await kb_card(chat_id, item.id, type_, session.get("mode") == "genre",
+                             session.get("mode") == "trending")
+    return RenderedCard(item.id, type_, start + candidate.pos, header + overview, poster, keyboard, time.monotonic())
 
-            await bot.send_message(
-                chat_id,
-                "🎬 Показаны все доступные результаты по вашим фильтрам!\n\nПопробуйте изменить фильтры или начать новый поиск.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⚡ Изменить фильтры", callback_data="search_filters")],
-                    [InlineKeyboardButton(text="🎲 Новый поиск", callback_data="search_menu")],
-                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
-                ])
-            )
-            return
 
-        # Обновляем сессию
-        session["results"] = filtered_results
-        session["index"] = 0
-        print(f"DEBUG: Загружено {len(filtered_results)} новых результатов (после фильтрации)")
+async def deliver_card(chat_id: int, card: RenderedCard, old_msg_id=None):
+    """Отправляет готовую карточку вместо старого сообщения"""
+    if old_msg_id:
+        try:
+            await bot.delete_message(chat_id, old_msg_id)
+        except Exception:
+            pass
 
-    item = session["results"][session["index"]]
-    print(f"DEBUG: Processing item {session['index']}: {item.get('title') or item.get('name')}")
+    if card.poster:
+        await send_poster(chat_id, card.poster, caption=card.caption, reply_markup=card.keyboard)
+    else:
+        await bot.send_message(chat_id, text=card.caption, reply_markup=card.keyboard)
 
-    # Пропускаем забаненные фильмы и применяем фильтры
-    max_attempts = len(session["results"])
-    attempts = 0
 
-    while attempts < max_attempts and session["index"] < len(session["results"]):
-        item = session["results"][session["index"]]
+async def prefetch_cards(chat_id: int, session: dict, entry: dict):
+    """Готовит следующие карточки в фоне"""
+    try:
+        start = session["index"]
+        prefs = await get_user_filters(chat_id)
+        while len(entry["cards"]) < CARD_PREFETCH_DEPTH:
+            card = await render_card(chat_id, session, start, priority=PRIORITY_BACKGROUND, prefs=prefs)
+            if card is None:
+                break
+            entry["cards"].append(card)
+            start = card.index + 1
+    except Exception as e:
+        print(f"Ошибка предзагрузки карточки для {chat_id}: {e}")
 
-        # Проверяем бан
-        if await is_banned(item["id"], session["type"]):
-            print(f"DEBUG: Пропускаем забаненный контент - ID: {item['id']}")
-            session["index"] += 1
-            attempts += 1
-            continue
 
-        # Получаем детали
-        details = get_item_details(session["type"], item["id"])
-        if not details:
-            session["index"] += 1
-            attempts += 1
-            continue
+def schedule_card_prefetch(chat_id: int, session: dict):
+    """Запускает предзагрузку следующих карточек для сессии"""
+    invalidate_card_prefetch(chat_id, count=False)
+    entry = {"token": browse_token(session), "cards": []}
+    entry["task"] = asyncio.create_task(prefetch_cards(chat_id, session, entry))
+    card_prefetch[chat_id] = entry
 
-        # Применяем фильтры пользователя
-        filters = await get_user_filters(chat_id)
-        filters = filters or {"exclude_anime": False, "exclude_cartoons": False, "exclude_watched": False}
 
-        if filters["exclude_anime"] and is_anime_by_details(session["type"], details, item):
-            session["index"] += 1
-            attempts += 1
-            continue
+def invalidate_card_prefetch(chat_id: int, tmdb_id: int | None = None, count: bool = True):
+    """Сбрасывает предзагруженные карточки чата (или только если среди них есть tmdb_id)"""
+    entry = card_prefetch.get(chat_id)
+    if entry is None:
+        return
+    if tmdb_id is not None and entry["task"].done() and all(card.tmdb_id != tmdb_id for card in entry["cards"]):
+        return
+    del card_prefetch[chat_id]
+    entry["task"].cancel()
+    if count:
+        card_prefetch_stats["invalidated"] += 1
 
-        if filters["exclude_cartoons"] and is_cartoons_by_details(session["type"], details, item):
-            session["index"] += 1
-            attempts += 1
-            continue
 
-        if filters["exclude_watched"]:
-            user_rating = await get_user_rating(chat_id, item["id"], session["type"])
-            if user_rating and user_rating["watched"]:
-                session["index"] += 1
-                attempts += 1
-                continue
+async def take_prefetched_card(chat_id: int, session: dict) -> RenderedCard | None:
+    """Забирает готовую следующую карточку, если она еще соответствует сессии"""
+    entry = card_prefetch.get(chat_id)
+    if entry is None or entry["token"] != session.get("browse_token"):
+        return None
+    if not entry["cards"] and not entry["task"].done():
+        # Карточка еще готовится с фоновым приоритетом: не ждем ее за PDF и фильмографиями, а отменяем
+        # предзагрузку. send_card соберет карточку сам с интерактивным приоритетом, и уже начатые
+        # запросы предзагрузки поднимутся до него, когда tmdb_get присоединит к ним новые
+        invalidate_card_prefetch(chat_id, count=False)
+        return None
+    results = session["results"]
+    now = time.monotonic()
+    while entry["cards"]:
+        card = entry["cards"].pop(0)
+        if (card.index >= session["index"] and card.index < len(results)
+                and results[card.index].id == card.tmdb_id and card.tmdb_id not in session["shown_ids"]
+                and now - card.created < CARD_PREFETCH_TTL):
+            return card
+    return None
 
-        # Если все проверки пройдены, показываем карточку
-        title = details.get("title") or details.get("name") or "Без названия"
-        year = (details.get("release_date") or details.get("first_air_date") or "")[:4]
-        rating = details.get("vote_average") or "—"
-        overview = details.get("overview") or "Описание отсутствует."
-        if len(overview) > 2000:
-            overview = overview[:2000] + "..."
-        poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
-        avg_ratings = await get_ratings(item["id"], session["type"])
-        user_rating = await get_user_rating(chat_id, item["id"], session["type"])
-        watched_text = "✅ Вы смотрели" if user_rating and user_rating["watched"] else ""
-
-        # Общая информация о прогрессе
-        total_shown = len(session["shown_ids"]) + 1
-        caption = (
-            f"{title} ({year})\n"
-            f"Рейтинг: {rating} (TMDB)\n"
-            f"👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n"
-            f"{watched_text}\n\n{overview}"
-        )
 
-        if len(caption) > 4096:
-            max_overview_len = 4096 - len(
-                f"{title} ({year})\nРейтинг: {rating} (TMDB)\n👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n{watched_text}\n\n"
-            )
-            overview = overview[:max_overview_len] + "..."
-            caption = (
-                f"{title} ({year})\n"
-                f"Рейтинг: {rating} (TMDB)\n"
-                f"👍 Лайки: {avg_ratings['likes']} | 👎 Дизлайки: {avg_ratings['dislikes']} | 👀 Просмотров: {avg_ratings['watches']}\n"
-                f"{watched_text}\n\n{overview}"
-            )
+def sweep_card_prefetch():
+    """Удаляет устаревшие предзагрузки"""
+    now = time.monotonic()
+    for chat_id, entry in list(card_prefetch.items()):
+        if entry["task"].done() and all(now - card.created >= CARD_PREFETCH_TTL for card in entry["cards"]):
+            del card_prefetch[chat_id]
+
+
+async def send_card(chat_id, old_msg_id=None):
+    session = user_sessions.get(chat_id)
+    if not session or "results" not in session:
+        await bot.send_message(chat_id, "❌ Сессия истекла. Начните поиск заново.")
+        return
+
+    print(
+        f"DEBUG: send_card - session type: {session.get('type')}, results count: {len(session['results'])}, index: {session['index']}")
+
+    # Инициализируем множество показанных ID если его нет
+    if "shown_ids" not in session:
+        session["shown_ids"] = set()
+
+    card = await take_prefetched_card(chat_id, session)
+    if card is not None:
+        card_prefetch_stats["hits"] += 1
+    else:
+        card_prefetch_stats["misses"] += 1
+        prefs = await get_user_filters(chat_id)  # Один раз на весь подбор
+        for _ in range(CARD_REFILL_ATTEMPTS):
+            # Если достигли конца списка или нужно загрузить новые результаты
+            if session["index"] >= len(session["results"]) or len(session["results"]) == 0:
+                print(f"DEBUG: Загружаем новые результаты, показано уже: {len(session['shown_ids'])}")
+
+                # Получаем активные фильтры
+                current_filters = await get_current_filters(chat_id)
+
+                # Загружаем новые результаты
+                new_results = await discover_tmdb(
+                    session["type"],
+                    session.get("genre_id"),
+                    filters=current_filters,
+                    prefs=prefs
+                )
+
+                if not new_results:
+                    if old_msg_id:
+                        try:
+                            await bot.delete_message(chat_id, old_msg_id)
+                        except Exception:
+                            pass
+
+                    await bot.send_message(
+                        chat_id,
+                        "❌ Не удалось загрузить новые результаты. Попробуйте изменить фильтры.",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(text="🎲 Новый поиск", callback_data="search_menu")],
+                            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+                        ])
+                    )
+                    return
+
+                # Фильтруем уже показанные элементы
+                filtered_results = []
+                for item in new_results:
+                    if item["id"] not in session["shown_ids"]:
+                        filtered_results.append(item)
+
+                if not filtered_results:
+                    # Если все новые результаты уже были показаны
+                    if old_msg_id:
+                        try:
+                            await bot.delete_message(chat_id, old_msg_id)
+                        except Exception:
+                            pass
+
+                    await bot.send_message(
+                        chat_id,
+                        "🎬 Показаны все доступные результаты по вашим фильтрам!\n\nПопробуйте изменить фильтры или начать новый поиск.",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(text="⚡ Изменить фильтры", callback_data="search_filters")],
+                            [InlineKeyboardButton(text="🎲 Новый поиск", callback_data="search_menu")],
+                            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+                        ])
+                    )
+                    return
 
-        # Добавляем ID в показанные
-        session["shown_ids"].add(item["id"])
+                # Обновляем сессию
+                session["results"] = to_refs(filtered_results, session["type"])
+                session["index"] = 0
+                session["browse_token"] = random.getrandbits(32)  # Старая предзагрузка к новой выборке не подходит
+                print(f"DEBUG: Загружено {len(filtered_results)} новых результатов (после фильтрации)")
 
-        is_genre_search = session.get("mode") == "genre"
-        is_trending = session.get("mode") == "trending"
+            card = await render_card(chat_id, session, session["index"], prefs=prefs)
+            if card is not None:
+                break
+            # В текущей выборке ничего не подошло — загрузим новые результаты
+            session["index"] = len(session["results"])
 
+    if card is None:
         if old_msg_id:
             try:
                 await bot.delete_message(chat_id, old_msg_id)
             except Exception:
                 pass
 
-        if poster:
-            await bot.send_photo(chat_id, photo=poster, caption=caption,
-                                 reply_markup=await kb_card(chat_id, item["id"], session["type"], is_genre_search,
-                                                            is_trending))
-        else:
-            await bot.send_message(chat_id, text=caption,
-                                   reply_markup=await kb_card(chat_id, item["id"], session["type"], is_genre_search,
-                                                              is_trending))
-
-        # Увеличиваем индекс для следующего вызова
-        session["index"] += 1
+        await bot.send_message(
+            chat_id,
+            "😔 Не нашлось подходящих карточек по вашим фильтрам.\n\nПопробуйте изменить фильтры или начать новый поиск.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⚡ Изменить фильтры", callback_data="search_filters")],
+                [InlineKeyboardButton(text="🎲 Новый поиск", callback_data="search_menu")],
+                [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_main")]
+            ])
+        )
         return
 
-    # Если не нашли подходящий контент в текущей выборке
-    if old_msg_id:
-        try:
-            await bot.delete_message(chat_id, old_msg_id)
-        except Exception:
-            pass
+    # Добавляем ID в показанные и сдвигаем индекс для следующего вызова
+    session["shown_ids"].add(card.tmdb_id)
+    session["index"] = card.index + 1
+    await deliver_card(chat_id, card, old_msg_id)
+    schedule_card_prefetch(chat_id, session)
 
-    # Пробуем загрузить новые результаты
-    session["index"] = len(session["results"])  # Принудительно загрузим новые результаты
-    await send_card(chat_id)
+SQL_GET_USER_RATING = """
+    SELECT liked, disliked, watched, is_hidden
+    FROM ratings
+    WHERE user_id = $1
+    AND tmdb_id = $2
+    AND type = $3
+"""
 
 
 async def get_user_rating(tg_id: int, tmdb_id: int, type_: str):
     async with db.acquire() as conn:
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE tg_id=$1", tg_id)
-        if not user:
+        user_id = await get_user_id(conn, tg_id)
+        if user_id is None:
             return None
-        row = await conn.fetchrow("""
-            SELECT liked, disliked, watched, is_hidden
-            FROM ratings
-            WHERE user_id = $1
-            AND tmdb_id = $2
-            AND type = $3
-        """, user["user_id"], tmdb_id, type_)
+        row = await conn.fetchrow(SQL_GET_USER_RATING, user_id, tmdb_id, type_)
         if row:
             return {
                 "liked": row["liked"],
@@ -4907,37 +6968,9 @@ async def get_ratings_stats(sort_by: str = "updated", page: int = 0, limit: int
             "total_pages": (total_count + limit - 1) // limit
         }
 
-async def handle_rating(callback, action, tmdb_id=None, type_=None):
+async def handle_rating(callback, action, tmdb_id: int, type_: str):
     chat_id = callback.message.chat.id
 
-    # Если tmdb_id и type_ не переданы, извлекаем их из callback.data
-    if tmdb_id is None or type_ is None:
-        parts = callback.data.split("_")
-        print(f"DEBUG: callback.data = {callback.data}, parts = {parts}")  # Отладочная информация
-
-        # Для действия "watch" формат: mark_watched_{tmdb_id}_{type_}
-        if action == "watch":
-            if len(parts) < 3:
-                await callback.answer("Ошибка: некорректные данные для отметки просмотра.")
-                return
-            try:
-                tmdb_id = int(parts[2])
-                type_ = parts[3] if len(parts) > 3 else "movie"  # default to movie if not specified
-            except (ValueError, IndexError) as e:
-                await callback.answer(f"Ошибка данных: {e}")
-                return
-        # Для действий like/dislike/reset формат: {action}_{tmdb_id}_{type_}
-        else:
-            if len(parts) < 3:
-                await callback.answer("Ошибка: некорректные данные.")
-                return
-            try:
-                tmdb_id = int(parts[1])
-                type_ = parts[2]
-            except (ValueError, IndexError) as e:
-                await callback.answer(f"Ошибка данных: {e}")
-                return
-
     print(f"DEBUG: handle_rating called with action={action}, tmdb_id={tmdb_id}, type_={type_}")
 
     user_rating = await get_user_rating(chat_id, tmdb_id, type_)
@@ -4963,11 +6996,14 @@ async def handle_rating(callback, action, tmdb_id=None, type_=None):
 
     print(f"DEBUG: after change - liked={liked}, disliked={disliked}, watched={watched}")
 
-    details = get_item_details(type_, tmdb_id)
+    details = await get_item_details(type_, tmdb_id)
     title = details.get("title") or details.get("name") or "Без названия"
 
-    success = await add_rating(chat_id, tmdb_id, type_, liked=liked, disliked=disliked, watched=watched, title=title)
-    print(f"DEBUG: add_rating success = {success}")
+    saved = await add_rating(chat_id, tmdb_id, type_, liked=liked, disliked=disliked, watched=watched, title=title)
+    print(f"DEBUG: add_rating result = {saved}")
+    if saved is not None:
+        liked, disliked, watched = saved["liked"], saved["disliked"], saved["watched"]
+        invalidate_card_prefetch(chat_id, tmdb_id)
 
     # Обновляем карточку
     avg_ratings = await get_ratings(tmdb_id, type_)
@@ -4977,7 +7013,7 @@ async def handle_rating(callback, action, tmdb_id=None, type_=None):
     overview = details.get("overview") or "Описание отсутствует."
     if len(overview) > 2000:
         overview = overview[:2000] + "..."
-    poster = f"https://image.tmdb.org/t/p/w500{details.get('poster_path')}" if details.get("poster_path") else None
+    poster = poster_media(details["poster_path"]) if details.get("poster_path") else None
     caption = (
         f"{title} ({year})\n"
         f"Рейтинг: {rating_tmdb} (TMDB)\n"
@@ -4991,14 +7027,14 @@ async def handle_rating(callback, action, tmdb_id=None, type_=None):
                 chat_id=chat_id,
                 message_id=callback.message.message_id,
                 media=types.InputMediaPhoto(media=poster, caption=caption),
-                reply_markup=kb_collection_item(tmdb_id, type_, watched, liked, disliked)
+                reply_markup=await kb_collection_item(tmdb_id, type_, watched, liked, disliked)
             )
         else:
             await bot.edit_message_caption(
                 chat_id=chat_id,
                 message_id=callback.message.message_id,
                 caption=caption,
-                reply_markup=kb_collection_item(tmdb_id, type_, watched, liked, disliked)
+                reply_markup=await kb_collection_item(tmdb_id, type_, watched, liked, disliked)
             )
     except Exception as e:
         print(f"Ошибка при обновлении карточки: {e}")
@@ -5010,7 +7046,19 @@ async def handle_rating(callback, action, tmdb_id=None, type_=None):
 async def main():
     await init_db()
     await set_bot_commands()
-    await dp.start_polling(bot)
+    reconcile_task = asyncio.create_task(title_stats_reconcile_loop())
+    sweep_task = asyncio.create_task(session_sweep_loop())
+    cf_task = asyncio.create_task(cf_rebuild_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        reconcile_task.cancel()
+        sweep_task.cancel()
+        cf_task.cancel()
+        discover_pool.close()
+        await details_cache.close()
+        await stop_banned_listener()
+        await close_tmdb_http()
 
 
 if __name__ == "__main__":